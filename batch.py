@@ -0,0 +1,584 @@
+""" Many matches stepped at once, as NumPy arrays.
+
+`BatchGame` plays the rules of `bomb.GameState` for n matches of one level
+side by side: cells, positions, bomb fuses and flames are arrays with a
+match axis, and a tick is a fixed number of array operations however many
+matches there are. It is meant for policies which are vectorized too, say
+for training: inputs are arrays of move and drop commands per player.
+
+Where the rules leave the order of things open it is fixed here: every
+drop of a tick is applied before every move, player by player, and a player
+picking up two collectibles in one tick gets the one with the highest cell
+index (with `GameState`, the one added last). Each match has `bombs` bomb
+slots, a drop finding none free is ignored. Collectible spawns and drops
+follow the same odds as `GameState` but come from NumPy's generator.
+
+`python batch.py --check` plays random inputs through both engines with
+collectible spawns and drops off and compares them after every tick,
+`python batch.py --bench` compares their speed. Needs numpy
+(`pip install numpy`).
+"""
+import argparse
+import time
+
+import numpy as np
+
+from bomb import (GameState, Direction, BOMB_TTL, CELL_SIZE, CSIZE, EPSILON,
+                  FLAME_TTL, NEW_COLL, PSIZE, load_level)
+from lockstep import Lockstep
+from snapshot import SYMBOLS, SYMBOL_CODES
+
+FLOOR = SYMBOL_CODES['0']
+WALL = SYMBOL_CODES['1']
+BREAKABLE = SYMBOL_CODES['2']
+BOOTS = SYMBOL_CODES['~']
+EXTRA = SYMBOL_CODES['+']
+MEGA = SYMBOL_CODES['!']
+# same odds as GameState.break_walls and random_collectible
+DROPS = np.array([SYMBOL_CODES[c] for c in '000~0+0+0!0!000'])
+SPAWNS = np.array([SYMBOL_CODES[c] for c in '~++!!'])
+# move command which isn't a direction
+STOP = -1
+BOMBS_PER_PLAYER = 4
+# unit steps of every combination of Direction flags
+STEP_X = np.array([bool(d & Direction.RIGHT.value)
+                   - bool(d & Direction.LEFT.value) for d in range(16)], float)
+STEP_Y = np.array([bool(d & Direction.UP.value)
+                   - bool(d & Direction.DOWN.value) for d in range(16)], float)
+DT = 1/60
+
+
+class BatchGame:
+    def __init__(self, n, level='map1.txt', players=4, dt=DT, bombs=None,
+                 seed=None, random_events=True):
+        # a player moving more than a cell in one tick could skip a wall
+        assert 55 * dt < CELL_SIZE - 1, "dt too large"
+        self.n = n
+        self.players = players
+        self.dt = dt
+        self.random_events = random_events
+        self.rng = np.random.default_rng(seed)
+        # a level file, or load_level's (width, height, cells)
+        self.width, self.height, cells = load_level(level) \
+            if isinstance(level, str) else level
+        self.size = self.width * self.height
+        self.level = np.array([SYMBOL_CODES[c] for c in cells], np.int8)
+        self.level_colls = np.where(self.level >= BOOTS, self.level, 0)
+        self.level_walls = ((self.level == WALL)
+                            | (self.level == BREAKABLE)).astype(np.int8)
+        # GameState.spawn_player's order
+        points, spawns = [], []
+        for _ in range(players):
+            if not points:
+                points = [i for i, c in enumerate(cells) if c in 'abcd']
+            spawns.append(points.pop())
+        self.spawns = np.array(
+            [(i % self.width * CELL_SIZE, i // self.width * CELL_SIZE)
+             for i in spawns], float)
+
+        b = bombs or players * BOMBS_PER_PLAYER
+        assert b <= 64, "can_walk holds a bit per bomb slot"
+        self.bits = np.uint64(1) << np.arange(b, dtype=np.uint64)
+        self.cells = np.empty((n, self.size), np.int8)
+        self.colls = np.empty((n, self.size), np.int8)  # kind, or 0
+        self.pos = np.empty((n, players, 2))
+        self.alive = np.empty((n, players), bool)
+        self.bomb_limit = np.empty((n, players), np.int16)
+        self.bomb_radius = np.empty((n, players), np.int16)
+        self.speed_boots = np.empty((n, players), bool)
+        self.direction = np.empty((n, players), np.int8)
+        self.moving_time = np.empty((n, players))
+        self.bombs_out = np.empty((n, players), np.int8)  # per player
+        self.bomb_on = np.empty((n, b), bool)
+        self.bomb_cell = np.empty((n, b), np.int32)
+        self.bomb_owner = np.empty((n, b), np.int8)
+        self.bomb_birth = np.empty((n, b))
+        self.bomb_reach = np.empty((n, b), np.int16)  # its radius
+        # walls and bombs per cell
+        self.obstacles = np.empty((n, self.size), np.int8)
+        self.can_walk = np.empty((n, players), np.uint64)  # slot bits
+        self.flame_on = np.empty((n, self.size), bool)
+        self.flame_birth = np.empty((n, self.size))
+        self.burning = np.empty(n, bool)  # any flame
+        self.running = np.empty(n, bool)
+        self.ticks = np.empty(n, np.int64)
+        self.last_coll = np.empty(n)
+        self.reset()
+
+    def reset(self, mask=None):
+        """ Start matches over, all of them or where mask is set """
+        m = slice(None) if mask is None else mask
+        self.cells[m] = self.level
+        self.colls[m] = self.level_colls
+        self.pos[m] = self.spawns
+        self.alive[m] = True
+        self.bomb_limit[m] = 1
+        self.bomb_radius[m] = 1
+        self.speed_boots[m] = False
+        self.direction[m] = Direction.DOWN.value
+        self.moving_time[m] = 0
+        self.bombs_out[m] = 0
+        self.bomb_on[m] = False
+        self.bomb_cell[m] = 0
+        self.obstacles[m] = self.level_walls
+        self.can_walk[m] = 0
+        self.flame_on[m] = False
+        self.burning[m] = False
+        self.running[m] = True
+        self.ticks[m] = 0
+        self.last_coll[m] = 0
+
+    @property
+    def now(self):
+        return self.ticks * self.dt
+
+    def mask(self, flags):
+        """ Bomb slot flags (..., slots) to can_walk bits """
+        return (flags * self.bits).sum(-1, dtype=np.uint64)
+
+    def flat(self, rows, idx):
+        """ Indices into the flattened (n, cells) arrays """
+        return rows * self.size + idx
+
+    def under(self, x, y, osize):
+        """ Indices of the cells whose (osize, osize) square at the cell's
+        corner overlaps the player rect at (x, y), with a mask of the valid
+        ones, in index order: shape (..., 4) """
+        rx = x + 2
+        i0 = np.floor((rx - osize) / CELL_SIZE) + 1
+        i1 = np.ceil((rx + PSIZE[0]) / CELL_SIZE) - 1
+        j0 = np.floor((y - osize) / CELL_SIZE) + 1
+        j1 = np.ceil((y + PSIZE[1]) / CELL_SIZE) - 1
+        i = np.stack([i0, i0 + 1, i0, i0 + 1], -1)
+        j = np.stack([j0, j0, j0 + 1, j0 + 1], -1)
+        ok = (i <= i1[..., None]) & (j <= j1[..., None]) \
+            & (i >= 0) & (i < self.width) & (j >= 0) & (j < self.height)
+        idx = np.where(ok, j * self.width + i, 0).astype(np.intp)
+        return idx, ok
+
+    def bomb_touches(self, x, y, cell):
+        """ collides(player rect, bomb rect), broadcasting """
+        bx = cell % self.width * CELL_SIZE
+        by = cell // self.width * CELL_SIZE
+        rx = x + 2
+        return (rx < bx + CELL_SIZE) & (rx + PSIZE[0] > bx) \
+            & (y < by + CELL_SIZE) & (y + PSIZE[1] > by)
+
+    def tick(self):
+        """ GameState.tick for every running match, returns the mask of the
+        matches which ended """
+        self.ticks += 1
+        now = self.now
+        live = self.running.copy()
+        rows = np.arange(self.n)[:, None]
+        if self.random_events:
+            self.spawn_collectibles(live, now)
+
+        flames = self.flame_on.reshape(-1)
+        exploding = self.bomb_on & live[:, None] \
+            & (now[:, None] - self.bomb_birth >= BOMB_TTL)
+        m = np.nonzero(live & self.burning)[0]
+        exploding[m] |= self.bomb_on[m] \
+            & flames[self.flat(m[:, None], self.bomb_cell[m])]
+        if exploding.any():
+            self.explode(exploding, now)
+
+        # flames don't change while GameState checks players one after the
+        # other, deaths can be found all at once
+        was_alive = self.alive.copy()
+        m = np.nonzero(live & self.burning)[0]
+        idx, ok = self.under(self.pos[m, :, 0], self.pos[m, :, 1], CELL_SIZE)
+        self.alive[m] &= ~(flames[self.flat(m[:, None, None], idx)]
+                           & ok).any(-1)
+        idx, ok = self.under(self.pos[..., 0], self.pos[..., 1], CSIZE)
+        colls = self.colls.reshape(-1)
+        picked = (colls[self.flat(rows[..., None], idx)] > 0) & ok \
+            & live[:, None, None]
+        if picked.any():
+            self.pick(np.nonzero(picked.any((1, 2)))[0], idx, ok, was_alive)
+
+        m = np.nonzero(live & self.burning)[0]
+        self.flame_on[m] &= now[m, None] - self.flame_birth[m] < FLAME_TTL
+        self.burning[m] = self.flame_on[m].any(1)
+        over = live & (self.alive.sum(1) <= 1)
+        self.running &= ~over
+        return over
+
+    def pick(self, m, idx, ok, was_alive):
+        """ Collectibles picked in matches m, player by player: what lies
+        under two players goes to the first. Only the last one a player
+        picks counts, GameState applies each to the player as it was before
+        the tick's deaths, alive included """
+        colls = self.colls.reshape(-1)
+        rows = np.arange(len(m))
+        for p in range(self.players):
+            at = self.flat(m[:, None], idx[m, p])
+            kinds = colls[at] * ok[m, p]
+            picked = kinds > 0
+            got = picked.any(1)
+            last = 3 - np.argmax(picked[:, ::-1], 1)
+            kind = np.where(got, kinds[rows, last], 0)
+            colls[at[picked]] = 0
+            self.alive[m, p] = np.where(got, was_alive[m, p],
+                                        self.alive[m, p])
+            self.speed_boots[m, p] |= kind == BOOTS
+            self.bomb_radius[m, p] += kind == MEGA
+            self.bomb_limit[m, p] += kind == EXTRA
+
+    def spawn_collectibles(self, live, now):
+        due = live & (np.floor(now - self.last_coll) > self.rng.integers(
+            NEW_COLL, NEW_COLL + 16, self.n))
+        if not due.any():
+            return
+        m = np.nonzero(due)[0]
+        free = (self.cells[m] != WALL) & (self.cells[m] != BREAKABLE) \
+            & (self.colls[m] == 0)
+        idx, ok = self.under(self.pos[m, :, 0], self.pos[m, :, 1], CSIZE)
+        k, p, c = np.nonzero(ok)
+        free[k, idx[k, p, c]] = False
+        cell = np.argmax(self.rng.random(free.shape) * free, 1)
+        kind = self.rng.choice(SPAWNS, len(m))
+        found = free.any(1)
+        m, cell, kind = m[found], cell[found], kind[found]
+        self.cells[m, cell] = kind
+        self.colls[m, cell] = kind
+        self.last_coll[m] = now[m]
+
+    def explode(self, exploding, now):
+        """ generate_flames and break_walls of GameState, for the exploding
+        bombs only """
+        m, b = np.nonzero(exploding)
+        cell = self.bomb_cell[m, b]
+        radius = self.bomb_reach[m, b]
+        cells = self.cells.reshape(-1)
+        flames = [self.flat(m, cell)]
+        hits = []
+        for step in (-1, -self.width, 1, self.width):
+            go = np.ones(len(m), bool)
+            c = cell
+            for r in range(1, radius.max() + 1):
+                c = c + step
+                go &= (r <= radius) & (c >= 0) & (c < self.size)
+                if not go.any():
+                    break
+                at = self.flat(m, np.clip(c, 0, self.size - 1))
+                code = cells[at]
+                wall = (code == WALL) | (code == BREAKABLE)
+                hit = go & (code == BREAKABLE)
+                flames.append(at[go & (~wall | hit)])
+                hits.append(at[hit])
+                go &= ~wall
+        flames = np.concatenate(flames)
+        self.flame_on.reshape(-1)[flames] = True
+        self.flame_birth.reshape(-1)[flames] = now[flames // self.size]
+        self.burning[m] = True
+        # two bombs may hit the same wall
+        broken = np.unique(np.concatenate(hits)) if hits else []
+        if self.random_events:
+            drops = self.rng.choice(DROPS, len(broken))
+        else:
+            drops = FLOOR
+        cells[broken] = drops
+        self.obstacles.reshape(-1)[broken] -= 1
+        self.colls.reshape(-1)[broken] = drops
+        self.bomb_on[m, b] = False
+        np.subtract.at(self.bombs_out, (m, self.bomb_owner[m, b]), 1)
+        np.subtract.at(self.obstacles.reshape(-1), self.flat(m, cell), 1)
+        gone = np.zeros(self.n, np.uint64)
+        np.bitwise_or.at(gone, m, self.bits[b])
+        self.can_walk &= ~gone[:, None]
+
+    def act(self, moves, drops):
+        """ Players' inputs for the tick which just ran: moves (n, players)
+        direction flags, STOP or 0 for nothing, drops (n, players) bool """
+        act = self.running[:, None] & self.alive
+        now = self.now
+        for p in range(self.players):
+            ok = drops[:, p] & act[:, p] \
+                & (self.bombs_out[:, p] < self.bomb_limit[:, p])
+            if not ok.any():
+                continue
+            m = np.nonzero(ok)[0]
+            m = m[self.bombs_out[m].sum(1) < len(self.bits)]  # free slot
+            slot = np.argmax(~self.bomb_on[m], 1)
+            x = self.pos[m, p, 0] + CELL_SIZE / 2
+            y = self.pos[m, p, 1] + CELL_SIZE / 2
+            cell = (y // CELL_SIZE * self.width + x // CELL_SIZE).astype(
+                np.int32)
+            self.bomb_on[m, slot] = True
+            self.bomb_cell[m, slot] = cell
+            self.bomb_owner[m, slot] = p
+            self.bomb_birth[m, slot] = now[m]
+            self.bomb_reach[m, slot] = self.bomb_radius[m, p]
+            self.obstacles[m, cell] += 1
+            self.bombs_out[m, p] += 1
+            # players on it may walk off it
+            on = self.bomb_touches(self.pos[m, :, 0], self.pos[m, :, 1],
+                                   cell[:, None])
+            self.can_walk[m] |= np.where(on, self.bits[slot, None], 0)
+
+        stop = act & (moves == STOP)
+        self.moving_time[stop] = 0
+        move = act & (moves > 0)
+        if not move.any():
+            return
+        self.moving_time[move] += self.dt
+        self.direction[move] = moves[move]
+        # only the moving players from here
+        m, p = np.nonzero(move)
+        moves = moves[m, p]
+        x, y = self.pos[m, p, 0], self.pos[m, p, 1]
+        w = np.nonzero(self.can_walk[m, p])[0]
+        self.can_walk[m[w], p[w]] &= self.mask(self.bomb_touches(
+            x[w, None], y[w, None], self.bomb_cell[m[w]]))
+        walk = self.can_walk[m, p]
+
+        s = np.where(self.speed_boots[m, p], 55, 40) * self.dt
+        dy = STEP_Y[moves] * s
+        dx = STEP_X[moves] * s
+        y = y + self.sweep(m, y, x + 2, dy, 1, walk)
+        x = x + self.sweep(m, x + 2, y, dx, 0, walk)
+        self.pos[m, p, 0] = x
+        self.pos[m, p, 1] = y
+
+    def sweep(self, m, start, across, delta, axis, walk):
+        """ bomb.sweep for players of matches m with can_walk bits walk: the
+        obstacles are whole cells, so only the row (or column) of cells just
+        ahead of a player can stop it """
+        moving = np.nonzero(delta)[0]
+        delta = delta.copy()
+        m, start, across, walk = \
+            m[moving], start[moving], across[moving], walk[moving]
+        d = delta[moving]
+        size = PSIZE[axis]
+        a0 = np.floor((across + EPSILON) / CELL_SIZE)
+        a1 = np.ceil((across + PSIZE[1 - axis] - EPSILON) / CELL_SIZE) - 1
+        forward = d > 0
+        ahead = np.where(forward,
+                         np.ceil((start + size - EPSILON) / CELL_SIZE),
+                         np.floor((start + EPSILON) / CELL_SIZE) - 1)
+        o = ahead * CELL_SIZE
+        gap = np.where(forward, o - start - size, o + CELL_SIZE - start)
+        blocked = np.zeros(len(m), bool)
+        obstacles = self.obstacles.reshape(-1)
+        w = np.nonzero(walk)[0]
+        for a in (a0, a1):
+            i, j = (ahead, a) if axis == 0 else (a, ahead)
+            ok = (i >= 0) & (i < self.width) & (j >= 0) & (j < self.height)
+            cell = np.where(ok, j * self.width + i, 0).astype(np.intp)
+            # a bomb blocks unless the player may walk through it
+            through = np.zeros(len(m), np.int8)
+            through[w] = ((self.bomb_cell[m[w]] == cell[w, None])
+                          & ((walk[w, None] & self.bits) != 0)).sum(1)
+            blocked |= ok & (obstacles[self.flat(m, cell)] > through)
+        stopped = np.where(forward, np.maximum(0, np.minimum(d, gap)),
+                           np.minimum(0, np.maximum(d, gap)))
+        delta[moving] = np.where(blocked, stopped, d)
+        return delta
+
+    def state(self, m):
+        """ Match m, comparable with reference_state """
+        return {
+            'running': bool(self.running[m]),
+            'cells': ''.join(SYMBOLS[c] for c in self.cells[m]),
+            'players': [
+                (*map(float, self.pos[m, p]), bool(self.alive[m, p]),
+                 int(self.bomb_limit[m, p]), int(self.bomb_radius[m, p]),
+                 bool(self.speed_boots[m, p]), int(self.direction[m, p]),
+                 float(self.moving_time[m, p]))
+                for p in range(self.players)],
+            'bombs': sorted(
+                (int(self.bomb_cell[m, b]), int(self.bomb_owner[m, b]),
+                 float(self.bomb_birth[m, b]), int(self.bomb_reach[m, b]))
+                for b in np.nonzero(self.bomb_on[m])[0]),
+            'flames': [int(i) for i in np.nonzero(self.flame_on[m])[0]],
+            'collectibles': [(int(i), SYMBOLS[self.colls[m, i]])
+                             for i in np.nonzero(self.colls[m])[0]],
+        }
+
+
+def reference_state(gs: GameState, names):
+    def idx(pos):
+        return gs.cell_idx(gs.cell_from_coords(pos))
+    return {
+        'running': gs.running,
+        'cells': ''.join(gs.cells),
+        'players': [
+            (*gs.players[n].pos, gs.players[n].alive,
+             gs.players[n].bomb_limit, gs.players[n].bomb_radius,
+             gs.players[n].speed_boots, gs.players[n].direction,
+             gs.players[n].moving_time)
+            for n in names],
+        'bombs': sorted((idx(b.pos), names.index(b.player), b.birth,
+                         b.radius) for b in gs.bombs),
+        'flames': sorted({idx(f.pos) for f in gs.flames}),
+        'collectibles': sorted((idx(c.pos), c.kind)
+                               for c in gs.collectibles),
+    }
+
+
+class NoRandom:
+    """ GameState's random for check(): no collectible spawns or drops """
+
+    def seed(self, seed):
+        pass
+
+    def randint(self, a, b):
+        return float('inf')
+
+    def choice(self, seq):
+        return seq[0]  # '0' for drops
+
+
+class RandomInputs:
+    """ Players walking about at random, dropping a bomb now and then """
+
+    def __init__(self, n, players, seed=None, turn=0.05, drop=0.01):
+        self.rng = np.random.default_rng(seed)
+        self.turn = turn
+        self.drop = drop
+        self.commands = np.array([d.value for d in Direction] + [STOP],
+                                 np.int8)
+        self.moves = self.rng.choice(self.commands, (n, players))
+
+    def __call__(self):
+        turn = self.rng.random(self.moves.shape) < self.turn
+        self.moves[turn] = self.rng.choice(self.commands, turn.sum())
+        return self.moves.copy(), self.rng.random(self.moves.shape) < self.drop
+
+    def reset(self, mask):
+        self.moves[mask] = self.rng.choice(self.commands,
+                                           self.moves[mask].shape)
+
+
+def reference_match(level, players, dt, random_events=True, seed=None):
+    gs = GameState(seed)
+    sim = Lockstep(gs, seed or 0, dt)
+    if not random_events:
+        gs.random = NoRandom()
+    w, h, cells = load_level(level) if isinstance(level, str) else level
+    gs.set_level(w, h, list(cells))
+    gs.running = True
+    names = [f'p{i}' for i in range(players)]
+    for name in names:
+        gs.spawn_player(name)
+    return sim, names
+
+
+def messages(names, moves, drops):
+    """ One match's inputs as GameState messages, in BatchGame's order """
+    inputs = [(name, {'code': 'drop_bomb'})
+              for name, drop in zip(names, drops) if drop]
+    for name, move in zip(names, moves):
+        if move == STOP:
+            inputs.append((name, {'code': 'stop'}))
+        elif move:
+            inputs.append((name, {'code': 'move', 'dir': int(move)}))
+    return inputs
+
+
+def check(matches=32, ticks=3000, level='map1.txt', players=4, dt=DT,
+          seed=0):
+    """ Play the same random inputs through BatchGame and GameState, with
+    spawns and drops off, return the first difference or None """
+    # collectibles on a fifth of the floor instead, to have pickups
+    rng = np.random.default_rng(seed)
+    w, h, cells = load_level(level)
+    cells = [str(rng.choice(list('~+!'))) if c == '0' and rng.random() < 0.2
+             else c for c in cells]
+    level = w, h, cells
+    batch = BatchGame(matches, level, players, dt, random_events=False)
+    sims = [reference_match(level, players, dt, False)
+            for _ in range(matches)]
+    inputs = RandomInputs(matches, players, seed, drop=0.005)
+    for tick in range(1, ticks + 1):
+        over = batch.tick()
+        moves, drops = inputs()
+        batch.act(moves, drops)
+        for m, (sim, names) in enumerate(sims):
+            sim.step(messages(names, moves[m], drops[m]))
+            expected = reference_state(sim.gs, names)
+            got = batch.state(m)
+            for k in expected:
+                if got[k] != expected[k]:
+                    return (f"match {m}, tick {tick}, {k}:\n"
+                            f"  GameState {expected[k]}\n"
+                            f"  BatchGame {got[k]}")
+            if over[m]:
+                sims[m] = reference_match(level, players, dt, False)
+        if over.any():
+            batch.reset(over)
+            inputs.reset(over)
+    return None
+
+
+def bench_reference(matches, ticks, level, players, dt, seed=0):
+    """ Match ticks and matches finished per second, one GameState after
+    the other """
+    inputs = RandomInputs(matches, players, seed)
+    plan = [inputs() for _ in range(ticks)]
+    sims = [reference_match(level, players, dt, seed=seed + m)
+            for m in range(matches)]
+    done = 0
+    t0 = time.perf_counter()
+    for moves, drops in plan:
+        for m, (sim, names) in enumerate(sims):
+            sim.step(messages(names, moves[m], drops[m]))
+            if not sim.gs.running:
+                sims[m] = reference_match(level, players, dt, seed=seed + m)
+                done += 1
+    elapsed = time.perf_counter() - t0
+    return matches * ticks / elapsed, done / elapsed
+
+
+def bench_batch(matches, ticks, level, players, dt, seed=0):
+    game = BatchGame(matches, level, players, dt, seed=seed)
+    inputs = RandomInputs(matches, players, seed)
+    done = 0
+    t0 = time.perf_counter()
+    for _ in range(ticks):
+        over = game.tick()
+        if over.any():
+            done += over.sum()
+            game.reset(over)
+            inputs.reset(over)
+        game.act(*inputs())
+    elapsed = time.perf_counter() - t0
+    return matches * ticks / elapsed, done / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--check', action='store_true',
+                        help="compare with GameState tick by tick")
+    parser.add_argument('--bench', action='store_true',
+                        help="compare speed with GameState")
+    parser.add_argument('--matches', type=int, default=4096,
+                        help="matches stepped together (--check: 32)")
+    parser.add_argument('--ticks', type=int, default=3000)
+    parser.add_argument('--level', default='map1.txt')
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--dt', type=float, default=DT)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.check:
+        matches = min(args.matches, 32)
+        error = check(matches, args.ticks, args.level, args.players,
+                      args.dt, args.seed)
+        if error:
+            parser.exit(1, f"Mismatch: {error}\n")
+        print(f"{matches} matches, {args.ticks} ticks: same as GameState")
+    if args.bench:
+        ref = bench_reference(16, args.ticks, args.level, args.players,
+                              args.dt, args.seed)
+        got = bench_batch(args.matches, args.ticks, args.level,
+                          args.players, args.dt, args.seed)
+        for name, (ticks, done) in (('GameState', ref), ('BatchGame', got)):
+            print(f"{name:>9}: {ticks:10.0f} match ticks/s "
+                  f"{done:8.1f} matches/s")
+        print(f"speedup: {got[0] / ref[0]:.0f}x")
+
+
+if __name__ == '__main__':
+    main()
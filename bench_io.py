@@ -0,0 +1,130 @@
+""" Loopback throughput of the server socket path, default vs --fast-io.
+
+Four players join a server and flood it with pings, each of which makes the
+server broadcast a status message to everybody. Reports datagrams handled
+per second of server CPU time.
+"""
+import argparse
+import json
+import multiprocessing
+import socket
+import subprocess
+import sys
+import time
+
+from server import DEFAULT_PORT, MAX_CLIENTS
+
+
+def admin_stats(port, tries=5):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(2)
+    try:
+        # the request gets dropped when the server queue is full, retry
+        for _ in range(tries):
+            sock.sendto(json.dumps({'code': 'admin',
+                                    'cmd': 'stats'}).encode(),
+                        ('127.0.0.1', port))
+            try:
+                return json.loads(sock.recv(65535).decode())
+            except socket.timeout:
+                pass
+        raise RuntimeError("Server does not answer")
+    finally:
+        sock.close()
+
+
+def flood(sock, port, duration):
+    addr = ('127.0.0.1', port)
+    end = time.time() + duration
+    sent = 0
+    while time.time() < end:
+        for _ in range(100):
+            sock.sendto(json.dumps({'code': 'ping',
+                                    't': time.time()}).encode(), addr)
+        sent += 100
+        # keep the receive queue from growing, content is not needed
+        try:
+            while True:
+                sock.recv(65535)
+        except BlockingIOError:
+            pass
+    return sent
+
+
+def join(i, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.sendto(json.dumps({'code': 'hi', 'name': f'bench{i}'}).encode(),
+                ('127.0.0.1', port))
+    sock.setblocking(False)
+    return sock
+
+
+def player(i, port, duration, start, results):
+    sock = join(i, port)
+    start.wait()
+    results.put(flood(sock, port, duration))
+
+
+def run(port, fast_io, duration, players):
+    # measuring the socket path, not the per address limit
+    cmd = [sys.executable, 'server.py', '--port', str(port),
+           '--rate-limit', '0']
+    if fast_io:
+        cmd.append('--fast-io')
+    server = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    time.sleep(1)
+    try:
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=player,
+                                         args=(i, port, duration, start,
+                                               results))
+                 for i in range(players)]
+        for p in procs:
+            p.start()
+        time.sleep(0.5)
+
+        before = admin_stats(port)['io']
+        t0 = time.time()
+        start.set()
+        sent = sum(results.get() for _ in procs)
+        elapsed = time.time() - t0
+        after = admin_stats(port)['io']
+        for p in procs:
+            p.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    received = after['received'] - before['received']
+    out = after['sent'] - before['sent']
+    cpu = after['cpu'] - before['cpu']
+    return {
+        'offered_pps': sent / elapsed,
+        'in_pps': received / elapsed,
+        'out_pps': out / elapsed,
+        'cpu': cpu / elapsed,
+        'in_per_core': received / cpu if cpu else 0,
+        'out_per_core': out / cpu if cpu else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT + 100)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--players', type=int, default=MAX_CLIENTS)
+    args = parser.parse_args()
+
+    print(f"{'path':<8} {'offered':>9} {'in/s':>9} {'out/s':>9} "
+          f"{'cpu':>5} {'in/core':>9} {'out/core':>9}")
+    for name, fast_io in [('default', False), ('fast-io', True)]:
+        r = run(args.port, fast_io, args.duration, args.players)
+        print(f"{name:<8} {r['offered_pps']:>9.0f} {r['in_pps']:>9.0f} "
+              f"{r['out_pps']:>9.0f} {r['cpu']:>5.2f} "
+              f"{r['in_per_core']:>9.0f} {r['out_per_core']:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,10 @@
 import random
 import time
-from collections import defaultdict
+from collections import Counter, defaultdict
 from enum import Flag
 from typing import Tuple, NamedTuple, Callable, Dict, List, Optional
 
-_uid = 0
+from tracing import NULL_TRACER
 
 CELL_SIZE = 16
 CSIZE = 14
@@ -16,6 +16,10 @@ FLAME_TTL = 0.3
 
 NEW_COLL = 40
 
+# Slack on contacts: a player clamped against a wall may end up a rounding
+# error inside it
+EPSILON = 1e-6
+
 Cell = Tuple[int, int]
 Coords = Tuple[float, float]
 
@@ -115,12 +119,6 @@ COLLECTIBLES = {
 }
 
 
-def uid():
-    global _uid
-    _uid += 1
-    return _uid
-
-
 def is_collectible(c):
     return c in '+~!'
 
@@ -152,6 +150,24 @@ def collides(r1: Rect, r2: Rect) -> bool:
         (y1 + h1 > y2)
 
 
+def sweep(rect: Rect, delta, axis, obstacles) -> float:
+    """ How far rect moves along axis (0: x, 1: y) when asked to move by
+    delta, stopping in contact with the first obstacle on the way """
+    start, size = rect[axis], rect[axis + 2]
+    across, width = rect[1 - axis], rect[3 - axis]
+    for o in obstacles:
+        # only what overlaps rect across the movement can be hit, touching
+        # isn't overlapping
+        if o[1 - axis] >= across + width - EPSILON \
+                or o[1 - axis] + o[3 - axis] <= across + EPSILON:
+            continue
+        if delta > 0 and o[axis] >= start + size - EPSILON:
+            delta = max(0, min(delta, o[axis] - start - size))
+        elif delta < 0 and o[axis] + o[axis + 2] <= start + EPSILON:
+            delta = min(0, max(delta, o[axis] + o[axis + 2] - start))
+    return delta
+
+
 def load_players(players):
     return {name: Player(*p) for name, p in players.items()}
 
@@ -174,14 +190,29 @@ class GameState:
         'collectibles': load_list(Collectible),
     }
 
-    def __init__(self):
+    def __init__(self, seed=None, clock=time.time):
+        # both can be replaced for deterministic simulations
+        self.clock = clock
+        self.random = random.Random(seed)
         self.running = False
         self.players = {}
         self.bombs = []
         self.flames = []
         self.collectibles = []
         self._can_walk = defaultdict(set)
-        self._last_coll = time.time()
+        self._last_coll = self.clock()
+        self._uid = 0
+        # match statistics, not part of the state
+        self.stats = Counter()
+        self.player_stats = defaultdict(Counter)
+        self.deaths = {}  # name -> clock time
+        self.started_at = self._last_coll
+        # spans of the tick's phases, when the server traces
+        self.tracer = NULL_TRACER
+
+    def uid(self):
+        self._uid += 1
+        return self._uid
 
     def cell_from_idx(self, idx) -> Cell:
         """ Cell index to Grid coords """
@@ -202,7 +233,7 @@ class GameState:
         return x // CELL_SIZE, y // CELL_SIZE
 
     def generate_flames(self, bomb: Bomb) -> List[Cell]:
-        now = time.time()
+        now = self.clock()
         cell = self.cell_from_coords(bomb.pos)
         flames = [Flame(self.cell_coords(cell), now, 'c')]
         hit_indices = []
@@ -238,6 +269,12 @@ class GameState:
         return x + CELL_SIZE/2, y + CELL_SIZE/2
 
     def spawn_player(self, player_name):
+        if not self.spawn_points:
+            # more players than the level planned (bot soak tests),
+            # share the spawn points
+            self.spawn_points = [
+                i for i, c in enumerate(self.cells) if c in 'abcd'
+            ]
         loc = self.spawn_points.pop()
         self.players[player_name] = Player(
             pid=self.cells[loc],
@@ -248,9 +285,9 @@ class GameState:
     def random_collectible(self):
         found = None
         while not found:
-            i = random.choice([i for i, c in enumerate(self.cells)
+            i = self.random.choice([i for i, c in enumerate(self.cells)
                                if not is_wall(c)])
-            kind = random.choice('~++!!')
+            kind = self.random.choice('~++!!')
             coll = self.create_collectible(i, kind)
             forbid = self._walls + list(self.players.values()) \
                 + self.collectibles
@@ -275,7 +312,7 @@ class GameState:
         ]
         self.update_wall_rects()
         self.update_collectible_rects()
-        self._last_coll = time.time()
+        self._last_coll = self.started_at = self.clock()
 
     def update_collectible_rects(self):
         self.collectibles = [
@@ -303,19 +340,54 @@ class GameState:
             if k in self.fields:
                 setattr(self, k, self.fields[k](v))
 
+    def patch(self, data):
+        """ Like load, but only replaces what differs
+
+        Returns the fields which changed, with the names of the changed
+        players for 'players'.
+        """
+        changed = {}
+        for k, v in data.items():
+            if k not in self.fields:
+                continue
+            new, old = self.fields[k](v), getattr(self, k, None)
+            if k == 'players':
+                names = {n for n in new.keys() | old.keys()
+                         if new.get(n) != old.get(n)}
+                for n in names:
+                    if n in new:
+                        old[n] = new[n]
+                    else:
+                        del old[n]
+                if names:
+                    changed[k] = names
+            elif k == 'cells' and old and len(old) == len(new):
+                diff = [i for i, (a, b) in enumerate(zip(old, new)) if a != b]
+                for i in diff:
+                    old[i] = new[i]
+                if diff:
+                    changed[k] = True
+            elif new != old:
+                setattr(self, k, new)
+                changed[k] = True
+        return changed
+
     def tick(self, dt) -> Optional[Effect]:
         if not self.running:
             return
 
         effect = []
         state = {}
-        now = time.time()
+        now = self.clock()
 
-        new_coll_time = random.randint(NEW_COLL, NEW_COLL + 15)
-        if int(now - self._last_coll) > new_coll_time:
-            self.add_collectible(self.random_collectible())
-            self._last_coll = now
-            state.update(self.dump('collectibles'))
+        with self.tracer.span('spawn'):
+            new_coll_time = self.random.randint(NEW_COLL, NEW_COLL + 15)
+            if int(now - self._last_coll) > new_coll_time:
+                coll = self.random_collectible()
+                self.add_collectible(coll)
+                self.stats['spawned' + coll.kind] += 1
+                self._last_coll = now
+                state.update(self.dump('collectibles'))
 
         def touch_flame(o):
             return any(collides(f.rect, o.rect)
@@ -324,42 +396,56 @@ class GameState:
         def should_explode(b):
             return touch_flame(b) or now - b.birth >= b.ttl
 
-        exploding_bombs, living_bombs = split_list(self.bombs, should_explode)
-
-        # Make bombs explode
-        broken_walls = []
-        if exploding_bombs:
-            for b in exploding_bombs:
-                flames, broken = self.generate_flames(b)
-                self.flames += flames
-                broken_walls += broken
-
-            if self.break_walls(broken_walls):
-                state.update(self.dump('cells', 'collectibles'))
-
-            self.bombs = living_bombs
-            state.update(self.dump('bombs'))
-            state.update(self.dump('flames'))
+        with self.tracer.span('explosions'):
+            exploding_bombs, living_bombs = split_list(self.bombs,
+                                                       should_explode)
+
+            # Make bombs explode
+            broken_walls = {}  # index -> bomb owner
+            if exploding_bombs:
+                self.stats['explosions'] += len(exploding_bombs)
+                for b in exploding_bombs:
+                    flames, broken = self.generate_flames(b)
+                    self.flames += flames
+                    for w in broken:
+                        broken_walls.setdefault(w, b.player)
+                for w, owner in broken_walls.items():
+                    if is_breakable(self.cells[w]):
+                        self.player_stats[owner]['walls_broken'] += 1
+
+                with self.tracer.span('break_walls'):
+                    if self.break_walls(broken_walls):
+                        state.update(self.dump('cells', 'collectibles'))
+
+                self.bombs = living_bombs
+                state.update(self.dump('bombs'))
+                state.update(self.dump('flames'))
 
         # check dead people
-        for pname, player in self.players.items():
-            if touch_flame(player):
-                self.players[pname] = player._replace(alive=False)
-                state.update(self.dump('players'))
-            # ah, and pick collectibles
-            for coll in list(self.collectibles):
-                if collides(player.rect, coll.rect):
-                    self.collectibles.remove(coll)
-                    fn = COLLECTIBLES[coll.kind]
-                    self.players[pname] = fn(player)
-                    state.update(self.dump('collectibles'))
+        with self.tracer.span('deaths'):
+            for pname, player in self.players.items():
+                if touch_flame(player):
+                    if player.alive:
+                        self.deaths[pname] = now
+                    self.players[pname] = player._replace(alive=False)
+                    state.update(self.dump('players'))
+                # ah, and pick collectibles
+                for coll in list(self.collectibles):
+                    if collides(player.rect, coll.rect):
+                        self.collectibles.remove(coll)
+                        fn = COLLECTIBLES[coll.kind]
+                        self.players[pname] = fn(player)
+                        self.stats['pickup' + coll.kind] += 1
+                        self.player_stats[pname]['pickups'] += 1
+                        state.update(self.dump('collectibles'))
 
         # clean old flames
-        n_flames = len(self.flames)
-        self.flames = [f for f in self.flames
-                       if now - f.birth < FLAME_TTL]
-        if n_flames != len(self.flames):
-            state.update(self.dump('flames'))
+        with self.tracer.span('flames'):
+            n_flames = len(self.flames)
+            self.flames = [f for f in self.flames
+                           if now - f.birth < FLAME_TTL]
+            if n_flames != len(self.flames):
+                state.update(self.dump('flames'))
 
         survivors = [name for name, p in self.players.items() if p.alive]
         nb_survivors = len(survivors)
@@ -385,32 +471,29 @@ class GameState:
         if not p.alive:
             return
 
-        x, y = p.pos
-
-        def _move(dx, dy):
-            # are we moving out a new bomb ?
-            for walkable in list(self._can_walk[player_name]):
-                obj = self.object_by_id(walkable)
-                if not obj or not collides(obj.rect, p.rect):
-                    self._can_walk[player_name].discard(walkable)
-
-            # only move if not resluting in a wall
-            np = p._replace(pos=(dx+x, dy+y))
-            if not any(collides(wr.rect, np.rect)
-                       for wr in self.obstacles(player_name)):
-                return dx + x, dy + y
-
-            return x, y
+        # are we moving out a new bomb ?
+        for walkable in list(self._can_walk[player_name]):
+            obj = self.object_by_id(walkable)
+            if not obj or not collides(obj.rect, p.rect):
+                self._can_walk[player_name].discard(walkable)
+        obstacles = [o.rect for o in self.obstacles(player_name)]
 
         s = p.speed * dt
+        dx = dy = 0
         if Direction.UP in direction:
-            x, y = _move(0, s)
+            dy += s
         if Direction.RIGHT in direction:
-            x, y = _move(s, 0)
+            dx += s
         if Direction.DOWN in direction:
-            x, y = _move(0, -s)
+            dy -= s
         if Direction.LEFT in direction:
-            x, y = _move(-s, 0)
+            dx -= s
+
+        # one axis after the other: blocked on one, the player slides along
+        # the obstacle on the other
+        x, y = p.pos
+        y += sweep(p.rect, dy, 1, obstacles)
+        x += sweep(p._replace(pos=(x, y)).rect, dx, 0, obstacles)
 
         p = p._replace(direction=direction.value,
                        moving_time=p.moving_time+dt)
@@ -444,9 +527,9 @@ class GameState:
         x, y = self.cell_center(cell)
         x -= BSIZE[0] // 2
         y -= BSIZE[1] // 2
-        now = time.time()
+        now = self.clock()
         radius = player.bomb_radius
-        bomb = Bomb(uid(), player_name, (x, y), now, radius)
+        bomb = Bomb(self.uid(), player_name, (x, y), now, radius)
 
         # allow players on bomb to move away from it
         on_bomb_players = [pname for pname, p in self.players.items()
@@ -455,6 +538,8 @@ class GameState:
             self._can_walk[pname].add(bomb.id)
 
         self.bombs.append(bomb)
+        self.stats['bombs'] += 1
+        self.player_stats[player_name]['bombs'] += 1
 
         return [{'code': 'update',
                  'state': self.dump('bombs')}]
@@ -465,8 +550,10 @@ class GameState:
             c = self.cells[w]
             if is_breakable(c):
                 self.cells[w] = '0'
-                kind = random.choice('000~0+0+0!0!000')
+                self.stats['walls_broken'] += 1
+                kind = self.random.choice('000~0+0+0!0!000')
                 if kind != '0':
+                    self.stats['drop' + kind] += 1
                     coll = self.create_collectible(w, kind)
                     self.add_collectible(coll)
                 effect = True
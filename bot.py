@@ -0,0 +1,378 @@
+""" Server side AI players.
+
+Bots only talk to the game through `bomb.action`, like remote players do.
+Path finding runs on flood-fill distance fields over `GameState.cells`,
+which are only recomputed when walls or bombs change, and the danger map is
+updated bomb by bomb rather than rebuilt every tick.
+"""
+import random
+import time
+from collections import deque, defaultdict
+
+from bomb import (GameState, Direction, CELL_SIZE, BOMB_TTL, action,
+                  is_wall, is_breakable)
+from stats import percentile
+
+# Seconds between two decisions, steering still happens every tick
+THINK_EVERY = 0.1
+# Pixels of tolerance when aligning on a cell, or half a tick's move if
+# that's more
+ALIGN = 1
+# Where to stand in a cell: the player rect has 2px of room on both sides
+# but none below, so aim slightly up
+AIM = 0, 2
+
+NEIGHBOURS = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+
+
+def blast_cells(gs: GameState, cell, radius):
+    """ Cells a bomb will set on fire, same rules as `generate_flames` """
+    cells = [gs.cell_idx(cell)]
+    for dx, dy in NEIGHBOURS:
+        c = cell
+        for r in range(radius):
+            c = c[0] + dx, c[1] + dy
+            idx = gs.cell_idx(c)
+            if not (0 <= idx < gs.width * gs.height):
+                break
+            if is_wall(gs.cells[idx]):
+                cells.append(idx)
+                break
+            cells.append(idx)
+    return cells
+
+
+class DangerMap:
+    """ When each cell is going to burn, updated as bombs come and go """
+
+    def __init__(self, gs: GameState):
+        self.gs = gs
+        self.reset()
+
+    def reset(self):
+        self.blasts = {}  # bomb id -> (explode time, cell indices)
+        self.by_cell = defaultdict(set)  # cell index -> bomb ids
+        self.danger = {}  # cell index -> earliest explode time
+        self.burning = set()
+        self.blocked = frozenset()
+        self.bonuses = set()
+        self._walls = getattr(self.gs, '_walls', None)
+
+    def update(self):
+        gs = self.gs
+        if gs._walls is not self._walls:
+            # broken walls open blast lines, start over
+            self.reset()
+
+        bombs = {b.id: b for b in gs.bombs}
+        for bid in [bid for bid in self.blasts if bid not in bombs]:
+            self._remove(bid)
+        for bid, b in bombs.items():
+            if bid not in self.blasts:
+                self._add(b)
+
+        # shared by all bots for this tick
+        self.burning = {gs.cell_idx(gs.cell_from_coords(f.pos))
+                        for f in gs.flames}
+        self.blocked = frozenset(
+            gs.cell_idx(gs.cell_from_coords(b.pos)) for b in gs.bombs
+        ) | self.burning
+        # the collectibles themselves: cells keep the symbol of picked up
+        # ones, and of spawn spots which were tried and rejected
+        self.bonuses = {gs.cell_idx(gs.cell_from_coords(
+            (c.pos[0] + CELL_SIZE/2, c.pos[1] + CELL_SIZE/2)))
+            for c in gs.collectibles}
+
+    def _add(self, bomb):
+        gs = self.gs
+        cell = tuple(map(int, gs.cell_from_coords(bomb.pos)))
+        idx = gs.cell_idx(cell)
+        # a bomb sitting in an earlier blast goes off with it
+        at = min(bomb.birth + bomb.ttl, self.danger.get(idx, float('inf')))
+        cells = blast_cells(gs, cell, bomb.radius)
+        self.blasts[bomb.id] = (at, cells)
+        self._burn(bomb.id, at, cells)
+
+    def _burn(self, bid, at, cells):
+        for idx in cells:
+            self.by_cell[idx].add(bid)
+            if at < self.danger.get(idx, float('inf')):
+                self.danger[idx] = at
+                self._chain(idx, at)
+
+    def _chain(self, idx, at):
+        for other in list(self.by_cell[idx]):
+            other_at, other_cells = self.blasts[other]
+            # first cell of a blast is the bomb itself
+            if other_at > at and other_cells[0] == idx:
+                self.blasts[other] = (at, other_cells)
+                self._burn(other, at, other_cells)
+
+    def _remove(self, bid):
+        _, cells = self.blasts.pop(bid)
+        for idx in cells:
+            self.by_cell[idx].discard(bid)
+            times = [self.blasts[b][0] for b in self.by_cell[idx]]
+            if times:
+                self.danger[idx] = min(times)
+            else:
+                self.danger.pop(idx, None)
+
+
+class DistanceField:
+    """ BFS distances and parents from one cell over walkable cells """
+
+    def __init__(self, gs: GameState, start, blocked):
+        self.start = start
+        self.dist = {start: 0}
+        self.parent = {}
+        queue = deque([start])
+        while queue:
+            idx = queue.popleft()
+            i, j = gs.cell_from_idx(idx)
+            for dx, dy in NEIGHBOURS:
+                if not (0 <= i + dx < gs.width and 0 <= j + dy < gs.height):
+                    continue
+                n = gs.cell_idx((i + dx, j + dy))
+                if n in self.dist or is_wall(gs.cells[n]) or n in blocked:
+                    continue
+                self.dist[n] = self.dist[idx] + 1
+                self.parent[n] = idx
+                queue.append(n)
+
+    def first_step(self, target):
+        """ Next cell to walk to in order to reach target """
+        if target == self.start or target not in self.dist:
+            return None
+        while self.parent[target] != self.start:
+            target = self.parent[target]
+        return target
+
+    def nearest(self, pred):
+        # cells were added in BFS order, the first match is the nearest
+        return next((idx for idx in self.dist if pred(idx)), None)
+
+
+class Bot:
+    def __init__(self, name, gs: GameState, danger: DangerMap, rng=None):
+        self.name = name
+        self.gs = gs
+        self.danger = danger
+        self.rng = rng or random.Random()
+        self.target = None
+        self.next_think = 0
+        self.last_now = None
+        self.align = ALIGN
+        self._field = None
+        self._field_key = None
+        self._field_walls = None
+        self._moving = False
+
+    @property
+    def player(self):
+        return self.gs.players.get(self.name)
+
+    def cell(self, player):
+        x, y = player.pos
+        # same reference point as `drop_bomb`
+        return self.gs.cell_idx(self.gs.cell_from_coords(
+            (x + CELL_SIZE/2, y + CELL_SIZE/2)))
+
+    def occupied(self, player):
+        """ Every cell the player rect overlaps """
+        x, y, w, h = player.rect
+        gs = self.gs
+        return {gs.cell_idx((i, j))
+                for i in {int(x // CELL_SIZE), int((x + w) // CELL_SIZE)}
+                for j in {int(y // CELL_SIZE), int((y + h) // CELL_SIZE)}}
+
+    def field(self, start):
+        gs = self.gs
+        blocked = self.danger.blocked
+        key = (start, blocked)
+        if key != self._field_key or gs._walls is not self._field_walls:
+            self._field = DistanceField(gs, start, blocked - {start})
+            self._field_key = key
+            self._field_walls = gs._walls
+        return self._field
+
+    def think(self, now):
+        """ Messages this bot sends this tick """
+        p = self.player
+        if not p or not p.alive or not self.gs.running:
+            return []
+
+        msgs = []
+        if self.last_now is not None:
+            # at low tick rates a move can be longer than the tolerance,
+            # and the bot would oscillate around the cell center
+            self.align = max(ALIGN, p.speed * (now - self.last_now) / 2)
+        self.last_now = now
+        here = self.cell(p)
+        if now >= self.next_think or self.target is None:
+            self.next_think = now + THINK_EVERY
+            msgs += self.decide(here)
+        msgs += self.steer(p, here)
+        return msgs
+
+    def is_safe(self, idx, burning):
+        # a cell in any pending blast is no place to stop, however long the
+        # fuse: bots otherwise wander back into dead ends next to their bomb
+        return idx not in burning and idx not in self.danger.danger
+
+    def decide(self, here):
+        gs = self.gs
+        field = self.field(here)
+        burning = self.danger.burning
+        msgs = []
+        enemies = {self.cell(p) for n, p in gs.players.items()
+                   if n != self.name and p.alive}
+
+        if not all(self.is_safe(i, burning)
+                   for i in self.occupied(self.player)):
+            self.target = field.nearest(
+                lambda i: self.is_safe(i, burning))
+            return msgs
+
+        if self.worth_bombing(here, enemies) and \
+                self.can_escape(field, here, burning):
+            msgs.append({'code': 'drop_bomb'})
+            self.target = field.nearest(
+                lambda i: i != here and self.is_safe(i, burning)
+                and i not in blast_cells(gs, gs.cell_from_idx(here),
+                                         self.player.bomb_radius))
+            return msgs
+
+        def interesting(i):
+            if not self.is_safe(i, burning):
+                return False
+            if i in self.danger.bonuses:
+                return True
+            return i != here and self.worth_bombing(i, enemies)
+        self.target = field.nearest(interesting)
+        if self.target is None:
+            # nothing to do, wander around
+            safe = [i for i in field.dist if self.is_safe(i, burning)]
+            self.target = self.rng.choice(safe) if safe else None
+        return msgs
+
+    def worth_bombing(self, idx, enemies):
+        gs = self.gs
+        i, j = gs.cell_from_idx(idx)
+        if any(is_breakable(gs.cells[gs.cell_idx((i + dx, j + dy))])
+               for dx, dy in NEIGHBOURS
+               if 0 <= i + dx < gs.width and 0 <= j + dy < gs.height):
+            return True
+        p = self.player
+        return bool(enemies & set(blast_cells(gs, (i, j), p.bomb_radius)))
+
+    def can_escape(self, field, here, burning):
+        p = self.player
+        if p.bomb_limit <= sum(b.player == self.name for b in self.gs.bombs):
+            return False
+        blast = set(blast_cells(self.gs, self.gs.cell_from_idx(here),
+                                p.bomb_radius))
+        # distance to safety must be walkable before the fuse ends
+        cells_per_second = p.speed / CELL_SIZE
+        escape = field.nearest(
+            lambda i: i not in blast and self.is_safe(i, burning))
+        return escape is not None and \
+            field.dist[escape] / cells_per_second < 0.8 * BOMB_TTL
+
+    def steer(self, p, here):
+        gs = self.gs
+        if self.target is None:
+            return self.stop(p)
+
+        if self.target == here:
+            # stand in the middle of the cell, not across two cells
+            step = here
+        else:
+            step = self.field(here).first_step(self.target)
+            if step is None:
+                self.target = None
+                return self.stop(p)
+
+        tx, ty = gs.cell_coords(gs.cell_from_idx(step))
+        x, y = p.pos
+        dx, dy = tx + AIM[0] - x, ty + AIM[1] - y
+        d = Direction(0)
+        if dy > self.align:
+            d |= Direction.UP
+        elif dy < -self.align:
+            d |= Direction.DOWN
+        if dx > self.align:
+            d |= Direction.RIGHT
+        elif dx < -self.align:
+            d |= Direction.LEFT
+        if not d:
+            return self.stop(p)
+        self._moving = True
+        return [{'code': 'move', 'dir': d.value}]
+
+    def stop(self, p):
+        if self._moving:
+            self._moving = False
+            return [{'code': 'stop'}]
+        return []
+
+
+class Bots:
+    """ All the bots of a game, plus their timing statistics """
+
+    def __init__(self, gs: GameState, seed=None):
+        self.gs = gs
+        self.rng = random.Random(seed)
+        self.danger = DangerMap(gs)
+        self.bots = {}
+        self.think_times = deque(maxlen=600)
+        self.think_max = 0
+
+    def __len__(self):
+        return len(self.bots)
+
+    def __contains__(self, name):
+        return name in self.bots
+
+    def __iter__(self):
+        return iter(self.bots)
+
+    def add(self, name):
+        self.bots[name] = Bot(name, self.gs, self.danger,
+                              random.Random(self.rng.random()))
+
+    def set_game(self, gs: GameState):
+        self.gs = gs
+        self.danger = DangerMap(gs)
+        for b in self.bots.values():
+            b.gs, b.danger = gs, self.danger
+            b.target, b._field_key = None, None
+
+    def messages(self, now):
+        """ (player name, message) wanted by every bot for this tick """
+        if not self.bots or not self.gs.running:
+            return []
+        self.danger.update()
+        messages = []
+        for name, bot in self.bots.items():
+            t0 = time.perf_counter()
+            messages += [(name, msg) for msg in bot.think(now)]
+            spent = time.perf_counter() - t0
+            self.think_times.append(spent)
+            self.think_max = max(self.think_max, spent)
+        return messages
+
+    def actions(self, now):
+        """ Actions wanted by every bot for this tick """
+        actions = [action(self.gs, name, msg)
+                   for name, msg in self.messages(now)]
+        return [a for a in actions if a]
+
+    def dump_stats(self):
+        times = self.think_times
+        return {
+            'count': len(self.bots),
+            'think_mean': sum(times) / len(times) if times else 0,
+            'think_p99': percentile(times, 0.99),
+            'think_max': self.think_max,
+        }
@@ -1,28 +1,38 @@
+import time
+STARTED = time.perf_counter()  # noqa, for the time to first frame
+
+import argparse
 import asyncio
 import json
 import pyglet
-import time
+from collections import deque
 from pyglet.window import key
 from pyglet.gl import *  # noqa
 
 from bomb import GameState, Coords, Direction, is_wall, is_breakable
-import server
+from reliable import ReliableChannel, CLIENT_CRITICAL, RESEND_EVERY
+from snapshot import Reassembler, unpack
+from lockstep import Lockstep, HASH_EVERY
+from sessions import RESUME_WINDOW
+from stats import percentile
 
 DEFAULT_PORT = 1888
+# Spectators tell the server/relay they are still watching that often
+WATCHING_EVERY = 2
+# Nothing from the server for that long (it pings every second): the link
+# is down, resume the session from a new socket
+LINK_TIMEOUT = 2
+RESUME_EVERY = 0.25
 FONT_FILE = 'neoletters.ttf'
 FONT_NAME = 'Neoletters'
 BOARD_SCALE = 2
 
 RES = dict()
+# SPRITES names to a texture region, or a tuple of animation frames
+TEXTURES = dict()
 POLL = 0.0001
 CELL_SIZE = 16
 
-GRID = pyglet.image.TextureGrid(
-    pyglet.image.ImageGrid(pyglet.resource.image('img/sprites.png'),
-                           rows=8,
-                           columns=16)
-)
-
 SPRITES = {
     'a_front': slice((7, 0), (8, 4)),
     'a_left': slice((7, 4), (8, 8)),
@@ -62,25 +72,39 @@ SPRITES = {
 }
 
 
-class PixSprite(pyglet.sprite.Sprite):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-        glTexParameteri(self._texture.target, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
-        glTexParameteri(self._texture.target, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+def load_assets():
+    """ Load images once the window (and its GL context) exists """
+    RES.update({
+        'logo': pyglet.resource.image('img/logo.png'),
+        'hud': pyglet.resource.image('img/player_hud.png'),
+    })
+    grid = pyglet.image.TextureGrid(
+        pyglet.image.ImageGrid(pyglet.resource.image('img/sprites.png'),
+                               rows=8,
+                               columns=16)
+    )
+    # every sprite is a region of the same texture, filter it once
+    glBindTexture(grid.target, grid.id)  # noqa
+    glTexParameteri(grid.target, GL_TEXTURE_MAG_FILTER, GL_NEAREST)  # noqa
+    glTexParameteri(grid.target, GL_TEXTURE_MIN_FILTER, GL_NEAREST)  # noqa
+    for name, region in SPRITES.items():
+        tex = grid[region]
+        TEXTURES[name] = tuple(tex) if isinstance(tex, list) else tex
 
 
-def sprite(coords: Coords, res_name, batch=None, scale=None, idx=None):
+def sprite(coords: Coords, res_name, batch=None, scale=None, idx=None,
+           group=None):
     x, y = coords
-    tex = GRID[SPRITES[res_name]]
+    tex = TEXTURES[res_name]
 
     if idx is not None:
         tex = tex[idx]
 
-    sp = PixSprite(
+    sp = pyglet.sprite.Sprite(
         tex,
         x=x, y=y,
         batch=batch,
+        group=group,
     )
     if scale:
         sp.scale = scale
@@ -93,6 +117,22 @@ def label(coords: Coords, text: str, **kw):
         x=x, y=y, text=text, font_name=FONT_NAME, **kw)
 
 
+def player_frame(p):
+    """ Sprite name and animation frame of a player """
+    direction = Direction(p.direction)
+    if Direction.DOWN in direction:
+        d = 'front'
+    elif Direction.LEFT in direction:
+        d = 'left'
+    elif Direction.RIGHT in direction:
+        d = 'right'
+    elif Direction.UP in direction:
+        d = 'back'
+
+    start_time = p.moving_time and 1+p.moving_time
+    return f"{p.pid}_{d}", int(start_time / 0.2 % 4)
+
+
 class GameView:
     def __init__(self, offset_x, offset_y):
         self.walls = pyglet.graphics.Batch()
@@ -101,6 +141,12 @@ class GameView:
         self.off_x, self.off_y, = offset_x, offset_y
         self.death_timers = {}
         self.force_update = 0
+        # sprites by key, so an update only touches what it changed
+        self._walls = {}
+        self._bonuses = {}
+        self._flames = {}
+        self._bombs = {}
+        self._players = {}
 
     def update_all(self, gs: GameState):
         self.update_walls(gs)
@@ -109,69 +155,70 @@ class GameView:
         self.update_flames(gs)
         self.update_bonuses(gs)
 
+    @staticmethod
+    def sync(sprites, wanted, batch):
+        """ Make sprites match wanted {key: (coords, res_name)} """
+        for k in sprites.keys() - wanted.keys():
+            sprites.pop(k).delete()
+        for k, (coords, res_name) in wanted.items():
+            if k not in sprites:
+                sprites[k] = sprite(coords, res_name, batch)
+
     def update_walls(self, gs: GameState):
-        self._walls = [
-            sprite(gs.cell_coords(gs.cell_from_idx(i)),
-                   'wall_b' if is_breakable(v) else 'wall',
-                   self.walls)
-            for i, v in enumerate(gs.cells)
-            if is_wall(v)
-        ]
-        self._walls += [
-            sprite(gs.cell_coords(gs.cell_from_idx(i)),
-                   'floor',
-                   self.walls)
-            for i, v in enumerate(gs.cells)
-            if not is_wall(v)
-        ]
+        wanted = {}
+        for i, v in enumerate(gs.cells):
+            if is_wall(v):
+                res_name = 'wall_b' if is_breakable(v) else 'wall'
+            else:
+                res_name = 'floor'
+            coords = gs.cell_coords(gs.cell_from_idx(i))
+            wanted[i, res_name] = coords, res_name
+        self.sync(self._walls, wanted, self.walls)
 
     def update_bonuses(self, gs):
-        self._bonuses = [
-            sprite(c.pos, c.kind, self.effects)
+        self.sync(self._bonuses, {
+            (c.kind, tuple(c.pos)): (c.pos, c.kind)
             for c in gs.collectibles
-        ]
+        }, self.effects)
 
     def update_flames(self, gs: GameState):
-        self._flames = [
-            sprite(f.pos, f'flame_{f.kind}', self.effects)
+        self.sync(self._flames, {
+            (tuple(f.pos), f.kind, f.birth): (f.pos, f'flame_{f.kind}')
             for f in gs.flames
-        ]
+        }, self.effects)
 
     def update_players(self, gs: GameState):
-        def _sprite(p):
-            direction = Direction(p.direction)
-            if Direction.DOWN in direction:
-                d = 'front'
-            elif Direction.LEFT in direction:
-                d = 'left'
-            elif Direction.RIGHT in direction:
-                d = 'right'
-            elif Direction.UP in direction:
-                d = 'back'
-
-            res = f"{p.pid}_{d}"
-
-            start_time = p.moving_time and 1+p.moving_time
-            idx = int(start_time / 0.2 % 4)
-            return sprite(p.pos, res, self.players, idx=idx)
-
         now = time.time()
-        self._players = []
+        for name in self._players.keys() - gs.players.keys():
+            self._players.pop(name).delete()
 
         for name, p in gs.players.items():
             if name not in self.death_timers and not p.alive:
                 self.death_timers[name] = now
                 self.force_update = now + 2
 
-            if ((name not in self.death_timers)
-                    or (now - self.death_timers[name] < 2)):
-                self._players.append(_sprite(p))
+            if name in self.death_timers \
+                    and now - self.death_timers[name] >= 2:
+                if name in self._players:
+                    self._players.pop(name).delete()
+                continue
+
+            res_name, idx = player_frame(p)
+            sp = self._players.get(name)
+            if sp is None:
+                self._players[name] = sprite(p.pos, res_name, self.players,
+                                             idx=idx)
+                continue
+            tex = TEXTURES[res_name][idx]
+            if sp.image is not tex:
+                sp.image = tex
+            if sp.position != tuple(p.pos):
+                sp.position = tuple(p.pos)
 
     def update_bombs(self, gs: GameState):
-        self._bombs = [
-            sprite(b.pos, 'bomb', self.players)
-            for b in gs.bombs
-        ]
+        self.sync(self._bombs, {
+            b.id: (b.pos, 'bomb') for b in gs.bombs
+        }, self.players)
 
     def draw(self):
         pyglet.gl.glPushMatrix()
@@ -184,80 +231,117 @@ class GameView:
         pyglet.gl.glPopMatrix()
 
 
-def player_hud(pname, player, x, y, anchor_x, anchor_y):
-    avatar_x = x + 5 if anchor_x == 'left' else x - 70
-    label_x = x + 80 if anchor_x == 'left' else x - 80
-    bomb_x = label_x if anchor_x == 'left' else label_x - 95
-    bonus_x = bomb_x if anchor_x == 'left' else avatar_x - 20
-
-    avatar_y = y - 70 if anchor_y == 'top' else y + 2
-    label_y = y-5 if anchor_y == 'top' else y + 52
-    bomb_y = y - 45 if anchor_y == 'top' else y + 25
-    bonus_y = bomb_y - 20
-
-    avatar = sprite((avatar_x, avatar_y), f"avatar_{player.pid}", scale=4)
-    extra = [sprite((avatar_x, avatar_y), 'cross', scale=4)] \
-        if not player.alive else []
-    color = (192, 192, 192, 255)
-    name = label((label_x, label_y),
-                 pname,
-                 anchor_x=anchor_x,
-                 anchor_y=anchor_y,
-                 font_size=15,
-                 color=color)
-
-    items = [sprite((bomb_x, bomb_y), 'bomb'),
-             label((bomb_x + 20, bomb_y+2),
-                   f'x{player.bomb_limit}',
-                   font_size=10,
-                   color=color)]
-    items += [sprite((bomb_x + 55, bomb_y), 'flame'),
-              label((bomb_x + 75, bomb_y+2),
-                    f'x{player.bomb_radius}',
-                    font_size=10,
-                    color=color)]
-
-    if player.speed_boots:
-        items += [sprite((bonus_x, bonus_y), '~')]
-
-    return [name, avatar, *(extra+items)]
+class PlayerHUD:
+    """ One player's corner of the HUD, built once and patched on change """
+
+    def __init__(self, pname, player, x, y, anchor_x, anchor_y, batch,
+                 group):
+        avatar_x = x + 5 if anchor_x == 'left' else x - 70
+        label_x = x + 80 if anchor_x == 'left' else x - 80
+        bomb_x = label_x if anchor_x == 'left' else label_x - 95
+        bonus_x = bomb_x if anchor_x == 'left' else avatar_x - 20
+
+        avatar_y = y - 70 if anchor_y == 'top' else y + 2
+        label_y = y-5 if anchor_y == 'top' else y + 52
+        bomb_y = y - 45 if anchor_y == 'top' else y + 25
+        bonus_y = bomb_y - 20
+
+        color = (192, 192, 192, 255)
+        kw = dict(batch=batch, group=group)
+        self.avatar = sprite((avatar_x, avatar_y), f"avatar_{player.pid}",
+                             scale=4, **kw)
+        self.cross = sprite((avatar_x, avatar_y), 'cross', scale=4, **kw)
+        self.name = label((label_x, label_y),
+                          pname,
+                          anchor_x=anchor_x,
+                          anchor_y=anchor_y,
+                          font_size=15,
+                          color=color, **kw)
+        self.bomb = sprite((bomb_x, bomb_y), 'bomb', **kw)
+        self.bomb_limit = label((bomb_x + 20, bomb_y+2), '',
+                                font_size=10, color=color, **kw)
+        self.flame = sprite((bomb_x + 55, bomb_y), 'flame', **kw)
+        self.bomb_radius = label((bomb_x + 75, bomb_y+2), '',
+                                 font_size=10, color=color, **kw)
+        self.boots = sprite((bonus_x, bonus_y), '~', **kw)
+        self.shown = None
+        self.update(player)
+
+    @property
+    def sprites(self):
+        return [self.avatar, self.cross, self.bomb, self.flame, self.boots]
+
+    def delete(self):
+        for s in [*self.sprites, self.name, self.bomb_limit,
+                  self.bomb_radius]:
+            s.delete()
+
+    def update(self, player):
+        shown = (player.alive, player.bomb_limit, player.bomb_radius,
+                 player.speed_boots)
+        if shown == self.shown:
+            return
+        self.shown = shown
+        # setting a label's text lays it out again, only do it on change
+        if self.bomb_limit.text != f'x{player.bomb_limit}':
+            self.bomb_limit.text = f'x{player.bomb_limit}'
+        if self.bomb_radius.text != f'x{player.bomb_radius}':
+            self.bomb_radius.text = f'x{player.bomb_radius}'
+        self.cross.visible = not player.alive
+        self.boots.visible = player.speed_boots
 
 
 class HUD:
+    HEIGHT = 85
+
     def __init__(self, window):
         self.window = window
+        self.batch = pyglet.graphics.Batch()
+        self.background = pyglet.graphics.OrderedGroup(0)
+        self.foreground = pyglet.graphics.OrderedGroup(1)
         self.player_anchors = [
             (5, window.height - 5, 'left', 'top'),
             (window.width-5, window.height-5, 'right', 'top'),
             (5, 5, 'left', 'bottom'),
             (window.width-5, 5, 'right', 'bottom'),
         ]
+        self._players = {}  # name -> (corner, PlayerHUD)
+        self._top = self.add_background(window.height)
+        self._bottom = None  # only once a bottom corner is taken
+
+    def add_background(self, y):
+        w, h = self.window.width, self.HEIGHT
+        return self.batch.add(
+            4, pyglet.gl.GL_QUADS, self.background,
+            ('v2i', (0, y, w, y, w, y-h, 0, y-h)),
+            ('c4B', (20, 20, 20, 255)*4),
+        )
 
     def update(self, gs: GameState):
-        self._players = []
-        for i, (pname, p) in enumerate(gs.players.items()):
-            self._players += player_hud(
-                pname, p,
-                x=self.player_anchors[i][0],
-                y=self.player_anchors[i][1],
-                anchor_x=self.player_anchors[i][2],
-                anchor_y=self.player_anchors[i][3],
-            )
+        for pname in [n for n in self._players if n not in gs.players]:
+            # left the game, its corner is free again
+            self._players.pop(pname)[1].delete()
+        for pname, p in gs.players.items():
+            if pname in self._players:
+                self._players[pname][1].update(p)
+                continue
+            taken = {corner for corner, _ in self._players.values()}
+            free = [i for i in range(len(self.player_anchors))
+                    if i not in taken]
+            if not free:
+                continue
+            self._players[pname] = free[0], PlayerHUD(
+                pname, p, *self.player_anchors[free[0]],
+                batch=self.batch, group=self.foreground)
+        bottom = any(corner >= 2 for corner, _ in self._players.values())
+        if bottom and self._bottom is None:
+            self._bottom = self.add_background(self.HEIGHT)
+        elif not bottom and self._bottom is not None:
+            self._bottom.delete()
+            self._bottom = None
 
     def draw(self):
-        H = 85
-        w, h = self.window.width, H
-        bgs = [(0, self.window.height)]
-        if len(self._players) > 2:
-            bgs.append((0, H))
-        for x, y in bgs:
-            pyglet.graphics.draw(
-                4, pyglet.gl.GL_QUADS,
-                ('v2i', (x, y, x+w, y, x+w, y-h, x, y-h)),
-                ('c4B', (20,20,20, 255)*4),
-            )
-        for e in self._players:
-            e.draw()
+        self.batch.draw()
 
 
 class GameScreen:
@@ -278,10 +362,23 @@ class GameScreen:
     def force_update(self):
         return self.gv.force_update
 
+    def batches(self):
+        """ (name, batch, sprite counter) of every batch, for PerfOverlay """
+        gv, hud = self.gv, self.hud
+        return [
+            ('walls', gv.walls, lambda: len(gv._walls)),
+            ('effects', gv.effects,
+             lambda: len(gv._bonuses) + len(gv._flames)),
+            ('players', gv.players,
+             lambda: len(gv._bombs) + len(gv._players)),
+            ('hud', hud.batch,
+             lambda: sum(len(p.sprites) for _, p in hud._players.values())),
+        ]
+
     def update(self, update, gs, force=False):
-        """ Update screen elements based on the state update received """
-        self.hud.update(gs)  # anyway
+        """ Update screen elements of the fields which changed """
         if force or 'players' in update:
+            self.hud.update(gs)
             self.gv.update_players(gs)
         if force or 'bombs' in update:
             self.gv.update_bombs(gs)
@@ -353,17 +450,126 @@ class Prompt:
         self.layout.draw()
 
 
+class PerfOverlay:
+    """ Client side timings, toggled with F3, optionally recorded """
+    FRAMES = 300  # frames the percentiles are computed over
+    REFRESH = 0.5
+
+    def __init__(self, window, record=None):
+        self.window = window
+        self.visible = False
+        self.frames = deque(maxlen=self.FRAMES)  # (interval, frame time)
+        self.batches = []  # (name, [draws, draw time], sprite counter)
+        self.updates = 0
+        self.net_time = 0
+        self.update_time = 0
+        self.last_refresh = time.perf_counter()
+        self.label = label((5, window.height - 90), "", font_size=9,
+                           anchor_y='top', multiline=True, width=300,
+                           color=(255, 255, 0, 255))
+        self.record = open(record, 'w') if record else None
+        if self.record:
+            self.record.write("t,interval_ms,frame_ms\n")
+
+    def toggle(self):
+        self.visible = not self.visible
+
+    def track(self, batches):
+        """ Count and time the draws of each batch, its draw is wrapped.
+
+        pyglet tells nothing of the GL calls one Batch.draw makes, so these
+        are batch draws, and the CPU time they take.
+        """
+        self.batches = []
+        for name, batch, sprites in batches:
+            drawn = [0, 0]
+
+            def draw(draw=batch.draw, drawn=drawn):
+                t0 = time.perf_counter()
+                draw()
+                drawn[0] += 1
+                drawn[1] += time.perf_counter() - t0
+            batch.draw = draw
+            self.batches.append((name, drawn, sprites))
+
+    def frame(self, interval, frame_time):
+        self.frames.append((interval, frame_time))
+        if self.record:
+            self.record.write(f"{time.perf_counter() - STARTED:.6f},"
+                              f"{interval * 1000:.3f},"
+                              f"{frame_time * 1000:.3f}\n")
+        now = time.perf_counter()
+        if self.visible and now - self.last_refresh > self.REFRESH:
+            self.refresh(now - self.last_refresh)
+            self.last_refresh = now
+
+    def refresh(self, elapsed):
+        intervals = [i for i, _ in self.frames]
+        times = [t for _, t in self.frames]
+        fps = len(intervals) / sum(intervals) if sum(intervals) else 0
+        lines = [
+            f"{fps:.0f} fps  frame ms p50 "
+            f"{percentile(times, 0.5) * 1000:.1f} "
+            f"p95 {percentile(times, 0.95) * 1000:.1f} "
+            f"p99 {percentile(times, 0.99) * 1000:.1f}",
+            f"{self.updates / elapsed:.0f} updates/s  "
+            f"net {self.net_time / elapsed * 1000:.1f} ms/s  "
+            f"apply {self.update_time / elapsed * 1000:.1f} ms/s",
+        ]
+        for name, drawn, sprites in self.batches:
+            lines.append(f"{name}: {sprites()} sprites  "
+                         f"{drawn[0] / elapsed:.0f} draws/s  "
+                         f"{drawn[1] / elapsed * 1000:.1f} ms/s")
+            drawn[:] = [0, 0]
+        self.label.text = '\n'.join(lines)
+        self.updates = 0
+        self.net_time = self.update_time = 0
+
+    def draw(self):
+        if self.visible:
+            self.label.draw()
+
+    def close(self):
+        if not self.record:
+            return
+        self.record.close()
+        times = [t for _, t in self.frames]
+        print(f"Frame times written to {self.record.name}, last "
+              f"{len(times)} frames: p50 "
+              f"{percentile(times, 0.5) * 1000:.1f} ms, p99 "
+              f"{percentile(times, 0.99) * 1000:.1f} ms")
+
+
 class Client:
-    def __init__(self, window):
+    def __init__(self, window, perf):
         self.loop = asyncio.get_event_loop()
+        self.perf = perf
         self.keys = key.KeyStateHandler()
         window.push_handlers(self.keys)
         self.pname = 'NoName'
+        self.spectating = False
+        self._last_watching = 0
+        self.sim = None  # lockstep games only
+        self._future_inputs = {}
+        self._last_resync = 0
+        # state received, and fields changed by the lockstep simulation,
+        # since the last frame
+        self._updates = {}
+        self._changed = {}
         self._moving = False
         self.window = window
         self.ready = False
         self.home = True
         self.transport = None
+        self.server = None
+        self.token = None  # to resume the session after a drop
+        self.tick = -1  # of the last update
+        self._last_heard = 0
+        self._resume_sent = None
+        self._resume_retry = 0
+        self._catching_up = None  # resumed, until the missed updates
+        self._missed = 0
+        self.fragments = Reassembler()
         self.connected = False
         self.ingame = False
         self.status_label = label(
@@ -403,45 +609,161 @@ class Client:
         return self
 
     def connection_made(self, transport):
+        if self.transport is None:
+            self.loop.create_task(self.resend_loop())
         self.transport = transport
-        self.send({'code': 'hi', 'name': self.pname})
+        self.channel = ReliableChannel(self.transport.sendto)
+        self._last_heard = time.time()
+        if self._resume_sent:
+            self.send_resume(time.time())
+        elif self.spectating:
+            self.send({'code': 'spectate'})
+        else:
+            self.send({'code': 'hi', 'name': self.pname})
+
+    async def resend_loop(self):
+        while self.transport:
+            self.channel.resend(time.time())
+            await asyncio.sleep(RESEND_EVERY)
 
     def datagram_received(self, data, addr):
+        t0 = time.perf_counter()
+        self._last_heard = time.time()
         data = json.loads(data.decode())
         code = data['code']
-        if code == 'welcome':
+        if code == 'ack':
+            self.channel.on_ack(data, time.time())
+        elif 'rseq' in data:
+            for msg in self.channel.receive(data):
+                self.handle(msg)
+        else:
+            self.handle(data)
+        self.perf.net_time += time.perf_counter() - t0
+
+    def handle(self, data):
+        data = unpack(data)
+        code = data['code']
+        if code == 'frag':
+            msg = self.fragments.add(data)
+            if msg:
+                self.handle(msg)
+        elif code == 'welcome':
             self.connected = True
+            self.token = data.get('token')
             self.message = None
+        elif code == 'resumed':
+            self._catching_up, self._resume_sent = self._resume_sent, None
+            self.message = None
+            self._missed = data['missed']
         elif code == 'ping':
             self.send(data)  # send back
         elif code == 'lobby':
             self.lobby_view.update(data['players'])
         elif code == 'fatal':
             self.message = data['text']
+            if self._resume_sent:
+                self.token = None  # expired, stop trying
+        elif code == 'redirect':
+            # from a matchmaker, the game is on another server
+            host = data['host'] \
+                or self.transport.get_extra_info('peername')[0]
+            self.message = f"Joining {host}:{data['port']}"
+            self.transport.close()
+            self.loop.create_task(self._client((host, data['port'])))
         elif code == 'update':
-            state = data['state']
-            self.game.load(state)
-            self.game_view.update(state, self.game)
+            if not self.ingame:
+                return  # game_start was lost or is still on its way
+            # applied once per frame, the latest value of each field wins
+            self._updates.update(data['state'])
+            self.perf.updates += 1
+            tick = data.get('tick')
+            if tick is None:
+                return  # from an older server or relay, no catch up then
+            if self._catching_up and tick > self.tick:
+                print(f"Resumed, {self._missed} ticks caught up in "
+                      f"{(time.time() - self._catching_up) * 1000:.0f} ms")
+                self._catching_up = None
+            self.tick = max(self.tick, tick)
         elif code == 'pid':  # propably useless, will see
             self.pid = data['pid']
         elif code == 'game_start':
-            self.game = GameState()
-            self.game.load(data['state'])
+            if 'sim' in data:
+                self.start_sim(data['sim'])
+            else:
+                self.sim = None
+                self.game = GameState()
+                self.game.load(data['state'])
+            self._updates, self._changed = {}, {}
             self.game_view = GameScreen(self.window, self.game)
+            self.perf.track(self.game_view.batches())
             self.ingame = True
             print(data)
+        elif code == 'snapshot':
+            if self.ingame:
+                self.start_sim(data['sim'])
+                self._updates, self._changed = {}, {}
+                self.game_view.update({}, self.game, force=True)
+        elif code == 'inputs':
+            if self.ingame and self.sim:
+                self.apply_inputs(data)
+                self.perf.updates += 1
+
+    def start_sim(self, snapshot):
+        self.sim = Lockstep.restore(snapshot)
+        self.game = self.sim.gs
+        self._future_inputs = {t: i for t, i in self._future_inputs.items()
+                               if t > self.sim.tick}
+
+    def apply_inputs(self, data):
+        """ Lockstep: run every tick we now have the inputs for """
+        for tick, inputs in data['in']:
+            if tick > self.sim.tick:
+                self._future_inputs[tick] = inputs
+
+        while self.sim.tick + 1 in self._future_inputs:
+            inputs = self._future_inputs.pop(self.sim.tick + 1)
+            for e in self.sim.step(inputs):
+                if e['code'] == 'update':
+                    # already applied to the game, the view follows
+                    # once per frame
+                    self._changed.update(dict.fromkeys(e['state'], True))
+                elif e['code'] == 'fatal':
+                    self.message = e['text']
+            if self.sim.tick % HASH_EVERY == 0:
+                self.send({'code': 'hash', 'tick': self.sim.tick,
+                           'h': self.sim.hash()})
+
+        now = time.time()
+        if self._future_inputs and now - self._last_resync > 0.5:
+            # lost more ticks than the redundancy covers
+            self._last_resync = now
+            self.send({'code': 'resync'})
 
     def error_received(self, error):
         self.status_label.text = str(error)
 
+    def connection_lost(self, exc):
+        pass
+
     def update(self, dt):
+        now = time.time()
+        if self.token and now - self._last_heard > LINK_TIMEOUT:
+            self.reconnect(now)
+        if self.spectating and self.connected \
+                and now - self._last_watching > WATCHING_EVERY:
+            self._last_watching = now
+            self.send({'code': 'watching'})
+
         if not self.ingame:
             return
 
-        now = time.time()
+        self.apply_updates()
         if now < self.game_view.force_update:
             self.game_view.update({}, self.game, True)
 
+        if self.spectating:
+            return
+
         d = Direction(0)
         if self.keys[key.UP]:
             d |= Direction.UP
@@ -458,11 +780,42 @@ class Client:
             self._moving = False
             self.send({'code': 'stop'})
 
+    def reconnect(self, now):
+        """ Resume from a new socket, the network may have changed """
+        if self._resume_sent is None:
+            self._resume_sent = now
+            self.message = "Connection lost, reconnecting..."
+            self.transport.close()
+            self.loop.create_task(self._client(self.server))
+        elif now - self._resume_sent > RESUME_WINDOW:
+            self.token = self._resume_sent = None
+            self.message = "Connection lost"
+        elif now - self._resume_retry > RESUME_EVERY \
+                and not self.transport.is_closing():
+            self.send_resume(now)
+
+    def send_resume(self, now):
+        self._resume_retry = now
+        self.send({'code': 'resume', 'token': self.token, 'tick': self.tick})
+
+    def apply_updates(self):
+        """ Patch the game with everything received since last frame """
+        t0 = time.perf_counter()
+        changed, self._changed = self._changed, {}
+        if self._updates:
+            updates, self._updates = self._updates, {}
+            changed.update(self.game.patch(updates))
+        if changed:
+            self.game_view.update(changed, self.game)
+        self.perf.update_time += time.perf_counter() - t0
+
     def send(self, payload):
-        try:
+        if self.transport is None:
+            return
+        if payload['code'] in CLIENT_CRITICAL:
+            self.channel.send(payload, time.time())
+        else:
             self.transport.sendto(json.dumps(payload).encode())
-        except AttributeError:
-            pass
 
     async def terminate(self):
         self.send({'code': 'bye'})
@@ -477,25 +830,34 @@ class Client:
         text = self.prompt.document.text.strip()
         name, *text = text.split('@')
         self.pname = name
+        # no name: just watch, usually through a relay.py
+        self.spectating = not name and bool(text)
 
+        port = DEFAULT_PORT
         if text:
-            host = text[0]
+            host, _, port = text[0].partition(':')
+            port = int(port or DEFAULT_PORT)
             self.message = f"Connecting to {host}"
         else:
             self.message = "Creating server..."
+            import server  # only needed when hosting
             self.loop.create_task(server.endpoint(self.loop))
             host = '127.0.0.1'
 
         async def connect():
             await asyncio.sleep(1)
-            await self._client((host, DEFAULT_PORT))
+            await self._client((host, port))
 
         self.loop.create_task(connect())
 
     def on_key_press(self, sym, mod):
-        if self.home:
+        if sym == key.F3:
+            self.perf.toggle()
+        elif self.home:
             if sym == key.ENTER:
                 self.go()
+        elif self.spectating:
+            return
         elif self.in_lobby:
             if sym == key.ENTER:
                 self.ready = not self.ready
@@ -547,7 +909,10 @@ class Client:
             )
             self.status_label.draw()
 
+        self.perf.draw()
+
     async def _client(self, host):
+        self.server = host
         transport, _ = await self.loop.create_datagram_endpoint(
             self, remote_addr=host)
 
@@ -562,7 +927,7 @@ class Client:
             self.status_label.text = msg
 
 
-def start():
+def start(perf=False, record=None):
     loop = asyncio.get_event_loop()
     window = pyglet.window.Window(
         width=600,
@@ -570,29 +935,41 @@ def start():
     )
 
     pyglet.font.add_file(FONT_FILE)
-
-    RES.update({
-        'logo': pyglet.resource.image('img/logo.png'),
-        'hud': pyglet.resource.image('img/player_hud.png'),
-    })
+    t0 = time.perf_counter()
+    load_assets()
+    assets_time = time.perf_counter() - t0
 
     glEnable(GL_BLEND)  # noqa
     #glClearColor(42/255, 29/255, 13/255, 1)  # noqa
     glClearColor(0, 0, 0, 1)
     glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)  # noqa
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)  # noqa
-    client = Client(window)
+    overlay = PerfOverlay(window, record)
+    overlay.visible = perf
+    client = Client(window, overlay)
 
     async def pyglet_loop():
+        first_frame = True
+        last = time.perf_counter()
         while True:
+            t0 = time.perf_counter()
             pyglet.clock.tick()
             if window.has_exit:
                 break
             window.dispatch_events()
             window.dispatch_event('on_draw')
             window.flip()
+            now = time.perf_counter()
+            overlay.frame(now - last, now - t0)
+            last = now
+            if first_frame:
+                first_frame = False
+                print(f"First frame after "
+                      f"{(time.perf_counter() - STARTED) * 1000:.0f} ms "
+                      f"(assets {assets_time * 1000:.0f} ms)")
             await asyncio.sleep(POLL)
         await client.terminate()
+        overlay.close()
         loop.stop()
 
     @window.event
@@ -609,7 +986,13 @@ def start():
 
 
 def main():
-    start()
+    parser = argparse.ArgumentParser(description="Bomberman client")
+    parser.add_argument('--perf', action='store_true',
+                        help="show the performance overlay (F3 toggles it)")
+    parser.add_argument('--record-frames', metavar='FILE',
+                        help="write every frame time to a CSV file")
+    args = parser.parse_args()
+    start(args.perf, args.record_frames)
 
 
 if __name__ == "__main__":
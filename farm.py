@@ -0,0 +1,245 @@
+""" Headless bot-vs-bot match farm.
+
+Plays seeded matches faster than real time over a process pool: every match
+is a lockstep simulation with a simulated clock, so a seed and a level always
+give the same match. Per-match results are streamed into a small columnar
+file, row groups of zlib compressed columns, readable with `read_results`.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+
+from bomb import GameState, COLLECTIBLES, load_level
+from bot import Bots
+from lockstep import Lockstep
+
+MAGIC = b'BOMBFARM1\n'
+ROW_GROUP = 4096
+DT = 1/60
+MAX_TIME = 300
+# winner column, when there isn't one
+NO_SURVIVOR = -1
+TIMEOUT = -2
+
+KINDS = sorted(COLLECTIBLES)
+# (name, array typecode)
+COLUMNS = [
+    ('seed', 'I'),
+    ('level', 'B'),
+    ('winner', 'b'),
+    ('duration', 'f'),
+    ('ticks', 'I'),
+    ('bombs', 'H'),
+    ('explosions', 'H'),
+    ('walls_broken', 'H'),
+    *[(f'drop{k}', 'H') for k in KINDS],
+    *[(f'spawned{k}', 'H') for k in KINDS],
+    *[(f'pickup{k}', 'H') for k in KINDS],
+    ('cpu', 'f'),
+]
+
+_levels = {}
+
+
+def level_cells(filename):
+    """ Levels are read once per worker """
+    if filename not in _levels:
+        _levels[filename] = load_level(filename)
+    w, h, cells = _levels[filename]
+    return w, h, list(cells)
+
+
+def play(seed, level, players=4, dt=DT, max_time=MAX_TIME):
+    """ Play one match, return its row as {column: value} """
+    cpu = time.process_time()
+    gs = GameState(seed)
+    sim = Lockstep(gs, seed, dt)
+    gs.set_level(*level_cells(level))
+    gs.running = True
+    bots = Bots(gs, seed)
+    names = [f'bot{i}' for i in range(players)]
+    for name in names:
+        bots.add(name)
+        gs.spawn_player(name)
+
+    while gs.running and sim.clock.t < max_time:
+        sim.step(bots.messages(sim.clock.t))
+
+    survivors = [i for i, name in enumerate(names)
+                 if gs.players[name].alive]
+    if gs.running:
+        winner = TIMEOUT
+    elif survivors:
+        winner = survivors[0]
+    else:
+        winner = NO_SURVIVOR
+    return {
+        **gs.stats,
+        'seed': seed,
+        'winner': winner,
+        'duration': sim.clock.t,
+        'ticks': sim.tick,
+        'cpu': time.process_time() - cpu,
+    }
+
+
+def play_task(task):
+    seed, level_idx, levels, players, dt, max_time = task
+    row = play(seed, levels[level_idx], players, dt, max_time)
+    row['level'] = level_idx
+    return row
+
+
+class ResultWriter:
+    """ Rows buffered in columns, written a row group at a time """
+
+    def __init__(self, path, meta):
+        self.f = open(path, 'wb')
+        header = json.dumps({**meta, 'columns': COLUMNS,
+                             'byteorder': sys.byteorder}).encode()
+        self.f.write(MAGIC + struct.pack('<I', len(header)) + header)
+        self.reset()
+        self.rows = 0
+
+    def reset(self):
+        self.columns = {name: array(code) for name, code in COLUMNS}
+
+    def add(self, row):
+        for name, column in self.columns.items():
+            column.append(row.get(name, 0))
+        if len(self.columns['seed']) >= ROW_GROUP:
+            self.flush()
+
+    def flush(self):
+        n = len(self.columns['seed'])
+        if not n:
+            return
+        self.f.write(struct.pack('<I', n))
+        for name, _ in COLUMNS:
+            data = zlib.compress(self.columns[name].tobytes())
+            self.f.write(struct.pack('<I', len(data)) + data)
+        self.rows += n
+        self.reset()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+def read_results(path):
+    """ (header, {column: array}) of a farm output file """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a farm result file")
+        size, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(size))
+        columns = {name: array(code) for name, code in header['columns']}
+        while True:
+            head = f.read(4)
+            if not head:
+                break
+            for name, _ in header['columns']:
+                size, = struct.unpack('<I', f.read(4))
+                columns[name].frombytes(zlib.decompress(f.read(size)))
+    if header['byteorder'] != sys.byteorder:
+        for column in columns.values():
+            column.byteswap()
+    return header, columns
+
+
+def summary(header, columns):
+    n = len(columns['seed'])
+    if not n:
+        print("No match")
+        return
+    # matches which timed out have no outcome, they are counted apart
+    ended = [d for d, w in zip(columns['duration'], columns['winner'])
+             if w != TIMEOUT]
+    print(f"{n} matches, {header['players']} players, {n - len(ended)} "
+          f"timed out ({(n - len(ended)) / n:.1%}), mean duration of the "
+          f"others {sum(ended) / max(1, len(ended)):.1f}s")
+    winners = {}
+    for w in columns['winner']:
+        if w != TIMEOUT:
+            winners[w] = winners.get(w, 0) + 1
+    if ended:
+        print("wins: " + ', '.join(
+            f"{'nobody' if w == NO_SURVIVOR else f'bot{w}'} "
+            f"{c / len(ended):.1%}"
+            for w, c in sorted(winners.items())))
+    walls = sum(columns['walls_broken'])
+    print(f"per match: {sum(columns['explosions']) / n:.1f} explosions, "
+          f"{walls / n:.1f} walls broken")
+    for k in KINDS:
+        drops = sum(columns[f'drop{k}'])
+        spawned = sum(columns[f'spawned{k}'])
+        picked = sum(columns[f'pickup{k}'])
+        print(f"  {k}  dropped {drops / walls if walls else 0:.1%} "
+              f"of walls, {spawned / n:.2f} spawned/match, "
+              f"{picked / max(1, drops + spawned):.1%} picked up")
+
+
+def tasks(args):
+    for i in range(args.matches):
+        yield (args.seed + i, i % len(args.level), args.level,
+               args.players, args.dt, args.max_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--matches', type=int, default=1000)
+    parser.add_argument('--level', action='append',
+                        help="level file, can be repeated "
+                             "(default map1.txt)")
+    parser.add_argument('--players', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed of the first match, then +1 per match")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--dt', type=float, default=DT)
+    parser.add_argument('--max-time', type=float, default=MAX_TIME,
+                        help="simulated seconds before calling a draw")
+    parser.add_argument('--output', default='farm.cols')
+    parser.add_argument('--summary', metavar='FILE',
+                        help="only summarize an existing result file")
+    args = parser.parse_args()
+
+    if args.summary:
+        summary(*read_results(args.summary))
+        return
+    args.level = args.level or ['map1.txt']
+
+    writer = ResultWriter(args.output, {'levels': args.level,
+                                        'players': args.players,
+                                        'dt': args.dt})
+    t0 = last = time.time()
+    cpu = 0
+    done = 0
+    with multiprocessing.Pool(args.workers) as pool:
+        for row in pool.imap_unordered(play_task, tasks(args), chunksize=4):
+            writer.add(row)
+            done += 1
+            cpu += row['cpu']
+            if time.time() - last > 5:
+                last = time.time()
+                rate = done / (last - t0)
+                print(f"{done}/{args.matches} matches, {rate:.1f}/s, "
+                      f"{rate / args.workers:.2f}/s per core")
+    writer.close()
+
+    elapsed = time.time() - t0
+    print(f"{done} matches in {elapsed:.1f}s on {args.workers} workers: "
+          f"{done / elapsed:.1f} matches/s, "
+          f"{done / elapsed / args.workers:.2f} matches/s per core, "
+          f"{done / cpu:.2f} matches per CPU second")
+    print(f"Results written to {args.output}")
+    summary(*read_results(args.output))
+
+
+if __name__ == '__main__':
+    main()
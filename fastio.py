@@ -0,0 +1,117 @@
+""" Optional high throughput datagram I/O for the server.
+
+- uvloop as event loop when it is installed,
+- a reader draining the socket into one preallocated buffer with
+  `recvfrom_into`, handing memoryviews to the protocol,
+- sends queued during a tick and flushed at its end.
+"""
+import asyncio
+import socket
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+RECV_BUFFER = 65536
+# Datagrams read per wakeup, so a flood can't starve the tick
+READ_BATCH = 256
+SOCKET_BUFFER = 4 * 1024 * 1024
+
+
+def install_uvloop():
+    """ Use uvloop for the loops created from now on, if available """
+    if uvloop is None:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    return True
+
+
+class BatchedTransport:
+    """ Wraps a transport, counting and optionally queueing datagrams """
+
+    def __init__(self, transport, batch=False):
+        self.transport = transport
+        self.batch = batch
+        self.queue = []
+        self.sent = 0
+
+    def sendto(self, data, addr=None):
+        self.sent += 1
+        if self.batch:
+            self.queue.append((data, addr))
+        else:
+            self.transport.sendto(data, addr)
+
+    def flush(self):
+        if not self.queue:
+            return
+        queue, self.queue = self.queue, []
+        sendto = self.transport.sendto
+        for data, addr in queue:
+            sendto(data, addr)
+
+    def close(self):
+        self.flush()
+        self.transport.close()
+
+
+class DatagramPump:
+    """ Minimal datagram transport reading into a reused buffer """
+
+    def __init__(self, loop, sock, protocol, bufsize=RECV_BUFFER):
+        self.loop = loop
+        self.sock = sock
+        self.protocol = protocol
+        self.buffer = bytearray(bufsize)
+        self.view = memoryview(self.buffer)
+        self.dropped = 0
+        loop.add_reader(sock.fileno(), self._read)
+
+    def _read(self):
+        recvfrom_into = self.sock.recvfrom_into
+        view = self.view
+        # many packets per wakeup, but give the loop back now and then
+        for _ in range(READ_BATCH):
+            try:
+                n, addr = recvfrom_into(self.buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.protocol.error_received(e)
+                return
+            # the protocol must not keep the view, the buffer is reused
+            self.protocol.datagram_received(view[:n], addr)
+
+    def sendto(self, data, addr=None):
+        try:
+            self.sock.sendto(data, addr)
+        except (BlockingIOError, InterruptedError):
+            self.dropped += 1  # send buffer full, it's UDP after all
+        except OSError as e:
+            self.protocol.error_received(e)
+
+    def close(self):
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+
+
+def bind_socket(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    for opt in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, opt, SOCKET_BUFFER)
+        except OSError:
+            pass
+    sock.bind((host, port))
+    sock.setblocking(False)
+    return sock
+
+
+def create_endpoint(loop, protocol, host, port):
+    """ Like `loop.create_datagram_endpoint`, but with a `DatagramPump` """
+    pump = DatagramPump(loop, bind_socket(host, port), protocol)
+    protocol.connection_made(pump)
+    return pump, protocol
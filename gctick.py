@@ -0,0 +1,119 @@
+""" Garbage collection kept out of the ticks.
+
+`GCMonitor` times every collection through `gc.callbacks`, noting whether
+it landed inside a tick, and counts the GC tracked objects each tick leaves
+behind. `GCControl` also turns automatic collection off: the level and
+everything else alive at game start is frozen out of the collector's
+reach, and the young generations are collected by hand in the idle time
+after a tick, when the pause they usually take fits before the next one.
+"""
+import gc
+import time
+from collections import deque
+
+from stats import percentile
+from tracing import NULL_TRACER
+
+# Collect anyway once this many times the usual threshold is pending
+FORCE = 4
+PAUSE_SMOOTHING = 0.2
+# Idle time left for the loop to wake up on time
+IDLE_MARGIN = 0.002
+
+
+class GCMonitor:
+    def __init__(self, size=600):
+        self.in_tick = False
+        self.pauses = deque(maxlen=size)  # (generation, seconds, in tick)
+        self.collections = [0, 0, 0]
+        self.in_tick_pauses = 0
+        self.tracked = deque(maxlen=size)  # net GC tracked objects per tick
+        self._started = None
+        self._count = None
+        self._collections = 0
+        self.tracer = NULL_TRACER  # collections as spans too
+        gc.callbacks.append(self.callback)
+
+    def callback(self, phase, info):
+        if phase == 'start':
+            self._started = time.perf_counter()
+            return
+        pause = time.perf_counter() - self._started
+        self.pauses.append((info['generation'], pause, self.in_tick))
+        self.tracer.add('gc', self._started, pause,
+                        {'generation': info['generation']})
+        self.collections[info['generation']] += 1
+        self.in_tick_pauses += self.in_tick
+
+    def freeze(self):
+        pass  # only watching, collections stay automatic
+
+    def idle(self, budget):
+        pass
+
+    def tick_start(self):
+        self.in_tick = True
+        self._count = gc.get_count()[0]
+        self._collections = sum(self.collections)
+
+    def tick_end(self):
+        self.in_tick = False
+        # the count restarts from 0 on collections, skip those ticks
+        if sum(self.collections) == self._collections:
+            self.tracked.append(gc.get_count()[0] - self._count)
+
+    def dump(self):
+        pauses = [p for _, p, _ in self.pauses]
+        return {
+            'collections': self.collections,
+            'in_tick': self.in_tick_pauses,
+            'pause_p50': percentile(pauses, 0.5),
+            'pause_p99': percentile(pauses, 0.99),
+            'pause_max': max(pauses, default=0),
+            'tracked_per_tick': percentile(list(self.tracked), 0.5),
+            'tracked_per_tick_max': max(self.tracked, default=0),
+            'frozen': gc.get_freeze_count(),
+        }
+
+
+class GCControl(GCMonitor):
+    def __init__(self, size=600):
+        super().__init__(size)
+        self.thresholds = gc.get_threshold()
+        self.expected = [0, 0, 0]  # usual pause per generation
+        self.deferred = 0
+        gc.disable()
+
+    def callback(self, phase, info):
+        super().callback(phase, info)
+        if phase == 'stop':
+            gen, pause, _ = self.pauses[-1]
+            self.expected[gen] += \
+                PAUSE_SMOOTHING * (pause - self.expected[gen])
+
+    def freeze(self):
+        """ After set_level: whatever is alive now stays alive """
+        gc.unfreeze()
+        gc.collect()
+        gc.freeze()
+
+    def idle(self, budget):
+        """ Collect what's due if it should fit in budget seconds """
+        budget -= IDLE_MARGIN
+        count = gc.get_count()
+        if count[0] < self.thresholds[0]:
+            return
+        gen = 0
+        if count[1] >= self.thresholds[1]:
+            gen = 1
+            if count[2] >= self.thresholds[2]:
+                gen = 2
+        if self.expected[gen] > budget \
+                and count[0] < FORCE * self.thresholds[0]:
+            self.deferred += 1
+            return
+        gc.collect(gen)
+
+    def dump(self):
+        return {**super().dump(), 'deferred': self.deferred,
+                'expected': self.expected}
@@ -0,0 +1,414 @@
+""" Headless load generator speaking the game protocol over UDP.
+
+Spawns one `server.py` per room and fills each room with headless
+sessions that go through the same hi/ready/move/drop_bomb/ping flow as
+`client.py`, then reports latency, packet rates and server tick jitter.
+With `--drop` every session also loses its connection once during the
+match and resumes its session from a new socket.
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import time
+
+from bomb import Direction
+from reliable import ReliableChannel, CLIENT_CRITICAL
+from snapshot import Reassembler, unpack
+from server import DEFAULT_PORT, MAX_CLIENTS, Server
+from stats import percentile
+
+FRAME = 1/60
+RESUME_EVERY = 0.25
+
+DIRECTIONS = [Direction.UP, Direction.DOWN, Direction.LEFT, Direction.RIGHT]
+
+
+class Pattern:
+    """ Decides what a session sends each frame """
+    def __init__(self, rng):
+        self.rng = rng
+
+    def inputs(self, now):
+        return []
+
+
+class Idle(Pattern):
+    pass
+
+
+class Walker(Pattern):
+    """ Walks in a random direction, changing every half second """
+    bomb_every = None
+
+    def __init__(self, rng):
+        super().__init__(rng)
+        self.direction = None
+        self.next_turn = 0
+        self.next_bomb = 0
+
+    def inputs(self, now):
+        msgs = []
+        if now >= self.next_turn:
+            self.next_turn = now + self.rng.uniform(0.2, 0.8)
+            previous = self.direction
+            self.direction = self.rng.choice(DIRECTIONS + [None])
+            if previous and not self.direction:
+                msgs.append({'code': 'stop'})
+        if self.direction:
+            msgs.append({'code': 'move', 'dir': self.direction.value})
+        if self.bomb_every and now >= self.next_bomb:
+            self.next_bomb = now + self.rng.uniform(0.5, 1.5) \
+                * self.bomb_every
+            msgs.append({'code': 'drop_bomb'})
+        return msgs
+
+
+class Bomber(Walker):
+    bomb_every = 2
+
+
+class Spammer(Walker):
+    """ Worst case: moves every frame and asks for a bomb every frame """
+    bomb_every = FRAME
+
+    def inputs(self, now):
+        self.next_turn = 0
+        return super().inputs(now)
+
+
+PATTERNS = {
+    'idle': Idle,
+    'walk': Walker,
+    'bomber': Bomber,
+    'spam': Spammer,
+}
+
+
+class Session:
+    def __init__(self, name, pattern, room_size, addr=None):
+        self.name = name
+        self.addr = addr
+        self.pattern = pattern
+        self.room_size = room_size
+        self.ready = False
+        self.fragments = Reassembler()
+        self.transport = None
+        self.connected = False
+        self.ingame = False
+        self.finished = False
+        self.sent = self.received = 0
+        self.bytes_sent = self.bytes_received = 0
+        self.updates = 0
+        self.latencies = []
+        self._input_sent_at = None
+        self._last_pos = None
+        self._moving = False
+        self.token = None
+        self.tick = -1  # of the last update
+        self.dropped_until = None
+        self._resume_sent = None  # first resume of this drop
+        self._resume_retry = 0
+        self.resume_latencies = []
+        self.missed = []
+
+    def __call__(self):
+        return self
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.channel = ReliableChannel(self.send_raw)
+        if self.token:
+            self.send_resume(time.time())
+        else:
+            self.send({'code': 'hi', 'name': self.name})
+
+    def connection_lost(self, exc):
+        pass
+
+    def error_received(self, exc):
+        pass
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+        self.bytes_received += len(data)
+        data = json.loads(data.decode())
+        if data['code'] == 'ack':
+            self.channel.on_ack(data, time.time())
+        elif 'rseq' in data:
+            for msg in self.channel.receive(data):
+                self.handle(msg)
+        else:
+            self.handle(data)
+
+    def handle(self, data):
+        data = unpack(data)
+        code = data['code']
+        if code == 'frag':
+            msg = self.fragments.add(data)
+            if msg:
+                self.handle(msg)
+        elif code == 'welcome':
+            self.connected = True
+            self.token = data.get('token')
+        elif code == 'resumed':
+            self.missed.append(data['missed'])
+        elif code == 'lobby':
+            # the game starts as soon as everybody is ready, so wait for
+            # the whole room to be there
+            if len(data['players']) == self.room_size and not self.ready:
+                self.ready = True
+                self.send({'code': 'ready', 'ready': True})
+        elif code == 'ping':
+            self.send(data)
+        elif code == 'game_start':
+            self.ingame = True
+        elif code == 'fatal':
+            self.finished = True
+        elif code == 'update':
+            self.updates += 1
+            if self._resume_sent and data['tick'] > self.tick:
+                # caught up: what was missed arrived
+                self.resume_latencies.append(time.time() - self._resume_sent)
+                self._resume_sent = None
+            self.tick = max(self.tick, data['tick'])
+            # latency is measured until our own player is seen moving
+            me = data['state'].get('players', {}).get(self.name)
+            if me and me[0] != self._last_pos:
+                self._last_pos = me[0]
+                if self._input_sent_at:
+                    self.latencies.append(time.time() - self._input_sent_at)
+                    self._input_sent_at = None
+
+    def send(self, payload):
+        if payload['code'] in CLIENT_CRITICAL:
+            self.channel.send(payload, time.time())
+        else:
+            self.send_raw(json.dumps(payload).encode())
+
+    def send_raw(self, data):
+        self.sent += 1
+        self.bytes_sent += len(data)
+        self.transport.sendto(data)
+
+    def drop(self, now, seconds):
+        """ The connection is lost, a new socket resumes after seconds """
+        self.dropped_until = now + seconds
+        self.transport.close()
+
+    def send_resume(self, now):
+        self._resume_sent = self._resume_sent or now
+        self._resume_retry = now
+        self.send_raw(json.dumps({'code': 'resume', 'token': self.token,
+                                  'tick': self.tick}).encode())
+
+    def frame(self, now):
+        if self.dropped_until:
+            if now >= self.dropped_until:
+                self.dropped_until = None
+                asyncio.ensure_future(asyncio.get_event_loop()
+                                      .create_datagram_endpoint(
+                                          self, remote_addr=self.addr))
+            return
+        if self.transport.is_closing():
+            return  # reconnecting
+        self.channel.resend(now)
+        if self._resume_sent and now - self._resume_retry > RESUME_EVERY:
+            self.send_resume(now)
+        if not self.ingame or self.finished:
+            return
+        for msg in self.pattern.inputs(now):
+            # time from starting to move until we see ourselves move,
+            # samples where we stop first (stuck in a wall) are dropped
+            if msg['code'] == 'move' and not self._moving:
+                self._moving = True
+                self._input_sent_at = now
+            elif msg['code'] == 'stop':
+                self._moving = False
+                self._input_sent_at = None
+            self.send(msg)
+
+    def close(self):
+        if self.transport and not self.transport.is_closing():
+            self.send({'code': 'bye'})
+            self.transport.close()
+
+
+class StatsProbe:
+    """ Polls a server's tick statistics through the admin message """
+    def __init__(self):
+        self.replies = asyncio.Queue()
+
+    def __call__(self):
+        return self
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        pass
+
+    def error_received(self, exc):
+        pass
+
+    def datagram_received(self, data, addr):
+        self.replies.put_nowait(json.loads(data.decode()))
+
+    async def query(self, timeout=1):
+        self.transport.sendto(
+            json.dumps({'code': 'admin', 'cmd': 'stats'}).encode())
+        try:
+            return await asyncio.wait_for(self.replies.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+def spawn_rooms(n, base_port):
+    procs = [subprocess.Popen([sys.executable, 'server.py',
+                               '--port', str(base_port + i)],
+                              stdout=subprocess.DEVNULL)
+             for i in range(n)]
+    time.sleep(1)
+    return procs
+
+
+async def run_step(loop, rooms, clients, pattern, duration, base_port,
+                   seed, connect_port=None, drop=None):
+    rng = random.Random(seed)
+    sessions, probes = [], []
+    for r in range(rooms):
+        addr = ('127.0.0.1', base_port + r)
+        _, probe = await loop.create_datagram_endpoint(
+            StatsProbe(), remote_addr=addr)
+        probes.append(probe)
+        # sessions may go through a relay (netproxy.py) instead
+        session_addr = ('127.0.0.1', connect_port + r) if connect_port \
+            else addr
+        for c in range(clients):
+            s = Session(f'bot-{r}-{c}', PATTERNS[pattern](rng), clients,
+                        session_addr)
+            await loop.create_datagram_endpoint(s, remote_addr=session_addr)
+            sessions.append(s)
+
+    start = time.time()
+    next_frame = start
+    # with drop, each session loses its connection once, early enough to
+    # come back well before the end
+    drops = {s: start + rng.uniform(1, max(1, duration / 2 - drop))
+             for s in sessions} if drop else {}
+    while time.time() - start < duration:
+        now = time.time()
+        for s in sessions:
+            if s in drops and now >= drops[s] and s.ingame:
+                del drops[s]
+                s.drop(now, drop)
+            s.frame(now)
+        next_frame += FRAME
+        await asyncio.sleep(max(0, next_frame - time.time()))
+    elapsed = time.time() - start
+
+    ticks = [await p.query() for p in probes]
+    for s in sessions:
+        s.close()
+    for p in probes:
+        p.transport.close()
+    return report(rooms, sessions, ticks, elapsed)
+
+
+def report(rooms, sessions, ticks, elapsed):
+    latencies = [l for s in sessions for l in s.latencies]
+    tick = [t['tick'] for t in ticks if t]
+    return {
+        'rooms': rooms,
+        'clients': len(sessions),
+        'joined': sum(s.ingame for s in sessions),
+        'pps_out': sum(s.sent for s in sessions) / elapsed,
+        'pps_in': sum(s.received for s in sessions) / elapsed,
+        'kbps_in': sum(s.bytes_received for s in sessions) / elapsed / 1000,
+        'updates_per_client': (sum(s.updates for s in sessions)
+                               / elapsed / max(1, len(sessions))),
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p99': percentile(latencies, 0.99),
+        'resumes': [l for s in sessions for l in s.resume_latencies],
+        'missed': [m for s in sessions for m in s.missed],
+        'jitter_p99': max((t['jitter_p99'] for t in tick), default=0),
+        'overruns': sum(t['overruns'] for t in tick),
+        'unresponsive_rooms': len(ticks) - len(tick),
+    }
+
+
+def sustained(result, jitter_budget):
+    return (result['joined'] == result['clients']
+            and not result['unresponsive_rooms']
+            and result['jitter_p99'] <= jitter_budget)
+
+
+def print_result(r, ok):
+    print(f"{r['rooms']:>5} {r['clients']:>7} {r['joined']:>6} "
+          f"{r['pps_in']:>8.0f} {r['pps_out']:>8.0f} {r['kbps_in']:>8.1f} "
+          f"{r['latency_p50']*1000:>7.1f} {r['latency_p99']*1000:>7.1f} "
+          f"{r['jitter_p99']*1000:>8.1f} {r['overruns']:>5}  "
+          f"{'ok' if ok else 'FAIL'}")
+    if r['resumes']:
+        print(f"      {len(r['resumes'])} resumed, caught up in p50 "
+              f"{percentile(r['resumes'], 0.5)*1000:.1f} ms p99 "
+              f"{percentile(r['resumes'], 0.99)*1000:.1f} ms, "
+              f"up to {max(r['missed'], default=0)} ticks missed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rooms', type=int, default=1,
+                        help="rooms to run, or the maximum with --ramp")
+    parser.add_argument('--clients', type=int, default=MAX_CLIENTS,
+                        help="clients per room")
+    parser.add_argument('--pattern', choices=PATTERNS, default='bomber')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help="port of the first room")
+    parser.add_argument('--connect', type=int, default=None,
+                        help="connect sessions to this port instead, "
+                        "e.g. a netproxy.py relay in front of the room")
+    parser.add_argument('--ramp', action='store_true',
+                        help="add rooms one by one until the box saturates")
+    parser.add_argument('--jitter-budget', type=float, default=Server.TICK/2,
+                        help="max acceptable p99 tick jitter (seconds)")
+    parser.add_argument('--drop', type=float, metavar='SECONDS',
+                        help="each session loses its connection that long "
+                        "once, then resumes")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    steps = range(1, args.rooms + 1) if args.ramp else [args.rooms]
+    print("rooms clients joined   pps_in  pps_out  kB/s_in "
+          "lat_p50 lat_p99 jit_p99 ovrun")
+    best = None
+    for rooms in steps:
+        procs = spawn_rooms(rooms, args.port)
+        try:
+            result = loop.run_until_complete(run_step(
+                loop, rooms, min(args.clients, MAX_CLIENTS), args.pattern,
+                args.duration, args.port, args.seed, args.connect,
+                args.drop))
+        finally:
+            for p in procs:
+                p.terminate()
+                p.wait()
+        ok = sustained(result, args.jitter_budget)
+        print_result(result, ok)
+        if not ok:
+            break
+        best = result
+
+    if best:
+        print(f"Sustained {best['rooms']} rooms / {best['clients']} clients "
+              f"({args.pattern} pattern)")
+    else:
+        print("Could not sustain a single room")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+""" Deterministic lockstep simulation of a GameState.
+
+In lockstep mode the server only stamps player inputs with a tick number and
+relays them. Every peer steps its own GameState with the same inputs, the
+same fixed dt, a simulated clock and a random generator seeded from the
+tick, so all of them compute the same match. Peers send state hashes now and
+then, a mismatching one gets a full snapshot back.
+"""
+import json
+import zlib
+from collections import defaultdict
+
+from bomb import GameState, action
+
+# Input codes relayed to every peer
+INPUTS = {'move', 'stop', 'drop_bomb'}
+# Only the latest of those per player counts in a tick, each would move the
+# player for the whole tick
+STEERING = {'move', 'stop'}
+# How many past ticks of inputs every 'inputs' message repeats, so a lost
+# datagram or two doesn't mean a desync
+REDUNDANCY = 4
+HASH_EVERY = 30
+HISTORY = 600
+# Seconds a move keeps its player walking without a newer one
+HOLD = 0.05
+
+
+class Steering:
+    """ Moves and stops of the server's players, applied once per tick.
+
+    A move keeps its player walking until a stop, or for HOLD seconds without
+    a newer move, so a tick which got no input because of jitter still moves
+    the player. A move followed by a stop in the same tick does both.
+    """
+
+    def __init__(self, hold=HOLD):
+        self.hold = hold
+        self.moving = {}  # player -> [move action, seconds left]
+        self.stopping = {}  # player -> stop action
+
+    def add(self, player, code, a):
+        if code == 'move':
+            self.moving[player] = [a, self.hold]
+            self.stopping.pop(player, None)
+        else:
+            self.stopping[player] = a
+
+    def forget(self, player):
+        self.moving.pop(player, None)
+        self.stopping.pop(player, None)
+
+    def actions(self, dt):
+        """ What to apply this tick, moves first """
+        actions = []
+        for player, entry in list(self.moving.items()):
+            actions.append(entry[0])
+            entry[1] -= dt
+            if entry[1] <= 0 or player in self.stopping:
+                del self.moving[player]
+        actions += self.stopping.values()
+        self.stopping = {}
+        return actions
+
+
+class SimClock:
+    def __init__(self, t=0):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+
+class Lockstep:
+    def __init__(self, gs: GameState, seed, dt, tick=0):
+        self.gs = gs
+        self.seed = seed
+        self.dt = dt
+        self.tick = tick
+        self.clock = gs.clock = SimClock(tick * dt)
+
+    def step(self, inputs):
+        """ Run next tick with inputs [(player, message)], return effects """
+        self.tick += 1
+        self.clock.t = self.tick * self.dt
+        self.gs.random.seed(self.seed * 1000003 + self.tick)
+
+        effects = [self.gs.tick(self.dt)]
+        for pname, data in inputs:
+            if pname in self.gs.players:
+                a = action(self.gs, pname, data)
+                if a:
+                    effects.append(a(self.dt))
+        return merge_effects(effects)
+
+    def hash(self):
+        return state_hash(self.gs)
+
+    def snapshot(self):
+        gs = self.gs
+        return {
+            'state': gs.dump(),
+            'tick': self.tick,
+            'seed': self.seed,
+            'dt': self.dt,
+            'can_walk': {k: sorted(v) for k, v in gs._can_walk.items()},
+            'last_coll': gs._last_coll,
+            'uid': gs._uid,
+        }
+
+    @classmethod
+    def restore(cls, snap):
+        gs = GameState()
+        sim = cls(gs, snap['seed'], snap['dt'], snap['tick'])
+        gs.load(snap['state'])
+        gs.update_wall_rects()
+        gs._can_walk = defaultdict(
+            set, {k: set(v) for k, v in snap['can_walk'].items()})
+        gs._last_coll = snap['last_coll']
+        gs._uid = snap['uid']
+        return sim
+
+
+def merge_effects(effects):
+    """ One update with every changed field, plus the other effects """
+    merged, others = {}, []
+    for effect in effects:
+        for e in effect or []:
+            if e['code'] == 'update':
+                merged.update(e['state'])
+            else:
+                others.append(e)
+    if merged:
+        others.append({'code': 'update', 'state': merged})
+    return others
+
+
+def state_hash(gs: GameState):
+    data = json.dumps([gs.dump(), sorted(
+        (k, sorted(v)) for k, v in gs._can_walk.items())], sort_keys=True)
+    return zlib.crc32(data.encode())
+
+
+class InputLog:
+    """ Server side: inputs of recent ticks and the matching hashes """
+
+    def __init__(self):
+        self.pending = []
+        self.ticks = {}
+        self.hashes = {}
+
+    def add(self, pname, data):
+        if data['code'] in STEERING:
+            self.pending = [(n, d) for n, d in self.pending
+                            if n != pname or d['code'] not in STEERING]
+        self.pending.append((pname, data))
+
+    def close_tick(self, tick, hash_):
+        inputs, self.pending = self.pending, []
+        self.ticks[tick] = inputs
+        self.hashes[tick] = hash_
+        self.ticks.pop(tick - HISTORY, None)
+        self.hashes.pop(tick - HISTORY, None)
+        return inputs
+
+    def message(self, tick):
+        """ The 'inputs' message for tick, with the previous ones too """
+        return {'code': 'inputs', 'tick': tick,
+                'in': [[t, self.ticks[t]]
+                       for t in range(tick - REDUNDANCY + 1, tick + 1)
+                       if t in self.ticks]}
+
+    def check(self, tick, hash_):
+        """ False if a peer's hash doesn't match ours """
+        return self.hashes.get(tick, hash_) == hash_
@@ -0,0 +1,258 @@
+""" Matchmaker: one address for players, many game server processes.
+
+Players connect to the matchmaker as if it were a game server. It answers
+their `hi` with a `redirect` to a server with room, and the client carries
+on with that one. Servers are `server.py` workers the matchmaker spawns on
+consecutive local ports and polls with the `stats` admin message for their
+players and CPU load. Players go to the open room with the most players
+already waiting so that matches fill up and start, and among equals to
+the least busy process. A worker is spawned when every room is full or
+playing, and stopped once its match is over and empty.
+"""
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+
+from reliable import ReliableChannel, CRITICAL, RESEND_EVERY
+from server import DEFAULT_PORT, MAX_CLIENTS
+
+MATCHMAKER_PORT = DEFAULT_PORT + 3
+BASE_PORT = DEFAULT_PORT + 10
+POLL_EVERY = 0.5
+# A redirected player counts in its room until the server has seen it
+RESERVATION = 3
+WORKER_TIMEOUT = 5
+CHANNEL_TIMEOUT = 10
+
+
+class Worker:
+    def __init__(self, port, process):
+        self.port = port
+        self.process = process
+        self.ready = False  # answered a poll
+        self.players = 0
+        self.started = False
+        self.cpu = 0  # process CPU time per second
+        self.last_cpu = None
+        self.last_seen = time.time()
+        self.reservations = []  # redirected at
+        self.waiting = []  # addresses to redirect once ready
+
+    @property
+    def count(self):
+        return self.players + len(self.reservations) + len(self.waiting)
+
+    @property
+    def open(self):
+        return not self.started and self.count < MAX_CLIENTS
+
+    def on_stats(self, data, now):
+        self.ready = True
+        self.last_seen = now
+        # players who arrived since the last poll were reserved for
+        arrived = max(0, data['players'] - self.players)
+        self.reservations = self.reservations[arrived:]
+        self.players = data['players']
+        self.started = data['started']
+        cpu = data['io']['cpu']
+        if self.last_cpu:
+            at, before = self.last_cpu
+            self.cpu = (cpu - before) / max(now - at, 1e-3)
+        self.last_cpu = now, cpu
+        self.reservations = [t for t in self.reservations
+                             if now - t < RESERVATION]
+
+    def dump(self):
+        return {'port': self.port, 'ready': self.ready,
+                'players': self.players, 'reserved': len(self.reservations),
+                'started': self.started, 'cpu': self.cpu}
+
+
+class Matchmaker:
+    def __init__(self, base_port=BASE_PORT, min_workers=1, max_workers=8,
+                 server_args=()):
+        self.base_port = base_port
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.server_args = list(server_args)
+        self.workers = {}  # port -> Worker
+        self.channels = {}  # addr -> [ReliableChannel, last seen]
+        self.redirected = 0
+        self.spawned = 0
+        self.transport = None
+
+    def __call__(self):
+        return self
+
+    def connection_made(self, transport):
+        self.transport = transport
+        for _ in range(self.min_workers):
+            self.spawn()
+        loop = asyncio.get_event_loop()
+        loop.create_task(self.poll_loop())
+        loop.create_task(self.resend_loop())
+
+    def connection_lost(self, exc):
+        pass
+
+    def error_received(self, exc):
+        pass
+
+    def datagram_received(self, data, addr):
+        try:
+            data = json.loads(data.decode())
+            code = data['code']
+        except (ValueError, TypeError, KeyError):
+            return
+        now = time.time()
+        if addr[1] in self.workers and addr[0] == '127.0.0.1':
+            if code == 'admin' and data.get('cmd') == 'stats':
+                self.workers[addr[1]].on_stats(data, now)
+                self.redirect_waiting(self.workers[addr[1]])
+            return
+        if code == 'ack':
+            if addr in self.channels:
+                self.channels[addr][0].on_ack(data, now)
+        elif 'rseq' in data:
+            for msg in self.channel(addr).receive(data):
+                self.handle(msg, addr)
+        else:
+            self.handle(data, addr)
+
+    def handle(self, data, addr):
+        code = data['code']
+        if code == 'hi':
+            self.place(addr)
+        elif code == 'admin' and data.get('cmd') == 'stats' \
+                and addr[0] in ('127.0.0.1', '::1'):
+            self.send(addr, {'code': 'admin', 'cmd': 'stats',
+                             'redirected': self.redirected,
+                             'spawned': self.spawned,
+                             'workers': [w.dump()
+                                         for w in self.workers.values()]})
+
+    def place(self, addr):
+        """ Send the player to a room, spawning a server if need be """
+        rooms = [w for w in self.workers.values() if w.open]
+        if rooms:
+            # fill rooms up first, then the least busy process
+            worker = min(rooms, key=lambda w: (-w.count, w.cpu))
+        elif len(self.workers) < self.max_workers:
+            worker = self.spawn()
+        else:
+            self.send(addr, {'code': 'fatal',
+                             'text': 'All servers are full'})
+            return
+        worker.waiting.append(addr)
+        self.redirect_waiting(worker)
+
+    def redirect_waiting(self, worker):
+        if not worker.ready:
+            return  # still starting, redirected after its first stats
+        now = time.time()
+        for addr in worker.waiting:
+            # host None: the matchmaker's own host
+            self.send(addr, {'code': 'redirect', 'host': None,
+                             'port': worker.port})
+            worker.reservations.append(now)
+            self.redirected += 1
+        worker.waiting = []
+
+    def spawn(self):
+        port = self.base_port
+        while port in self.workers:
+            port += 1
+        process = subprocess.Popen(
+            [sys.executable, 'server.py', '--port', str(port),
+             *self.server_args], stdout=subprocess.DEVNULL)
+        worker = self.workers[port] = Worker(port, process)
+        self.spawned += 1
+        print(f"Spawned server on port {port}")
+        return worker
+
+    def stop(self, worker, reason):
+        print(f"Stopping server on port {worker.port}: {reason}")
+        worker.process.terminate()
+        worker.process.wait(1)
+        self.workers.pop(worker.port)
+
+    async def poll_loop(self):
+        query = json.dumps({'code': 'admin', 'cmd': 'stats'}).encode()
+        while True:
+            now = time.time()
+            for worker in list(self.workers.values()):
+                if worker.process.poll() is not None:
+                    self.workers.pop(worker.port)
+                    print(f"Server on port {worker.port} exited")
+                elif now - worker.last_seen > WORKER_TIMEOUT:
+                    self.stop(worker, "not answering")
+                elif worker.started and not worker.count:
+                    self.stop(worker, "match over")
+                else:
+                    self.transport.sendto(query, ('127.0.0.1', worker.port))
+            for _ in range(self.min_workers - len(self.workers)):
+                self.spawn()
+            await asyncio.sleep(POLL_EVERY)
+
+    async def resend_loop(self):
+        while True:
+            now = time.time()
+            for addr, (channel, seen) in list(self.channels.items()):
+                channel.resend(now)
+                if channel.idle and now - seen > CHANNEL_TIMEOUT:
+                    self.channels.pop(addr)
+            await asyncio.sleep(RESEND_EVERY)
+
+    def channel(self, addr):
+        if addr not in self.channels:
+            self.channels[addr] = [ReliableChannel(
+                lambda data: self.transport.sendto(data, addr)), 0]
+        self.channels[addr][1] = time.time()
+        return self.channels[addr][0]
+
+    def send(self, addr, payload):
+        if payload['code'] in CRITICAL:
+            self.channel(addr).send(payload, time.time())
+        else:
+            self.transport.sendto(json.dumps(payload).encode(), addr)
+
+    def close(self):
+        for worker in list(self.workers.values()):
+            self.stop(worker, "shutting down")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=MATCHMAKER_PORT,
+                        help="port players connect to")
+    parser.add_argument('--base-port', type=int, default=BASE_PORT,
+                        help="first port of the game servers")
+    parser.add_argument('--min-workers', type=int, default=1,
+                        help="game servers kept running, even empty")
+    parser.add_argument('--max-workers', type=int, default=8)
+    parser.add_argument('--level', default='map1.txt')
+    parser.add_argument('--fast-io', action='store_true')
+    args = parser.parse_args()
+
+    server_args = ['--level', args.level]
+    if args.fast_io:
+        server_args.append('--fast-io')
+    matchmaker = Matchmaker(args.base_port, args.min_workers,
+                            args.max_workers, server_args)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(loop.create_datagram_endpoint(
+        matchmaker, local_addr=('0.0.0.0', args.port)))
+    print(f"Matchmaking on port {args.port}")
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        matchmaker.close()
+
+
+if __name__ == '__main__':
+    main()
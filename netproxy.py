@@ -0,0 +1,230 @@
+""" UDP relay injecting bad network conditions between clients and server.
+
+Every client seen on the listening port gets its own upstream socket, so the
+server still sees one address per client. Each direction can be given
+latency, jitter, loss, reordering and duplication independently.
+"""
+import argparse
+import asyncio
+import ipaddress
+import random
+import time
+
+from server import DEFAULT_PORT
+
+UP = 'client->server'
+DOWN = 'server->client'
+
+
+class Impairment:
+    def __init__(self, latency=0, jitter=0, loss=0, reorder=0,
+                 duplicate=0, rng=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.reorder = reorder
+        self.duplicate = duplicate
+        self.rng = rng or random.Random()
+
+    def delays(self):
+        """ Delays at which copies of a packet are delivered, or [] if lost """
+        rng = self.rng
+        if rng.random() < self.loss:
+            return []
+        copies = 2 if rng.random() < self.duplicate else 1
+        delays = []
+        for _ in range(copies):
+            d = self.latency + rng.uniform(-self.jitter, self.jitter)
+            if rng.random() < self.reorder:
+                # held back long enough for the next packets to overtake it
+                d += self.latency + self.jitter + 0.01
+            delays.append(max(0, d))
+        return delays
+
+
+class DirectionStats:
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.delivered = 0
+        self.delay_total = 0
+
+    def record(self, size, delays):
+        self.packets += 1
+        self.bytes += size
+        if not delays:
+            self.dropped += 1
+        self.duplicated += max(0, len(delays) - 1)
+        self.delivered += len(delays)
+        self.delay_total += sum(delays)
+
+    def dump(self, elapsed):
+        return {
+            'packets': self.packets,
+            'pps': self.packets / elapsed if elapsed else 0,
+            'kBps': self.bytes / elapsed / 1000 if elapsed else 0,
+            'dropped': self.dropped,
+            'duplicated': self.duplicated,
+            'mean_delay_ms': (self.delay_total / self.delivered * 1000
+                              if self.delivered else 0),
+        }
+
+
+class Upstream:
+    """ Socket talking to the server on behalf of one client """
+    def __init__(self, proxy, client_addr):
+        self.proxy = proxy
+        self.client_addr = client_addr
+        self.transport = None
+        self.waiting = []  # sent up before the socket was ready
+
+    def __call__(self):
+        return self
+
+    def connection_made(self, transport):
+        self.transport = transport
+        waiting, self.waiting = self.waiting, []
+        for data in waiting:
+            transport.sendto(data)
+
+    def connection_lost(self, exc):
+        pass
+
+    def error_received(self, exc):
+        pass
+
+    def datagram_received(self, data, addr):
+        self.proxy.relay(DOWN, data, self.proxy.transport.sendto,
+                         self.client_addr)
+
+
+class Proxy:
+    def __init__(self, target, impairments):
+        self.target = target
+        self.impairments = impairments
+        self.stats = {UP: DirectionStats(), DOWN: DirectionStats()}
+        self.upstreams = {}
+        self.transport = None
+        self.started = time.time()
+        self.loop = asyncio.get_event_loop()
+
+    def __call__(self):
+        return self
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        pass
+
+    def error_received(self, exc):
+        pass
+
+    def datagram_received(self, data, addr):
+        upstream = self.upstreams.get(addr)
+        if upstream is None:
+            upstream = self.upstreams[addr] = Upstream(self, addr)
+            self.loop.create_task(self.loop.create_datagram_endpoint(
+                upstream, remote_addr=self.target))
+        self.relay(UP, data, self._send_up, upstream)
+
+    def _send_up(self, data, upstream):
+        if upstream.transport:
+            upstream.transport.sendto(data)
+        else:
+            upstream.waiting.append(data)
+
+    def relay(self, direction, data, send, dest):
+        delays = self.impairments[direction].delays()
+        self.stats[direction].record(len(data), delays)
+        for d in delays:
+            if d:
+                self.loop.call_later(d, send, data, dest)
+            else:
+                send(data, dest)
+
+    def dump_stats(self):
+        elapsed = time.time() - self.started
+        return {direction: s.dump(elapsed)
+                for direction, s in self.stats.items()}
+
+
+def check_local(host):
+    if not ipaddress.ip_address(host).is_loopback:
+        raise SystemExit(f"{host} is not a loopback address, "
+                         "the proxy only runs on localhost")
+
+
+async def report_loop(proxy, every):
+    while True:
+        await asyncio.sleep(every)
+        for direction, s in proxy.dump_stats().items():
+            print(f"{direction}: " + ' '.join(
+                f"{k}={v:.1f}" if isinstance(v, float) else f"{k}={v}"
+                for k, v in s.items()))
+
+
+def impairment_args(parser, prefix, name):
+    group = parser.add_argument_group(name)
+    group.add_argument(f'--{prefix}latency', type=float, default=None,
+                       help="one way delay in ms")
+    group.add_argument(f'--{prefix}jitter', type=float, default=None,
+                       help="random +/- delay in ms")
+    group.add_argument(f'--{prefix}loss', type=float, default=None,
+                       help="drop probability (0-1)")
+    group.add_argument(f'--{prefix}reorder', type=float, default=None,
+                       help="probability of delaying a packet past others")
+    group.add_argument(f'--{prefix}duplicate', type=float, default=None,
+                       help="probability of sending a packet twice")
+
+
+def build_impairment(args, prefix, rng):
+    def get(name):
+        v = getattr(args, prefix + name)
+        return getattr(args, name) if v is None else v
+    return Impairment(latency=(get('latency') or 0) / 1000,
+                      jitter=(get('jitter') or 0) / 1000,
+                      loss=get('loss') or 0,
+                      reorder=get('reorder') or 0,
+                      duplicate=get('duplicate') or 0,
+                      rng=rng)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--listen', type=int, default=DEFAULT_PORT,
+                        help="port clients connect to")
+    parser.add_argument('--target', type=int, default=DEFAULT_PORT + 1,
+                        help="port the server listens on")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--report', type=float, default=5,
+                        help="seconds between traffic reports")
+    impairment_args(parser, '', "both directions")
+    impairment_args(parser, 'up-', "client to server only")
+    impairment_args(parser, 'down-', "server to client only")
+    args = parser.parse_args()
+    check_local(args.host)
+
+    rng = random.Random(args.seed)
+    proxy = Proxy((args.host, args.target), {
+        UP: build_impairment(args, 'up_', rng),
+        DOWN: build_impairment(args, 'down_', rng),
+    })
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(loop.create_datagram_endpoint(
+        proxy, local_addr=(args.host, args.listen)))
+    loop.create_task(report_loop(proxy, args.report))
+    print(f"Relaying {args.host}:{args.listen} -> {args.host}:{args.target}")
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    print(proxy.dump_stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+""" Periodic snapshots of a running match, to resume it after a crash.
+
+The server captures a copy of its state on the loop (cheap: the game's
+entities are immutable tuples), and a worker thread encodes, compresses and
+writes it. Files are replaced atomically, a crash mid-write leaves the
+previous snapshot. Times are saved relative to the snapshot, so bombs get
+the fuse they had left when the match resumes.
+"""
+import json
+import os
+import time
+import zlib
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from bomb import GameState, Player, Bomb, Flame, Collectible
+from snapshot import encode_cells, decode_cells
+
+SNAPSHOT_EVERY = 1
+VERSION = 2
+
+
+def capture_game(gs: GameState, now):
+    return {
+        'width': gs.width,
+        'height': gs.height,
+        'cells': encode_cells(gs.cells),
+        'running': gs.running,
+        'players': dict(gs.players),
+        # remaining fuse, and flame age
+        'bombs': [(b.id, b.player, b.pos, b.birth + b.ttl - now, b.radius,
+                   b.ttl) for b in gs.bombs],
+        'flames': [(f.pos, now - f.birth, f.kind) for f in gs.flames],
+        'collectibles': list(gs.collectibles),
+        'can_walk': {k: sorted(v) for k, v in gs._can_walk.items()},
+        'last_coll': now - gs._last_coll,
+        'uid': gs._uid,
+        # for the match result: how long it lasted, who survived longest
+        'age': now - gs.started_at,
+        'deaths': {name: now - t for name, t in gs.deaths.items()},
+        'stats': dict(gs.stats),
+        'player_stats': {name: dict(c) for name, c in gs.player_stats.items()},
+    }
+
+
+def restore_game(data, now) -> GameState:
+    gs = GameState()
+    gs.set_level(data['width'], data['height'], decode_cells(data['cells']))
+    gs.running = data['running']
+    gs.players = {name: Player(tuple(p[0]), *p[1:])
+                  for name, p in data['players'].items()}
+    gs.bombs = [Bomb(bid, player, tuple(pos), now - (ttl - fuse), radius,
+                     ttl)
+                for bid, player, pos, fuse, radius, ttl in data['bombs']]
+    gs.flames = [Flame(tuple(pos), now - age, kind)
+                 for pos, age, kind in data['flames']]
+    gs.collectibles = [Collectible(kind, tuple(pos))
+                       for kind, pos in data['collectibles']]
+    gs._can_walk = defaultdict(
+        set, {k: set(v) for k, v in data['can_walk'].items()})
+    gs._last_coll = now - data['last_coll']
+    gs._uid = data['uid']
+    gs.started_at = now - data['age']
+    gs.deaths = {name: now - ago for name, ago in data['deaths'].items()}
+    gs.stats = Counter(data['stats'])
+    gs.player_stats = defaultdict(Counter, {
+        name: Counter(c) for name, c in data['player_stats'].items()})
+    return gs
+
+
+def write(path, snap):
+    """ Encode and atomically replace path, runs in the writer thread """
+    t0 = time.perf_counter()
+    data = zlib.compress(json.dumps(snap).encode())
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(data), time.perf_counter() - t0
+
+
+def read(path):
+    try:
+        with open(path, 'rb') as f:
+            snap = json.loads(zlib.decompress(f.read()).decode())
+    except FileNotFoundError:
+        return None
+    if snap.get('version') != VERSION:
+        print(f"Ignoring {path}, unknown snapshot version")
+        return None
+    return snap
+
+
+class SnapshotWriter:
+    def __init__(self, path, every=SNAPSHOT_EVERY):
+        self.path = path
+        self.every = every
+        self.executor = ThreadPoolExecutor(1)
+        self.pending = None
+        self.written = 0
+        self.skipped = 0
+        self.size = 0
+        self.write_time = 0
+
+    def save(self, loop, snap):
+        """ Write snap in the background, unless a write is still going """
+        if self.pending and not self.pending.done():
+            self.skipped += 1
+            return
+        snap = {'version': VERSION, **snap}
+        self.pending = loop.run_in_executor(self.executor, write,
+                                            self.path, snap)
+        self.pending.add_done_callback(self._written)
+
+    def _written(self, future):
+        if future.exception():
+            print(f"Snapshot failed: {future.exception()}")
+            return
+        self.size, self.write_time = future.result()
+        self.written += 1
+
+    def dump(self):
+        return {'written': self.written, 'skipped': self.skipped,
+                'size': self.size, 'write_time': self.write_time}
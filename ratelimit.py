@@ -0,0 +1,80 @@
+""" Cheap checks on inbound datagrams, before any JSON decoding.
+
+Every source address gets a token bucket, and datagrams which are too big,
+don't look like a JSON object, or come from an address the server doesn't
+know (unless they introduce it) are dropped and counted, so a noisy or
+malicious sender costs a few comparisons per packet rather than a decode.
+"""
+import re
+import time
+from collections import Counter
+
+# Per address, messages per second and burst. A client sends a move per
+# frame, pings, acks and the odd bomb.
+RATE = 300
+BURST = 150
+MAX_DATAGRAM = 4096
+# Codes a datagram from an unknown address may have, found in its first
+# HEAD bytes whatever the key order and spacing of the sender's JSON
+INTRODUCTION = re.compile(
+    rb'"code"\s*:\s*"(?:hi|spectate|admin|resume)"')
+HEAD = 256
+IDLE_BUCKET = 10
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def take(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class InboundGuard:
+    def __init__(self, rate=RATE, burst=BURST):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # addr -> TokenBucket
+        self.rejected = Counter()
+        self.accepted = 0
+
+    def check(self, data, addr, known, now):
+        """ Reason to drop the datagram, or None to decode it """
+        if len(data) > MAX_DATAGRAM:
+            return self.reject('oversize')
+        if self.rate:
+            bucket = self.buckets.get(addr)
+            if bucket is None:
+                bucket = self.buckets[addr] = TokenBucket(
+                    self.rate, self.burst, now)
+            if not bucket.take(now):
+                return self.reject('rate_limited')
+        if data[:1] != b'{':
+            return self.reject('malformed')
+        if not known and not INTRODUCTION.search(data, 0, HEAD):
+            return self.reject('unknown')
+        self.accepted += 1
+
+    def reject(self, reason):
+        self.rejected[reason] += 1
+        return reason
+
+    def prune(self, now=None):
+        """ Forget addresses which have been quiet for a while """
+        now = now or time.time()
+        for addr, bucket in list(self.buckets.items()):
+            if now - bucket.last > IDLE_BUCKET:
+                del self.buckets[addr]
+
+    def dump(self):
+        return {'accepted': self.accepted, 'rejected': dict(self.rejected),
+                'addresses': len(self.buckets)}
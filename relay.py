@@ -0,0 +1,228 @@
+""" Spectator relay: one subscription to a game server, many watchers.
+
+The relay joins the server as a single spectator, then fans the stream out
+to its own spectators, slightly delayed and with all the updates of a
+period merged into one message. Watching a match this way costs the game
+server a single extra recipient whatever the audience.
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+
+from reliable import ReliableChannel, CRITICAL, RESEND_EVERY
+from server import DEFAULT_PORT, SPECTATOR_TIMEOUT
+from snapshot import Fragmenter, Reassembler, unpack
+
+RELAY_PORT = DEFAULT_PORT + 2
+SEND_EVERY = 1/10
+DELAY = 0.5
+HEARTBEAT = 2
+
+
+def merged_update(state, tick):
+    """ Updates merged by the relay, with the tick of the last one """
+    msg = {'code': 'update', 'state': state}
+    if tick is not None:
+        msg['tick'] = tick
+    return msg
+
+
+class Upstream:
+    """ The relay's own spectator session on the game server """
+
+    def __init__(self, relay):
+        self.relay = relay
+        self.transport = None
+        self.channel = ReliableChannel(
+            lambda data: self.transport.sendto(data))
+        self.fragments = Reassembler()
+
+    def __call__(self):
+        return self
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.channel.send({'code': 'spectate'}, time.time())
+
+    def connection_lost(self, exc):
+        pass
+
+    def error_received(self, exc):
+        pass
+
+    def datagram_received(self, data, addr):
+        data = json.loads(data.decode())
+        if data['code'] == 'ack':
+            self.channel.on_ack(data, time.time())
+        elif 'rseq' in data:
+            for msg in self.channel.receive(data):
+                self.handle(msg)
+        else:
+            self.handle(data)
+
+    def handle(self, data):
+        data = unpack(data)
+        if data['code'] == 'frag':
+            data = self.fragments.add(data)
+            if not data:
+                return
+        self.relay.queue(data)
+
+
+class Relay:
+    def __init__(self, server_addr, delay=DELAY, send_every=SEND_EVERY):
+        self.server_addr = server_addr
+        self.delay = delay
+        self.send_every = send_every
+        self.spectators = {}  # addr -> last seen
+        self.channels = {}
+        self.fragmenter = Fragmenter()
+        self.incoming = deque()  # (received at, message)
+        self.lobby = {}
+        self.state = None  # game state as spectators currently see it
+        self.upstream = Upstream(self)
+        self.transport = None
+        self.sent = 0
+
+    def __call__(self):
+        return self
+
+    def connection_made(self, transport):
+        self.transport = transport
+        loop = asyncio.get_event_loop()
+        loop.create_task(loop.create_datagram_endpoint(
+            self.upstream, remote_addr=self.server_addr))
+        loop.create_task(self.send_loop())
+        loop.create_task(self.housekeeping())
+
+    def connection_lost(self, exc):
+        pass
+
+    def error_received(self, exc):
+        pass
+
+    def queue(self, msg):
+        self.incoming.append((time.time(), msg))
+
+    def datagram_received(self, data, addr):
+        data = json.loads(data.decode())
+        code = data['code']
+        if code == 'ack':
+            if addr in self.channels:
+                self.channels[addr].on_ack(data, time.time())
+            return
+        if 'rseq' in data:
+            msgs = self.channel(addr).receive(data)
+        else:
+            msgs = [data]
+        for msg in msgs:
+            if msg['code'] == 'spectate':
+                self.join(addr)
+            elif msg['code'] == 'watching' and addr in self.spectators:
+                self.spectators[addr] = time.time()
+            elif msg['code'] == 'bye':
+                self.spectators.pop(addr, None)
+                self.channels.pop(addr, None)
+
+    def join(self, addr):
+        self.spectators[addr] = time.time()
+        self.send([addr], {'code': 'welcome', 'name': None})
+        self.send([addr], {'code': 'lobby', 'players': self.lobby})
+        if self.state is not None:
+            self.send([addr], {'code': 'game_start', 'state': self.state})
+
+    def channel(self, addr):
+        if addr not in self.channels:
+            self.channels[addr] = ReliableChannel(
+                lambda data: self.transport.sendto(data, addr))
+        return self.channels[addr]
+
+    async def send_loop(self):
+        while True:
+            self.release(time.time() - self.delay)
+            await asyncio.sleep(self.send_every)
+
+    def release(self, until):
+        """ Send what was received before `until`, updates merged in one """
+        merged, tick = {}, None
+        while self.incoming and self.incoming[0][0] <= until:
+            _, msg = self.incoming.popleft()
+            code = msg['code']
+            if code == 'update':
+                merged.update(msg['state'])
+                tick = msg.get('tick', tick)
+                if self.state is not None:
+                    self.state.update(msg['state'])
+                continue
+            # keep the order between updates and anything else
+            if merged:
+                self.broadcast(merged_update(merged, tick))
+                merged, tick = {}, None
+            if code == 'lobby':
+                self.lobby = msg['players']
+            elif code == 'game_start':
+                self.state = dict(msg['state'])
+            elif code in ('welcome', 'ping', 'status'):
+                continue  # meant for the relay itself
+            self.broadcast(msg)
+        if merged:
+            self.broadcast(merged_update(merged, tick))
+
+    def broadcast(self, payload):
+        self.send(list(self.spectators), payload)
+
+    def send(self, addrs, payload):
+        if payload['code'] in CRITICAL:
+            now = time.time()
+            for msg in self.fragmenter.split(payload):
+                for addr in addrs:
+                    self.channel(addr).send(msg, now)
+                self.sent += len(addrs)
+            return
+        for data in self.fragmenter.encode(payload):
+            for addr in addrs:
+                self.transport.sendto(data, addr)
+            self.sent += len(addrs)
+
+    async def housekeeping(self):
+        last_beat = 0
+        while True:
+            now = time.time()
+            for channel in [self.upstream.channel, *self.channels.values()]:
+                channel.resend(now)
+            if now - last_beat > HEARTBEAT and self.upstream.transport:
+                last_beat = now
+                self.upstream.transport.sendto(
+                    json.dumps({'code': 'watching'}).encode())
+            for addr, seen in list(self.spectators.items()):
+                if now - seen > SPECTATOR_TIMEOUT:
+                    self.spectators.pop(addr)
+                    self.channels.pop(addr, None)
+            await asyncio.sleep(RESEND_EVERY)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', default=f'127.0.0.1:{DEFAULT_PORT}',
+                        help="game server host:port")
+    parser.add_argument('--port', type=int, default=RELAY_PORT,
+                        help="port spectators connect to")
+    parser.add_argument('--delay', type=float, default=DELAY)
+    parser.add_argument('--rate', type=float, default=1/SEND_EVERY,
+                        help="messages per second sent to spectators")
+    args = parser.parse_args()
+
+    host, _, port = args.server.partition(':')
+    relay = Relay((host, int(port or DEFAULT_PORT)), args.delay,
+                  1 / args.rate)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(loop.create_datagram_endpoint(
+        relay, local_addr=('0.0.0.0', args.port)))
+    print(f"Relaying {args.server} to spectators on port {args.port}")
+    loop.run_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+""" Acknowledged, ordered delivery of a few critical messages over UDP.
+
+Only messages whose code is listed as critical go through a channel, state
+updates stay fire-and-forget. A wrapped message carries `rseq`, its sequence
+number, and `repoch`, picked at random per channel so a restarted peer is
+not mistaken for duplicates. The receiver acks every copy it gets and hands
+messages over once, in order.
+"""
+import json
+import random
+
+# Server to client
+CRITICAL = {'game_start', 'pid', 'welcome', 'fatal', 'snapshot',
+            'redirect', 'resumed'}
+# Client to server
+CLIENT_CRITICAL = {'hi', 'ready', 'bye', 'spectate'}
+
+RESEND_EVERY = 0.02
+INITIAL_RTO = 0.2
+MIN_RTO = 0.05
+MAX_RTO = 2
+MAX_TRIES = 12
+
+
+class ReliableChannel:
+    def __init__(self, send_raw, resumed=False):
+        self.send_raw = send_raw
+        # resumed: we restarted but the peer didn't, its numbering goes on
+        self.resumed = resumed
+        self.epoch = random.getrandbits(31)
+        self.next_seq = 0
+        self.pending = {}  # seq -> [data, sent at, tries]
+        self.peer_epoch = None
+        self.expected = 0
+        self.held = {}  # seq -> message received ahead of its turn
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.failed = False
+
+    def send(self, payload, now):
+        seq = self.next_seq
+        self.next_seq += 1
+        data = json.dumps({**payload, 'rseq': seq,
+                           'repoch': self.epoch}).encode()
+        self.pending[seq] = [data, now, 1]
+        self.send_raw(data)
+
+    def on_ack(self, data, now):
+        if data.get('repoch') != self.epoch:
+            return
+        entry = self.pending.pop(data['rseq'], None)
+        # Karn: only measure messages which were not resent
+        if entry and entry[2] == 1:
+            self._rtt_sample(now - entry[1])
+
+    def _rtt_sample(self, rtt):
+        # RFC 6298
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    def receive(self, data):
+        """ Ack a wrapped message and return the ones now deliverable """
+        self.send_raw(json.dumps({'code': 'ack', 'rseq': data['rseq'],
+                                  'repoch': data['repoch']}).encode())
+        if data['repoch'] != self.peer_epoch:
+            # new peer (or restarted one), start over
+            adopt = self.resumed and self.peer_epoch is None
+            self.peer_epoch = data['repoch']
+            self.expected = data['rseq'] if adopt else 0
+            self.held = {}
+
+        seq = data['rseq']
+        if seq < self.expected or seq in self.held:
+            return []  # duplicate
+        self.held[seq] = data
+
+        ready = []
+        while self.expected in self.held:
+            ready.append(self.held.pop(self.expected))
+            self.expected += 1
+        return ready
+
+    def restart(self, now):
+        """ The peer starts over with a new channel: what it didn't ack
+        yet is sent again, numbered from 0 in a new epoch """
+        unacked = [json.loads(self.pending[seq][0])
+                   for seq in sorted(self.pending)]
+        self.epoch = random.getrandbits(31)
+        self.next_seq = 0
+        self.pending = {}
+        self.failed = False
+        for payload in unacked:
+            del payload['rseq'], payload['repoch']
+            self.send(payload, now)
+
+    def resend(self, now):
+        for seq, entry in list(self.pending.items()):
+            data, sent, tries = entry
+            if now - sent < min(MAX_RTO, self.rto * 2 ** (tries - 1)):
+                continue
+            if tries >= MAX_TRIES:
+                self.failed = True
+                self.pending.pop(seq)
+                continue
+            entry[1], entry[2] = now, tries + 1
+            self.send_raw(data)
+
+    @property
+    def idle(self):
+        return not self.pending
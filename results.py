@@ -0,0 +1,173 @@
+""" Match results, queued in memory and written to SQLite in batches.
+
+`ResultStore.record` only appends to a queue, so the tick that ends a match
+never waits on the disk. A background task hands whatever is queued to a
+writer thread every few seconds, one transaction per batch.
+`python results.py results.db` prints the leaderboard.
+"""
+import argparse
+import asyncio
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+FLUSH_EVERY = 5
+MAX_BATCH = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS matches (
+    id INTEGER PRIMARY KEY,
+    ended_at REAL NOT NULL,
+    level TEXT NOT NULL,
+    duration REAL NOT NULL,
+    winner TEXT
+);
+CREATE TABLE IF NOT EXISTS player_results (
+    match_id INTEGER NOT NULL REFERENCES matches(id),
+    name TEXT NOT NULL,
+    bot INTEGER NOT NULL,
+    won INTEGER NOT NULL,
+    bombs INTEGER NOT NULL,
+    walls_broken INTEGER NOT NULL,
+    pickups INTEGER NOT NULL,
+    survival REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS matches_ended_at ON matches(ended_at);
+CREATE INDEX IF NOT EXISTS player_results_match
+    ON player_results(match_id);
+-- leaderboards: per player totals, and the best single survivals
+CREATE INDEX IF NOT EXISTS player_results_name
+    ON player_results(name, won, survival);
+CREATE INDEX IF NOT EXISTS player_results_survival
+    ON player_results(survival DESC);
+"""
+
+LEADERBOARD = """
+SELECT name, COUNT(*) AS matches, SUM(won) AS wins,
+       AVG(survival) AS survival, SUM(bombs) AS bombs,
+       SUM(walls_broken) AS walls, SUM(pickups) AS pickups
+FROM player_results
+WHERE bot = 0 OR ?
+GROUP BY name
+ORDER BY wins DESC, survival DESC
+LIMIT ?
+"""
+
+
+def match_result(gs, level, bots=()):
+    """ The record of a match which just ended """
+    end = gs.clock()
+    survivors = [name for name, p in gs.players.items() if p.alive]
+    winner = survivors[0] if len(survivors) == 1 else None
+    return {
+        'ended_at': time.time(),
+        'level': level,
+        'duration': end - gs.started_at,
+        'winner': winner,
+        'players': [{
+            'name': name,
+            'bot': name in bots,
+            'won': name == winner,
+            'bombs': gs.player_stats[name]['bombs'],
+            'walls_broken': gs.player_stats[name]['walls_broken'],
+            'pickups': gs.player_stats[name]['pickups'],
+            'survival': gs.deaths.get(name, end) - gs.started_at,
+        } for name in gs.players],
+    }
+
+
+def connect(path):
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    return db
+
+
+class ResultStore:
+    def __init__(self, path, flush_every=FLUSH_EVERY):
+        self.path = path
+        self.flush_every = flush_every
+        self.queue = deque()
+        # the connection lives in the writer thread
+        self.executor = ThreadPoolExecutor(1)
+        self.db = None
+        self.recorded = 0
+        self.written = 0
+        self.batches = 0
+        self.flush_time = 0  # last batch
+        self.flush_time_max = 0
+
+    def record(self, result):
+        self.queue.append(result)
+        self.recorded += 1
+
+    async def flush_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.flush_every)
+            await self.flush(loop)
+
+    async def flush(self, loop):
+        while self.queue:
+            batch = [self.queue.popleft()
+                     for _ in range(min(MAX_BATCH, len(self.queue)))]
+            try:
+                duration = await loop.run_in_executor(
+                    self.executor, self.write, batch)
+            except sqlite3.Error as e:
+                print(f"Couldn't write results: {e}")
+                self.queue.extendleft(reversed(batch))  # next time
+                return
+            self.written += len(batch)
+            self.batches += 1
+            self.flush_time = duration
+            self.flush_time_max = max(self.flush_time_max, duration)
+
+    def write(self, batch):
+        """ One transaction for the whole batch, runs in the writer thread """
+        t0 = time.perf_counter()
+        if self.db is None:
+            self.db = connect(self.path)
+        with self.db:
+            for r in batch:
+                match_id = self.db.execute(
+                    'INSERT INTO matches (ended_at, level, duration, winner) '
+                    'VALUES (?, ?, ?, ?)',
+                    (r['ended_at'], r['level'], r['duration'], r['winner']),
+                ).lastrowid
+                self.db.executemany(
+                    'INSERT INTO player_results '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(match_id, p['name'], p['bot'], p['won'], p['bombs'],
+                      p['walls_broken'], p['pickups'], p['survival'])
+                     for p in r['players']])
+        return time.perf_counter() - t0
+
+    def dump(self):
+        return {'queued': len(self.queue), 'recorded': self.recorded,
+                'written': self.written, 'batches': self.batches,
+                'flush_time': self.flush_time,
+                'flush_time_max': self.flush_time_max}
+
+
+def leaderboard(path, limit=20, bots=False):
+    return connect(path).execute(LEADERBOARD, (bots, limit)).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Match results leaderboard")
+    parser.add_argument('db')
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--bots', action='store_true',
+                        help="rank the server's bots too")
+    args = parser.parse_args()
+    print(f"{'name':<16} {'matches':>7} {'wins':>5} {'survival':>8} "
+          f"{'bombs':>6} {'walls':>6} {'pickups':>7}")
+    for name, matches, wins, survival, bombs, walls, pickups in \
+            leaderboard(args.db, args.limit, args.bots):
+        print(f"{name:<16} {matches:>7} {wins:>5} {survival:>8.1f} "
+              f"{bombs:>6} {walls:>6} {pickups:>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+""" State updates sent at a per-client rate, decoupled from the tick.
+
+The simulation keeps producing updates every tick, they are logged here
+merged per tick. Each client gets, when its own send period has elapsed, one
+message with everything that changed since the last one it got. The period
+adapts to the client: it shrinks while the link is fine and grows back on
+loss or backlog, a long RTT also caps the rate.
+"""
+from collections import deque
+
+MIN_RATE = 10
+MAX_RATE = 60
+# Additive increase, multiplicative decrease, once per ping
+RATE_STEP = 5
+RATE_BACKOFF = 0.75
+LOSS_LIMIT = 0.05
+BACKLOG_LIMIT = 4
+# RTT from which sending faster doesn't make the game feel any better
+FAST_RTT = 0.1
+# Ping loss is averaged over that many pings
+LOSS_SMOOTHING = 0.2
+
+
+class UpdateLog:
+    """ The update state of the last ticks, merged per tick """
+
+    def __init__(self, size=MAX_RATE):
+        self.tick = 0
+        self.ticks = deque(maxlen=size)  # (tick, state)
+        self.forgotten = -1  # last tick no longer in the log
+
+    def add(self, state):
+        if self.ticks and self.ticks[-1][0] == self.tick:
+            self.ticks[-1][1].update(state)
+            return
+        if len(self.ticks) == self.ticks.maxlen:
+            self.forgotten = self.ticks[0][0]
+        self.ticks.append((self.tick, dict(state)))
+
+    def close_tick(self):
+        self.tick += 1
+
+    def since(self, tick):
+        """ Everything which changed after tick, or None if it's too old """
+        if tick < self.forgotten:
+            return None
+        # from the end, the log can be much longer than what is missed
+        missed = []
+        for t, state in reversed(self.ticks):
+            if t <= tick:
+                break
+            missed.append(state)
+        merged = {}
+        for state in reversed(missed):
+            merged.update(state)
+        return merged
+
+    def clear(self):
+        self.ticks.clear()
+        self.forgotten = self.tick - 1
+
+
+class SendScheduler:
+    """ When to send updates to one client, and how often """
+
+    def __init__(self, tick, min_rate=MIN_RATE, max_rate=MAX_RATE):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.last_tick = tick  # last tick the client got updates for
+        self.last_sent = 0
+        self.rtt = None
+        self.loss = 0
+        self.backlog = 0
+        self.outstanding = set()  # timestamps of unanswered pings
+        self.sent = 0
+
+    def due(self, now):
+        return now - self.last_sent >= 1 / self.rate
+
+    def sent_until(self, tick, now):
+        self.last_tick = tick
+        self.last_sent = now
+        self.sent += 1
+
+    def on_ping(self, t):
+        """ A ping is sent with timestamp t, the previous ones are lost
+        if still unanswered """
+        lost = len(self.outstanding)
+        if lost or self.rtt is not None:
+            sample = min(1, lost)
+            self.loss += LOSS_SMOOTHING * (sample - self.loss)
+        self.outstanding = {t}
+        if lost:
+            self.adapt()  # no pong is coming to do it
+
+    def on_pong(self, t, now, backlog=0):
+        if t not in self.outstanding:
+            return  # late, already counted as lost
+        self.outstanding.discard(t)
+        rtt = now - t
+        self.rtt = rtt if self.rtt is None else 0.875 * self.rtt + 0.125 * rtt
+        self.backlog = backlog
+        self.adapt()
+
+    def adapt(self):
+        if self.loss > LOSS_LIMIT or self.backlog > BACKLOG_LIMIT:
+            rate = self.rate * RATE_BACKOFF
+        else:
+            rate = self.rate + RATE_STEP
+        if self.rtt and self.rtt > FAST_RTT:
+            rate = min(rate, self.max_rate * FAST_RTT / self.rtt)
+        self.rate = max(self.min_rate, min(self.max_rate, rate))
+
+    def dump(self):
+        return {'rate': self.rate, 'rtt': self.rtt, 'loss': self.loss,
+                'backlog': self.backlog, 'sent': self.sent}
@@ -1,11 +1,32 @@
+import argparse
 import asyncio
 import json  # TODO ujson
+import random
+import signal
 import time
 
+import fastio
+import persist
 from bomb import GameState, load_level, action, Effect
+from bot import Bots
+from gctick import GCMonitor, GCControl
+from lockstep import Lockstep, InputLog, Steering, INPUTS, STEERING, \
+    HASH_EVERY
+from profiler import SamplingProfiler
+from ratelimit import InboundGuard, RATE
+from reliable import ReliableChannel, CRITICAL, RESEND_EVERY
+from results import ResultStore, match_result
+from sendrate import UpdateLog, SendScheduler, MIN_RATE, MAX_RATE
+from sessions import Sessions, SILENT, HISTORY
+from simproc import SimLink, update_message
+from snapshot import Fragmenter, MAX_PAYLOAD
+from stats import TickStats
+from tracing import Tracer, NULL_TRACER
 
 MAX_CLIENTS = 4
 DEFAULT_PORT = 1888
+# Spectators (normally relay.py processes) silent for that long are dropped
+SPECTATOR_TIMEOUT = 10
 
 
 class Server:
@@ -13,63 +34,375 @@ class Server:
     # if to big, well... less reactive.
     TICK = 1/60
 
-    def __init__(self):
+    def __init__(self, port=DEFAULT_PORT, bots=0, soak=False,
+                 level='map1.txt', fast_io=False, lockstep=False,
+                 min_rate=MIN_RATE, max_rate=MAX_RATE, rate_limit=RATE,
+                 split=False, snapshot=None,
+                 snapshot_every=persist.SNAPSHOT_EVERY, results=None,
+                 gc_control=False, tick_rate=None, trace=False):
+        self.port = port
+        if tick_rate:
+            self.TICK = 1 / tick_rate
+        # trace: spans of the ticks' phases, see tracing
+        self.tracer = Tracer(f'server :{port}') if trace else NULL_TRACER
+        # gc_control: no automatic collections, only between ticks
+        self.gc = GCControl() if gc_control else GCMonitor()
+        self.gc.tracer = self.tracer
+        # results: SQLite file match results are written to
+        self.results = results and ResultStore(results)
+        self.recorded = False
+        # snapshot: the match is saved there, and resumed from it on start
+        self.persist = snapshot and persist.SnapshotWriter(snapshot,
+                                                           snapshot_every)
+        # split: the game runs in another process, see simproc
+        self.link = SimLink(self.TICK, gc_control) if split else None
+        self.snapshot_waiting = []
+        # lockstep: only relay inputs, clients simulate the game themselves
+        self.lockstep = lockstep
+        self.sim = None
+        self.inputs = InputLog()
+        # fast_io: sends are queued and flushed once per tick
+        self.fast_io = fast_io
+        self.received = 0
+        self.guard = InboundGuard(rate_limit, burst=rate_limit // 2)
+        self.level = level
+        # soak: bots only, start right away and restart when it's over
+        self.soak = soak
         self.started = False
         self.clients = {}
+        # players who drop out of a match can come back, see sessions
+        self.sessions = Sessions()
         self.ping_res = {}
         self.lobby_status = {}
+        self.spectators = {}  # addr -> last seen
+        self.channels = {}
+        self.fragmenter = Fragmenter()
+        # updates go out at each recipient's own rate, between min and max
+        self.updates = UpdateLog(int(HISTORY / self.TICK))
+        self.schedulers = {}  # addr -> SendScheduler
+        self.min_rate, self.max_rate = min_rate, max_rate
         self.actions = asyncio.Queue()
+        self.steering = Steering()
         self.game = GameState()
+        self.profiler = SamplingProfiler()
+        self.tick_stats = TickStats(self.TICK)
+        self.bots = Bots(self.game)
+        for i in range(bots):
+            self.add_bot(f'bot{i + 1}')
 
     def __call__(self):
         return self
 
     def connection_made(self, transport):
-        self.transport = transport
+        self.transport = fastio.BatchedTransport(transport, self.fast_io)
         print("Connection ready")
         self.last_time = time.time()
         loop = asyncio.get_event_loop()
         loop.create_task(self.action_loop())
         loop.create_task(self.ping_clients())
+        loop.create_task(self.resend_loop())
+        self.install_signals(loop)
+        snap = self.persist and persist.read(self.persist.path)
+        if snap:
+            self.resume(snap)
+        elif self.soak:
+            self.start_game()
+        if self.persist:
+            loop.create_task(self.snapshot_loop())
+        if self.results:
+            loop.create_task(self.results.flush_loop())
+
+    def install_signals(self, loop):
+        # SIGUSR1 toggles the profiler, SIGUSR2 also snapshots allocations
+        try:
+            loop.add_signal_handler(signal.SIGUSR1, self.profiler.toggle)
+            loop.add_signal_handler(signal.SIGUSR2, self.profiler.toggle,
+                                    True)
+            loop.add_signal_handler(signal.SIGTERM, self.terminate, loop)
+        except (AttributeError, NotImplementedError, RuntimeError):
+            pass  # no signals here (Windows, or not the main thread)
+
+    def terminate(self, loop):
+        """ SIGTERM: atexit doesn't run then, stop the simulation here """
+        print("Terminated")
+        if self.link:
+            self.link.close()
+        loop.stop()
 
     async def action_loop(self):
+        tick_start = time.time()
         while True:
             now = time.time()
             dt = now - self.last_time
-
-            # first, game tick, which is an action
-            self.actions.put_nowait(self.game.tick)
-
-            # then queued actions
-            # better to handle all queued actions in the same tick
-            pull = True
-            while pull:
-                try:
-                    action = self.actions.get_nowait()
-                except asyncio.QueueEmpty:
-                    pull = False
+            interval, tick_start = now - tick_start, now
+            self.gc.tick_start()
+
+            span = self.tracer.span
+            with span('tick', {'tick': self.tick_stats.ticks}):
+                if self.sim:
+                    with span('lockstep'):
+                        self.lockstep_tick()
+                elif self.link:
+                    with span('poll'):
+                        self.link.poll(self)
+                    with span('send_updates'):
+                        self.send_updates(now)
                 else:
-                    effect = action(dt)
-                    self.propagate(effect)
+                    with span('simulate'):
+                        self.simulate(dt)
+                    with span('send_updates'):
+                        self.send_updates(now)
+                self.updates.close_tick()
+                with span('flush'):
+                    self.transport.flush()
             self.last_time = time.time()
             pt = self.last_time - now
-            await asyncio.sleep(self.TICK - pt)
+            self.gc.tick_end()
+            self.tick_stats.record(interval, pt)
+            if self.started and not self.link and not self.game.running \
+                    and not self.recorded:
+                self.record_result(
+                    match_result(self.game, self.level, self.bots))
+            if self.soak and self.started and not self.running:
+                self.started = False
+                loop = asyncio.get_event_loop()
+                loop.call_later(3, self.restart_game)
+            self.gc.idle(self.TICK - pt)
+            await asyncio.sleep(self.TICK - (time.time() - now))
+
+    async def snapshot_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.persist.every)
+            if self.clients or self.started:
+                # copied here between two ticks, written by another thread
+                self.persist.save(loop, self.checkpoint())
+
+    def record_result(self, result):
+        """ Queued only, the store writes it later """
+        self.recorded = True
+        if self.results:
+            self.results.record(result)
+
+    def checkpoint(self):
+        now = time.time()
+        return {
+            'saved_at': now,
+            'level': self.level,
+            'started': self.started,
+            'clients': dict(self.clients),
+            'sessions': dict(self.sessions.tokens),
+            'lobby': dict(self.lobby_status),
+            'bots': list(self.bots),
+            'game': self.started and persist.capture_game(self.game, now),
+        }
+
+    def resume(self, snap):
+        """ Pick up the match of a snapshot, its players' addresses are
+        known again right away """
+        now = time.time()
+        self.level = snap['level']
+        for name in snap['bots']:
+            if name not in self.bots:
+                self.bots.add(name)
+        self.lobby_status = snap['lobby']
+        self.sessions.restore(snap.get('sessions', {}))
+        for name, addr in snap['clients'].items():
+            addr = tuple(addr)
+            self.clients[name] = addr
+            self.scheduler(addr)
+            self.ping_res[name] = now, 0
+            self.channel(addr, resumed=True)
+        if snap['started']:
+            self.started = True
+            self.game = persist.restore_game(snap['game'], now)
+            self.game.tracer = self.tracer
+            self.bots.set_game(self.game)
+            self.broadcast(self.game_start())
+            self.gc.freeze()
+        else:
+            for name, addr in self.clients.items():
+                self.send(addr, {'code': 'welcome', 'name': name,
+                                 'token': self.sessions.tokens.get(name)})
+            self.broadcast_lobby()
+        print(f"Resumed from {self.persist.path} "
+              f"({now - snap['saved_at']:.1f}s old) with "
+              f"{', '.join(self.clients) or 'no players'}")
+
+    def simulate(self, dt):
+        # first, game tick, which is an action
+        self.actions.put_nowait(self.game.tick)
+        with self.tracer.span('bots'):
+            for a in self.bots.actions(self.game.clock()):
+                self.actions.put_nowait(a)
+
+        # then queued actions
+        # better to handle all queued actions in the same tick
+        pull = True
+        while pull:
+            try:
+                action = self.actions.get_nowait()
+            except asyncio.QueueEmpty:
+                pull = False
+            else:
+                effect = action(dt)
+                self.propagate(effect)
+        for action in self.steering.actions(dt):
+            self.propagate(action(dt))
+
+    def lockstep_tick(self):
+        if not self.game.running:
+            return
+        for pname, msg in self.bots.messages(self.game.clock()):
+            self.inputs.add(pname, msg)
+        inputs = self.inputs.pending
+        effects = self.sim.step(inputs)
+        tick = self.sim.tick
+        self.inputs.close_tick(
+            tick, self.sim.hash() if tick % HASH_EVERY == 0 else None)
+        self.broadcast(self.inputs.message(tick))
+        # peers compute updates themselves, anything else is news for them
+        self.propagate([e for e in effects if e['code'] != 'update'])
+
+    def send_updates(self, now):
+        """ Send what changed to every recipient whose turn it is """
+        tick = self.updates.tick
+        # recipients last served at the same tick get the same message
+        groups = {}
+        for addr in [*self.clients.values(), *self.spectators]:
+            s = self.schedulers.get(addr)
+            if s and s.last_tick < tick and s.due(now):
+                groups.setdefault(s.last_tick, []).append(addr)
+
+        for since, addrs in groups.items():
+            state = self.updates.since(since)
+            if state is None:
+                # too far behind, everything
+                if self.link:
+                    self.snapshot_waiting += addrs
+                    self.link.request_snapshot()
+                    continue
+                state = self.game.dump()
+            for addr in addrs:
+                if state:
+                    self.schedulers[addr].sent_until(tick, now)
+                else:
+                    self.schedulers[addr].last_tick = tick
+            if state and self.link:
+                self.send_encoded(addrs, update_message(state, tick))
+            elif state:
+                self.send_many(addrs, {'code': 'update', 'tick': tick,
+                                       'state': state})
+            for addr in addrs:
+                if addr in self.sessions.waiting:
+                    self.sessions.served(addr, time.time(),
+                                         full=since < self.updates.forgotten)
+
+    def send_encoded(self, addrs, data):
+        """ Send a message the simulation process encoded already """
+        if len(data) > MAX_PAYLOAD:
+            for msg in self.fragmenter.split_encoded(data):
+                self.send_many(addrs, msg)
+            return
+        for addr in addrs:
+            self.transport.sendto(data, addr)
+
+    def send_split_snapshot(self, msg):
+        addrs, self.snapshot_waiting = self.snapshot_waiting, []
+        for addr in set(addrs):
+            if addr in self.schedulers:
+                # updates of this tick may be newer than the snapshot
+                self.schedulers[addr].last_tick = self.updates.tick - 1
+                self.send(addr, msg)
+                if addr in self.sessions.waiting:
+                    self.sessions.served(addr, time.time(), full=True)
+
+    def scheduler(self, addr):
+        self.schedulers[addr] = SendScheduler(
+            self.updates.tick - 1, self.min_rate, self.max_rate)
+
+    def send_snapshot(self, addr):
+        self.send(addr, {'code': 'snapshot', 'sim': self.sim.snapshot()})
 
     async def ping_clients(self):
         while True:
             now = time.time()
             for name, addr in self.clients.items():
+                if name in self.sessions.away:
+                    continue
                 self.send(addr, {'code': 'ping', 't': now})
+                if addr in self.schedulers:
+                    self.schedulers[addr].on_ping(now)
 
             # casting to a list as ping_res will be changed sometimes
             for name, (last_seen, ping) in list(self.ping_res.items()):
-                if now - last_seen > 5:
-                    print(f"Kicking inactive player {name}...")
-                    self.remove_player(name)
+                silent = now - last_seen
+                if silent <= SILENT:
+                    continue
+                if self.started and silent <= self.sessions.window:
+                    # kept in the match, the client may resume
+                    if self.sessions.leave(name, last_seen):
+                        print(f"Player {name} is away...")
+                    continue
+                print(f"Kicking inactive player {name}...")
+                self.remove_player(name)
+            self.guard.prune(now)
+            for addr, last_seen in list(self.spectators.items()):
+                if now - last_seen > SPECTATOR_TIMEOUT:
+                    print(f"Dropping spectator {addr}")
+                    self.spectators.pop(addr)
+                    self.channels.pop(addr, None)
+                    self.schedulers.pop(addr, None)
             await asyncio.sleep(1)
 
+    async def resend_loop(self):
+        while True:
+            now = time.time()
+            away = {self.clients[name] for name in self.sessions.away}
+            known = {*self.clients.values(), *self.spectators}
+            for addr, channel in list(self.channels.items()):
+                if addr in away:
+                    continue  # kept for when they resume
+                channel.resend(now)
+                # e.g. the fatal reply to a refused hi, delivered or not
+                if channel.idle and addr not in known:
+                    self.channels.pop(addr)
+            await asyncio.sleep(RESEND_EVERY)
+
+    def channel(self, addr, resumed=False):
+        if addr not in self.channels:
+            self.channels[addr] = ReliableChannel(
+                lambda data: self.transport.sendto(data, addr), resumed)
+        return self.channels[addr]
+
     def datagram_received(self, data, addr):
-        data = json.loads(data.decode())
+        with self.tracer.span('receive'):
+            self.receive(data, addr)
+
+    def receive(self, data, addr):
+        self.received += 1
+        # every player and spectator has a scheduler, and the acks of
+        # messages to anyone else are welcome
+        known = addr in self.schedulers or addr in self.channels
+        if self.guard.check(data, addr, known, time.time()):
+            return
+        # data may be a memoryview of a reused buffer, decode it right away
+        try:
+            data = json.loads(str(data, 'utf-8'))
+            code = data['code']
+        except (ValueError, TypeError, KeyError):
+            self.guard.reject('malformed')
+            return
+        if code == 'ack':
+            if addr in self.channels:
+                self.channels[addr].on_ack(data, time.time())
+        elif 'rseq' in data:
+            for msg in self.channel(addr).receive(data):
+                self.handle(msg, addr)
+        else:
+            self.handle(data, addr)
+
+    def handle(self, data, addr):
         code = data['code']
         if code == 'hi':
             if not self.open:
@@ -79,15 +412,42 @@ class Server:
             # TODO will need to manage existing names
             print(f"New player: {name}")
             self.clients[name] = addr
+            self.scheduler(addr)
             self.lobby_status[name] = False
-            self.send(addr, {'code': 'welcome', 'name': name})
+            self.send(addr, {'code': 'welcome', 'name': name,
+                             'token': self.sessions.open(name)})
             self.broadcast_lobby()
 
+        elif code == 'resume':
+            self.resume_player(addr, data.get('token'), data.get('tick'))
+
+        elif code == 'spectate':
+            # no player slot, gets everything players get
+            print(f"New spectator: {addr}")
+            self.spectators[addr] = time.time()
+            self.scheduler(addr)
+            self.send(addr, {'code': 'welcome', 'name': None})
+            self.send(addr, {'code': 'lobby', 'players': self.lobby_status})
+            if self.started and self.link:
+                self.snapshot_waiting.append(addr)
+                self.link.request_snapshot()
+            elif self.started:
+                self.send(addr, self.game_start())
+        elif code == 'watching':
+            if addr in self.spectators:
+                self.spectators[addr] = time.time()
         elif code == 'ping':
             name = self.get_player_name(addr)
+            if name is None:
+                return  # a spectator, or a player just dropped
             now = time.time()
             ping = now - data['t']
             self.ping_res[name] = now, ping
+            self.sessions.away.pop(name, None)  # back without resuming
+            if addr in self.schedulers:
+                channel = self.channels.get(addr)
+                self.schedulers[addr].on_pong(
+                    data['t'], now, len(channel.pending) if channel else 0)
             self.broadcast({'code': 'status', 'players': self.ping_res})
         elif code == 'ready':
             name = self.get_player_name(addr)
@@ -95,39 +455,204 @@ class Server:
             self.broadcast_lobby()
             if all(self.lobby_status.values()):
                 self.start_game()
+        elif code == 'admin':
+            self.admin(addr, data)
         elif code == 'bye':
             name = self.get_player_name(addr)
             print(f"Player leaving: {name}")
             self.remove_player(name)
+        elif code == 'hash':
+            if self.sim and not self.inputs.check(data['tick'], data['h']):
+                print(f"Desync of {self.get_player_name(addr)} "
+                      f"at tick {data['tick']}")
+                self.send_snapshot(addr)
+        elif code == 'resync':
+            if self.sim:
+                self.send_snapshot(addr)
+        elif self.sim:
+            player = self.get_player_name(addr)
+            if player and code in INPUTS and self.game.running:
+                self.inputs.add(player, data)
+        elif self.link:
+            player = self.get_player_name(addr)
+            if player and code in INPUTS:
+                self.link.send_input(player, data)
         else:
             player = self.get_player_name(addr)
             a = action(self.game, player, data)
-            if a:
+            if a and code in STEERING:
+                self.steering.add(player, code, a)
+            elif a:
                 self.actions.put_nowait(a)
 
+    def resume_player(self, addr, token, tick):
+        """ A player back from a dropped connection, maybe from another
+        address: updates since tick will catch it up """
+        now = time.time()
+        name = self.sessions.names.get(token)
+        if name is None or name not in self.clients:
+            return self.send_error(addr, 'fatal', 'Session expired')
+        old = self.clients[name]
+        if old == addr and name not in self.sessions.away:
+            return  # a retry, 'resumed' is on its way
+        if tick is None or tick >= self.updates.tick:
+            tick = self.updates.tick - 1
+        missed = self.updates.tick - 1 - tick
+        self.sessions.resume(token, addr, missed, now)
+        print(f"Player {name} resumes, {missed} ticks behind")
+
+        channel = self.channels.pop(old, None)
+        self.channels.pop(addr, None)
+        self.schedulers.pop(old, None)
+        self.clients[name] = addr
+        self.ping_res[name] = now, self.ping_res.get(name, (0, 0))[1]
+        if channel:
+            # the client starts a new channel, what it didn't ack yet is
+            # sent again, numbered afresh as well
+            channel.send_raw = self.channel(addr).send_raw
+            self.channels[addr] = channel
+            channel.restart(now)
+        self.schedulers[addr] = SendScheduler(tick, self.min_rate,
+                                              self.max_rate)
+        self.send(addr, {'code': 'resumed', 'name': name,
+                         'tick': self.updates.tick - 1, 'missed': missed})
+        if self.sim:
+            self.send_snapshot(addr)
+            self.sessions.served(addr, time.time(), full=True)
+        elif not self.started:
+            self.send(addr, {'code': 'lobby', 'players': self.lobby_status})
+            self.sessions.served(addr, time.time())
+
+    def admin(self, addr, data):
+        # admin commands are only accepted from the local machine
+        if addr[0] not in ('127.0.0.1', '::1'):
+            return
+        cmd = data.get('cmd')
+        if cmd == 'profile':
+            writing = self.profiler.toggle(data.get('memory', False))
+            if writing is None:
+                self.reply(addr, {'code': 'admin', 'cmd': cmd,
+                                  'running': self.profiler.running,
+                                  'files': []})
+                return
+
+            def written(future):
+                reply = {'error': str(future.exception())} \
+                    if future.exception() else {'files': future.result()}
+                self.reply(addr, {'code': 'admin', 'cmd': cmd,
+                                  'running': self.profiler.running, **reply})
+            writing.add_done_callback(written)
+        elif cmd == 'trace':
+            self.write_trace(addr, data.get('seconds'), data.get('slow'))
+        elif cmd == 'stats':
+            sim = self.link.stats if self.link else {}
+            self.reply(addr, {'code': 'admin', 'cmd': cmd,
+                              'players': len(self.clients),
+                              'started': self.started,
+                              # with --split, the network loop's ticks
+                              'io_tick': self.tick_stats.dump(),
+                              'tick': sim.get('tick', self.tick_stats.dump()),
+                              'bots': sim.get('bots', self.bots.dump_stats()),
+                              'sim_cpu': sim.get('cpu'),
+                              'gc': sim.get('gc', self.gc.dump()),
+                              'io_gc': self.gc.dump(),
+                              'send': {name: self.schedulers[addr].dump()
+                                       for name, addr in self.clients.items()
+                                       if addr in self.schedulers},
+                              'inbound': self.guard.dump(),
+                              'sessions': self.sessions.dump(),
+                              'snapshots': self.persist and
+                              self.persist.dump(),
+                              'results': self.results and
+                              self.results.dump(),
+                              'io': {'received': self.received,
+                                     'sent': self.transport.sent,
+                                     'cpu': time.process_time()}})
+
+    def write_trace(self, addr, seconds, slow):
+        """ Spans are picked here, written by a thread """
+        if not self.tracer.enabled:
+            self.reply(addr, {'code': 'admin', 'cmd': 'trace',
+                              'error': 'Not tracing, start with --trace'})
+            return
+        events = self.tracer.select(seconds, slow)
+
+        def written(future):
+            if future.exception():
+                reply = {'error': str(future.exception())}
+            else:
+                reply = {'file': future.result(), 'spans': len(events)}
+            self.reply(addr, {'code': 'admin', 'cmd': 'trace', **reply})
+        loop = asyncio.get_event_loop()
+        loop.run_in_executor(None, self.tracer.write, events) \
+            .add_done_callback(written)
+
     @property
     def open(self):
-        return len(self.clients) < MAX_CLIENTS and not self.started
+        return len(self.clients) + len(self.bots) < MAX_CLIENTS \
+            and not self.started
+
+    def add_bot(self, name):
+        self.bots.add(name)
+        self.lobby_status[name] = True
 
     def start_game(self):
         self.started = True
-        self.game.set_level(*load_level('map1.txt'))
+        self.recorded = False
+        self.updates.clear()
+        for s in self.schedulers.values():
+            s.last_tick = self.updates.tick - 1
+        if self.link:
+            self.link.start([*self.clients, *self.bots], list(self.bots),
+                            self.level)
+            return
+        self.game.tracer = self.tracer
+        self.steering = Steering()  # moves of the previous game
+        if self.lockstep:
+            # before set_level, which reads the clock
+            self.sim = Lockstep(self.game, random.getrandbits(31), self.TICK)
+            self.inputs = InputLog()
+        self.game.set_level(*load_level(self.level))
         self.game.running = True
 
         for pname in self.clients:
             pid = self.game.spawn_player(pname)
             self.send(self.clients[pname],  # maybe useless
                       {'code': 'pid', 'pid': pid})
+        for pname in self.bots:
+            self.game.spawn_player(pname)
+
+        self.broadcast(self.game_start())
+        self.gc.freeze()
 
-        self.broadcast({'code': 'game_start',
-                        'state': self.game.dump()})
+    def game_start(self):
+        msg = {'code': 'game_start', 'state': self.game.dump()}
+        if self.sim:
+            msg['sim'] = self.sim.snapshot()
+        return msg
+
+    @property
+    def running(self):
+        return self.link.running if self.link else self.game.running
+
+    def restart_game(self):
+        self.game = GameState()
+        self.bots.set_game(self.game)
+        self.start_game()
 
     def remove_player(self, name):
         if name not in self.clients:
             return
         self.game.remove_player(name)
-        self.clients.pop(name)
-        self.ping_res.pop(name)
+        self.steering.forget(name)
+        if self.link:
+            self.link.leave(name)
+        self.sessions.close(name)
+        addr = self.clients.pop(name)
+        self.sessions.waiting.pop(addr, None)
+        self.channels.pop(addr, None)
+        self.schedulers.pop(addr, None)
+        self.ping_res.pop(name, None)
         self.lobby_status.pop(name)
         self.broadcast_lobby()
 
@@ -137,9 +662,15 @@ class Server:
                 return k
 
     def propagate(self, effect: Effect):
-        if effect:
+        if not effect:
+            return
+        with self.tracer.span('propagate'):
             for e in effect:
-                self.broadcast(e)
+                if e['code'] == 'update':
+                    # sent by send_updates, at each recipient's rate
+                    self.updates.add(e['state'])
+                else:
+                    self.broadcast(e)
 
     def broadcast_lobby(self):
         self.broadcast({'code': 'lobby',
@@ -150,10 +681,29 @@ class Server:
                         'state': self.game.dump(*fields)})
 
     def broadcast(self, payload):
-        for c in self.clients.values():
-            self.send(c, payload)
+        self.send_many([*self.clients.values(), *self.spectators], payload)
 
     def send(self, addr, payload):
+        self.send_many([addr], payload)
+
+    def send_many(self, addrs, payload):
+        if payload['code'] in CRITICAL:
+            now = time.time()
+            with self.tracer.span('send'):
+                for msg in self.fragmenter.split(payload):
+                    for addr in addrs:
+                        self.channel(addr).send(msg, now)
+            return
+        # encoded once for everybody
+        with self.tracer.span('encode'):
+            datagrams = self.fragmenter.encode(payload)
+        with self.tracer.span('send'):
+            for data in datagrams:
+                for addr in addrs:
+                    self.transport.sendto(data, addr)
+
+    def reply(self, addr, payload):
+        """ Admin replies go whole, to the local machine only """
         self.transport.sendto(json.dumps(payload).encode(), addr)
 
     def send_error(self, addr, level, text):
@@ -162,19 +712,77 @@ class Server:
                    'text': text})
 
 
-async def endpoint(loop):
+async def endpoint(loop, port=DEFAULT_PORT, **options):
+    if options.get('fast_io'):
+        return fastio.create_endpoint(loop, Server(port, **options),
+                                      '0.0.0.0', port)
     transport, protocol = await loop.create_datagram_endpoint(
-        Server(), local_addr=('0.0.0.0', DEFAULT_PORT)
+        Server(port, **options), local_addr=('0.0.0.0', port)
     )
 
 
-def start_server():
+def start_server(port=DEFAULT_PORT, **options):
+    if options.get('fast_io') and fastio.install_uvloop():
+        print("Using uvloop")
     loop = asyncio.get_event_loop()
 
     loop.run_until_complete(
-        asyncio.ensure_future(endpoint(loop), loop=loop))
+        asyncio.ensure_future(endpoint(loop, port, **options), loop=loop))
     loop.run_forever()
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Bomberweek game server")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--bots', type=int, default=0,
+                        help="fill that many slots with server side bots")
+    parser.add_argument('--soak', action='store_true',
+                        help="bots only: start at once and loop matches")
+    parser.add_argument('--level', default='map1.txt')
+    parser.add_argument('--fast-io', action='store_true',
+                        help="uvloop if installed, recv_into and "
+                        "batched sends")
+    parser.add_argument('--lockstep', action='store_true',
+                        help="relay inputs only, clients run the game")
+    parser.add_argument('--min-rate', type=float, default=MIN_RATE,
+                        help="updates per second to the slowest links")
+    parser.add_argument('--max-rate', type=float, default=MAX_RATE,
+                        help="updates per second to the best links")
+    parser.add_argument('--split', action='store_true',
+                        help="run the simulation in its own process")
+    parser.add_argument('--rate-limit', type=int, default=RATE,
+                        help="datagrams per second accepted from one "
+                        "address, 0 for no limit")
+    parser.add_argument('--snapshot', metavar='FILE',
+                        help="save the match there, and resume it from "
+                        "there on start")
+    parser.add_argument('--snapshot-every', type=float,
+                        default=persist.SNAPSHOT_EVERY, metavar='SECONDS')
+    parser.add_argument('--tick-rate', type=float, default=1 / Server.TICK,
+                        help="simulation ticks per second, 20 to 30 is "
+                        "enough and cheaper")
+    parser.add_argument('--gc-control', action='store_true',
+                        help="freeze the level at game start and only "
+                        "collect garbage between ticks")
+    parser.add_argument('--results', metavar='FILE',
+                        help="record match results in this SQLite file")
+    parser.add_argument('--trace', action='store_true',
+                        help="keep spans of the ticks' phases, written "
+                        "by tracing.py")
+    args = parser.parse_args()
+    if args.snapshot and (args.lockstep or args.split):
+        parser.error("--snapshot needs the game in the server process, "
+                     "not with --lockstep or --split")
+    return args
+
+
 if __name__ == '__main__':
-    start_server()
+    args = parse_args()
+    start_server(args.port, bots=args.bots, soak=args.soak,
+                 level=args.level, fast_io=args.fast_io,
+                 lockstep=args.lockstep, min_rate=args.min_rate,
+                 max_rate=args.max_rate, rate_limit=args.rate_limit,
+                 split=args.split, snapshot=args.snapshot,
+                 snapshot_every=args.snapshot_every, results=args.results,
+                 gc_control=args.gc_control, tick_rate=args.tick_rate,
+                 trace=args.trace)
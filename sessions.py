@@ -0,0 +1,88 @@
+""" Sessions which outlive a dropped connection.
+
+Every player gets a token with its welcome. A player who goes silent during
+a match is only marked away: the slot, the player in the game and the token
+are kept for `RESUME_WINDOW` seconds. Coming back, from the same address or
+a new one, the client sends `resume` with its token and the last tick it got
+updates for, and is sent what changed since that tick from the server's
+update log, which keeps the last `HISTORY` seconds. Only a player away for
+longer gets the whole state again.
+"""
+import secrets
+from collections import deque
+
+from stats import percentile
+
+# Silent players are away after that long, and kicked outside of a match
+SILENT = 5
+RESUME_WINDOW = 30
+# Seconds of updates kept for the players coming back
+HISTORY = 10
+
+
+class Sessions:
+    def __init__(self, window=RESUME_WINDOW, size=600):
+        self.window = window
+        self.tokens = {}  # name -> token
+        self.names = {}  # token -> name
+        self.away = {}  # name -> silent since
+        self.waiting = {}  # addr -> (resume received at, ticks missed)
+        self.latencies = deque(maxlen=size)  # resume to catch up sent
+        self.missed = deque(maxlen=size)
+        self.resumes = 0
+        self.full = 0  # came back too late for the update log
+        self.expired = 0
+
+    def open(self, name):
+        token = secrets.token_hex(8)
+        self.close(name)
+        self.tokens[name], self.names[token] = token, name
+        return token
+
+    def restore(self, tokens):
+        """ Tokens of a snapshot, {name: token} """
+        for name, token in tokens.items():
+            self.tokens[name], self.names[token] = token, name
+
+    def close(self, name):
+        token = self.tokens.pop(name, None)
+        self.names.pop(token, None)
+        if self.away.pop(name, None) is not None:
+            self.expired += 1
+
+    def leave(self, name, since):
+        """ Mark a silent player away, True the first time """
+        if name in self.away:
+            return False
+        self.away[name] = since
+        return True
+
+    def resume(self, token, addr, missed, now):
+        """ The player of token, now at addr, or None if unknown """
+        name = self.names.get(token)
+        if name is None:
+            return None
+        self.away.pop(name, None)
+        self.waiting[addr] = now, missed
+        self.resumes += 1
+        return name
+
+    def served(self, addr, now, full=False):
+        """ The catch up for a resumed address is sent """
+        received, missed = self.waiting.pop(addr)
+        self.latencies.append(now - received)
+        self.missed.append(missed)
+        self.full += full
+
+    def dump(self):
+        return {
+            'sessions': len(self.tokens),
+            'away': list(self.away),
+            'resumes': self.resumes,
+            'full': self.full,
+            'expired': self.expired,
+            'latency_p50': percentile(self.latencies, 0.5),
+            'latency_max': max(self.latencies, default=0),
+            'missed_p50': percentile(self.missed, 0.5),
+            'missed_max': max(self.missed, default=0),
+        }
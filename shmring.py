@@ -0,0 +1,90 @@
+""" Single producer, single consumer ring buffer in shared memory.
+
+Records are a 4 bytes length followed by the payload. The producer owns the
+head counter and the consumer the tail one, both only ever grow, so no lock
+is needed between the two processes. The payload is always written before
+the head is moved past it (x86 doesn't reorder stores).
+"""
+import struct
+from multiprocessing import shared_memory
+
+HEADER = 128  # head and tail on their own cache lines
+HEAD_AT, TAIL_AT = 0, 64
+COUNTER = struct.Struct('<Q')
+LENGTH = struct.Struct('<I')
+WRAP = 0xFFFFFFFF  # rest of the buffer is padding, go back to the start
+
+
+class ShmRing:
+    def __init__(self, name=None, capacity=1 << 22):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True,
+                                                  size=HEADER + capacity)
+            self.shm.buf[:HEADER] = bytes(HEADER)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.capacity = len(self.buf) - HEADER
+        self.dropped = 0
+
+    def _get(self, at):
+        return COUNTER.unpack_from(self.buf, at)[0]
+
+    def _set(self, at, value):
+        COUNTER.pack_into(self.buf, at, value)
+
+    def push(self, data):
+        """ Append a record, False (and dropped) if there is no room """
+        n = LENGTH.size + len(data)
+        if n > self.capacity // 2:
+            raise ValueError(f"Record of {len(data)} bytes is too big")
+        head, tail = self._get(HEAD_AT), self._get(TAIL_AT)
+        idx = head % self.capacity
+        pad = self.capacity - idx if self.capacity - idx < n else 0
+        if head + pad + n - tail > self.capacity:
+            self.dropped += 1
+            return False
+        if pad:
+            if pad >= LENGTH.size:
+                LENGTH.pack_into(self.buf, HEADER + idx, WRAP)
+            head += pad
+            idx = 0
+        at = HEADER + idx
+        LENGTH.pack_into(self.buf, at, len(data))
+        self.buf[at + LENGTH.size:at + n] = data
+        self._set(HEAD_AT, head + n)
+        return True
+
+    def consume(self, fn):
+        """ Call fn with a memoryview of every record available, return how
+        many there were. The views are only valid during the call. """
+        head, tail = self._get(HEAD_AT), self._get(TAIL_AT)
+        count = 0
+        try:
+            while tail < head:
+                idx = tail % self.capacity
+                left = self.capacity - idx
+                if left < LENGTH.size:
+                    tail += left
+                    continue
+                n, = LENGTH.unpack_from(self.buf, HEADER + idx)
+                if n == WRAP:
+                    tail += left
+                    continue
+                at = HEADER + idx + LENGTH.size
+                # a record which makes fn fail is skipped all the same
+                tail += LENGTH.size + n
+                count += 1
+                with self.buf[at:at + n] as view:
+                    fn(view)
+        finally:
+            # only now may the producer reuse the space
+            self._set(TAIL_AT, tail)
+        return count
+
+    def close(self, unlink=False):
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
@@ -0,0 +1,288 @@
+""" The game simulation in its own process, fed through shared memory.
+
+With `server.py --split`, the server process keeps the sockets, the lobby and
+all the JSON decoding, and forwards decoded inputs to a simulation process
+as a few bytes each over a `ShmRing`. The simulation process ticks the
+`GameState`, runs the bots, and publishes every tick the changed fields
+already JSON encoded on a second ring, which the server turns into update
+datagrams without decoding them. Each side gets its own core.
+"""
+import atexit
+import json
+import multiprocessing
+import struct
+import time
+
+from bomb import GameState, load_level, action
+from bot import Bots
+from gctick import GCMonitor, GCControl
+from lockstep import merge_effects, Steering, STEERING
+from results import match_result
+from shmring import ShmRing
+from snapshot import encode_cells
+from stats import TickStats
+
+# Server -> simulation
+OP_START = b's'
+OP_MOVE = b'm'
+OP_STOP = b'x'
+OP_BOMB = b'b'
+OP_LEAVE = b'l'
+OP_SNAPSHOT = b'r'
+OP_QUIT = b'q'
+# Simulation -> server
+OUT_UPDATE = b'U'
+OUT_EFFECT = b'E'
+OUT_START = b'S'
+OUT_SNAPSHOT = b'R'
+OUT_OVER = b'O'
+OUT_STATS = b'T'
+
+SLOT = struct.Struct('<B')
+MOVE = struct.Struct('<BB')
+FIELD = struct.Struct('<BI')
+STATS_EVERY = 1
+
+
+def encode_state(state):
+    """ Fields as (name, JSON bytes), cells in their compact form """
+    for k, v in state.items():
+        if k == 'cells':
+            yield 'cells_rle', json.dumps(encode_cells(v)).encode()
+        else:
+            yield k, json.dumps(v).encode()
+
+
+def encode_update(state):
+    out = [OUT_UPDATE]
+    for k, blob in encode_state(state):
+        name = k.encode()
+        out += [FIELD.pack(len(name), len(blob)), name, blob]
+    return b''.join(out)
+
+
+def decode_update(view):
+    """ {field: JSON bytes} of an OUT_UPDATE record """
+    fields, at = {}, 1
+    while at < len(view):
+        n, size = FIELD.unpack_from(view, at)
+        at += FIELD.size
+        name = bytes(view[at:at + n]).decode()
+        at += n
+        # copied out of the ring, it may have to wait a few ticks
+        fields[name] = bytes(view[at:at + size])
+        at += size
+    return fields
+
+
+def update_message(fields, tick):
+    """ The encoded update message of {field: JSON bytes} """
+    return b''.join([
+        b'{"code": "update", "tick": %d, "state": {' % tick,
+        b', '.join(b'"%s": %s' % (k.encode(), v) for k, v in fields.items()),
+        b'}}',
+    ])
+
+
+class Simulation:
+    def __init__(self, outputs: ShmRing, tick, gc_control=False):
+        self.outputs = outputs
+        self.tick = tick
+        self.tick_stats = TickStats(tick)
+        self.gc = GCControl() if gc_control else GCMonitor()
+        self.game = GameState()
+        self.bots = Bots(self.game)
+        self.names = []
+        self.level = None
+        self.backlog = []
+        self.pending = []  # actions of this tick
+        self.steering = Steering()
+        self.quit = False
+        self.orphaned = False  # the server died without saying so
+        self.last_stats = 0
+
+    def publish(self, record):
+        # keep the order if the server lags behind and the ring is full
+        if self.backlog or not self.outputs.push(record):
+            self.backlog.append(record)
+
+    def flush(self):
+        while self.backlog and self.outputs.push(self.backlog[0]):
+            self.backlog.pop(0)
+
+    def on_input(self, view):
+        op = bytes(view[:1])
+        if op == OP_MOVE:
+            slot, d = MOVE.unpack_from(view, 1)
+            self.act(slot, {'code': 'move', 'dir': d})
+        elif op == OP_STOP:
+            self.act(SLOT.unpack_from(view, 1)[0], {'code': 'stop'})
+        elif op == OP_BOMB:
+            self.act(SLOT.unpack_from(view, 1)[0], {'code': 'drop_bomb'})
+        elif op == OP_START:
+            self.start(json.loads(bytes(view[1:])))
+        elif op == OP_LEAVE:
+            slot, = SLOT.unpack_from(view, 1)
+            self.game.remove_player(self.names[slot])
+            self.steering.forget(slot)
+        elif op == OP_SNAPSHOT:
+            self.publish(OUT_SNAPSHOT + self.game_start())
+        elif op == OP_QUIT:
+            self.quit = True
+
+    def act(self, slot, data):
+        if slot < len(self.names) and self.names[slot] in self.game.players:
+            a = action(self.game, self.names[slot], data)
+            if a and data['code'] in STEERING:
+                self.steering.add(slot, data['code'], a)
+            elif a:
+                self.pending.append(a)
+
+    def start(self, options):
+        self.game = GameState()
+        self.steering = Steering()
+        self.level = options['level']
+        self.game.set_level(*load_level(self.level))
+        self.game.running = True
+        self.names = options['players']
+        self.bots = Bots(self.game)
+        for name in options['bots']:
+            self.bots.add(name)
+        for name in self.names:
+            self.game.spawn_player(name)
+        self.publish(OUT_START + self.game_start())
+        self.gc.freeze()
+
+    def game_start(self):
+        # rare and critical, the server decodes it and sends it the usual way
+        return json.dumps({'code': 'game_start',
+                           'state': self.game.dump()}).encode()
+
+    def step(self, dt):
+        """ One tick: the game, the bots, then the inputs received """
+        if not self.game.running:
+            return
+        effects = [self.game.tick(dt)]
+        for a in [*self.bots.actions(self.game.clock()), *self.pending,
+                  *self.steering.actions(dt)]:
+            effects.append(a(dt))
+        for e in merge_effects(effects):
+            if e['code'] == 'update':
+                self.publish(encode_update(e['state']))
+            else:
+                self.publish(OUT_EFFECT + json.dumps(e).encode())
+        if not self.game.running:
+            self.publish(OUT_OVER + json.dumps(match_result(
+                self.game, self.level, self.bots)).encode())
+
+    def run(self, inputs: ShmRing):
+        last = tick_start = time.time()
+        while not self.quit:
+            now = time.time()
+            interval, tick_start = now - tick_start, now
+            self.gc.tick_start()
+            self.pending = []
+            inputs.consume(self.on_input)
+            self.flush()
+            self.step(now - last)
+            last = time.time()
+            pt = last - now
+            self.gc.tick_end()
+            self.tick_stats.record(interval, pt)
+            if now - self.last_stats > STATS_EVERY:
+                self.last_stats = now
+                parent = multiprocessing.parent_process()
+                if parent and not parent.is_alive():
+                    self.orphaned = True
+                    return
+                self.publish(OUT_STATS + json.dumps({
+                    'tick': self.tick_stats.dump(),
+                    'bots': self.bots.dump_stats(),
+                    'gc': self.gc.dump(),
+                    'cpu': time.process_time(),
+                }).encode())
+            self.gc.idle(self.tick - pt)
+            time.sleep(max(0, self.tick - (time.time() - now)))
+
+
+def run(inputs_name, outputs_name, tick, gc_control):
+    inputs, outputs = ShmRing(inputs_name), ShmRing(outputs_name)
+    sim = Simulation(outputs, tick, gc_control)
+    try:
+        sim.run(inputs)
+    finally:
+        # the rings are the server's to free, unless it is gone
+        inputs.close(unlink=sim.orphaned)
+        outputs.close(unlink=sim.orphaned)
+
+
+class SimLink:
+    """ Server side of the simulation process """
+
+    def __init__(self, tick, gc_control=False, capacity=1 << 22):
+        self.inputs = ShmRing(capacity=capacity)
+        self.outputs = ShmRing(capacity=capacity)
+        self.slots = {}
+        self.running = False
+        self.stats = {}
+        self.process = multiprocessing.get_context('spawn').Process(
+            target=run, args=(self.inputs.name, self.outputs.name, tick,
+                              gc_control),
+            daemon=True)
+        self.process.start()
+        atexit.register(self.close)
+
+    def start(self, players, bots, level):
+        """ New match with players, the bots among them """
+        self.slots = {name: i for i, name in enumerate(players)}
+        self.inputs.push(OP_START + json.dumps({
+            'players': players, 'bots': bots, 'level': level}).encode())
+
+    def send_input(self, name, data):
+        slot = self.slots.get(name)
+        if slot is None:
+            return
+        code = data['code']
+        if code == 'move':
+            self.inputs.push(OP_MOVE + MOVE.pack(slot, data['dir'] & 0xf))
+        elif code == 'stop':
+            self.inputs.push(OP_STOP + SLOT.pack(slot))
+        elif code == 'drop_bomb':
+            self.inputs.push(OP_BOMB + SLOT.pack(slot))
+
+    def leave(self, name):
+        if name in self.slots:
+            self.inputs.push(OP_LEAVE + SLOT.pack(self.slots[name]))
+
+    def request_snapshot(self):
+        self.inputs.push(OP_SNAPSHOT)
+
+    def poll(self, server):
+        """ Hand what the simulation published to the server """
+        def on_output(view):
+            kind = bytes(view[:1])
+            if kind == OUT_UPDATE:
+                server.updates.add(decode_update(view))
+            elif kind == OUT_EFFECT:
+                server.broadcast(json.loads(bytes(view[1:])))
+            elif kind == OUT_START:
+                self.running = True
+                server.broadcast(json.loads(bytes(view[1:])))
+            elif kind == OUT_SNAPSHOT:
+                server.send_split_snapshot(json.loads(bytes(view[1:])))
+            elif kind == OUT_OVER:
+                self.running = False
+                server.record_result(json.loads(bytes(view[1:])))
+            elif kind == OUT_STATS:
+                self.stats = json.loads(bytes(view[1:]))
+        return self.outputs.consume(on_output)
+
+    def close(self):
+        if self.process.is_alive():
+            self.inputs.push(OP_QUIT)
+            self.process.join(1)
+            if self.process.is_alive():
+                self.process.terminate()
+        if self.inputs.buf is not None:
+            self.inputs.close(unlink=True)
+            self.outputs.close(unlink=True)
@@ -0,0 +1,135 @@
+""" Compact encoding of full snapshots and their fragmentation.
+
+Cells are sent as runs of 4-bit symbols, one byte per run. Messages which
+are still too big for one datagram are zlib compressed and split into
+numbered `frag` messages which the receiver puts back together.
+"""
+import base64
+import json
+import time
+import zlib
+
+# Keeps a datagram under the usual 1280 bytes IPv6 minimum MTU,
+# minus IP/UDP headers and the frag envelope
+MAX_PAYLOAD = 1200
+FRAGMENT_SIZE = 800
+REASSEMBLY_TIMEOUT = 2
+
+SYMBOLS = '012abcd~+!'
+SYMBOL_CODES = {s: i for i, s in enumerate(SYMBOLS)}
+MAX_RUN = 16
+
+
+def encode_cells(cells) -> str:
+    """ Run length encode cells, 4 bits of run length, 4 bits of symbol """
+    out = bytearray()
+    run, prev = 0, None
+    for c in cells:
+        if c == prev and run < MAX_RUN:
+            run += 1
+            continue
+        if prev is not None:
+            out.append((run - 1) << 4 | SYMBOL_CODES[prev])
+        run, prev = 1, c
+    if prev is not None:
+        out.append((run - 1) << 4 | SYMBOL_CODES[prev])
+    return base64.b64encode(bytes(out)).decode()
+
+
+def decode_cells(data: str) -> list:
+    cells = []
+    for b in base64.b64decode(data):
+        cells += SYMBOLS[b & 0xf] * ((b >> 4) + 1)
+    return cells
+
+
+def _pack_state(state):
+    if not state or 'cells' not in state:
+        return state
+    state = dict(state)
+    state['cells_rle'] = encode_cells(state.pop('cells'))
+    return state
+
+
+def pack(payload):
+    """ Payload with its state cells in compact form, payload is untouched """
+    packed = payload
+    if 'state' in payload:
+        state = _pack_state(payload['state'])
+        if state is not payload['state']:
+            packed = {**packed, 'state': state}
+    sim = payload.get('sim')  # lockstep snapshots
+    if sim:
+        state = _pack_state(sim['state'])
+        if state is not sim['state']:
+            packed = {**packed, 'sim': {**sim, 'state': state}}
+    return packed
+
+
+def unpack(payload):
+    for state in (payload.get('state'), payload.get('sim', {}).get('state')):
+        if state and 'cells_rle' in state:
+            state['cells'] = decode_cells(state.pop('cells_rle'))
+    return payload
+
+
+class Fragmenter:
+    def __init__(self, compress=True):
+        self.compress = compress
+        self.next_id = 0
+
+    def split(self, payload):
+        """ Messages to send for payload, itself when small enough """
+        payload = pack(payload)
+        data = json.dumps(payload).encode()
+        if len(data) <= MAX_PAYLOAD:
+            return [payload]
+        return self.split_encoded(data)
+
+    def encode(self, payload):
+        """ Like split, but the datagrams, payload is only encoded once """
+        data = json.dumps(pack(payload)).encode()
+        if len(data) <= MAX_PAYLOAD:
+            return [data]
+        return [json.dumps(msg).encode() for msg in self.split_encoded(data)]
+
+    def split_encoded(self, data):
+        """ Frag messages carrying an already encoded message """
+        if self.compress:
+            data = zlib.compress(data)
+        chunks = [data[i:i + FRAGMENT_SIZE]
+                  for i in range(0, len(data), FRAGMENT_SIZE)]
+        self.next_id += 1
+        return [{'code': 'frag', 'id': self.next_id, 'i': i,
+                 'n': len(chunks), 'z': self.compress,
+                 'data': base64.b64encode(chunk).decode()}
+                for i, chunk in enumerate(chunks)]
+
+
+class Reassembler:
+    def __init__(self, timeout=REASSEMBLY_TIMEOUT):
+        self.timeout = timeout
+        self.partial = {}  # id -> (first seen, parts)
+        self.expired = 0
+
+    def add(self, frag, now=None):
+        """ Store a fragment, returns the whole message once complete """
+        now = now or time.time()
+        self.purge(now)
+        first_seen, parts = self.partial.setdefault(frag['id'], (now, {}))
+        parts[frag['i']] = frag['data']
+        if len(parts) < frag['n']:
+            return None
+
+        self.partial.pop(frag['id'])
+        data = b''.join(base64.b64decode(parts[i])
+                        for i in range(frag['n']))
+        if frag.get('z'):
+            data = zlib.decompress(data)
+        return unpack(json.loads(data.decode()))
+
+    def purge(self, now):
+        for fid, (first_seen, _) in list(self.partial.items()):
+            if now - first_seen > self.timeout:
+                self.partial.pop(fid)
+                self.expired += 1
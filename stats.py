@@ -0,0 +1,40 @@
+""" Percentiles, and the tick timings the server and simulation report """
+from collections import deque
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class TickStats:
+    """ Keeps the last few seconds of tick timings """
+
+    def __init__(self, tick, size=600):
+        self.tick = tick
+        self.intervals = deque(maxlen=size)
+        self.durations = deque(maxlen=size)
+        self.ticks = 0
+        self.overruns = 0
+
+    def record(self, interval, duration):
+        self.ticks += 1
+        self.intervals.append(interval)
+        self.durations.append(duration)
+        if duration > self.tick:
+            self.overruns += 1
+
+    def dump(self):
+        jitter = [abs(i - self.tick) for i in self.intervals]
+        return {
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'interval_mean': (sum(self.intervals) / len(self.intervals)
+                              if self.intervals else 0),
+            'jitter_p50': percentile(jitter, 0.5),
+            'jitter_p99': percentile(jitter, 0.99),
+            'jitter_max': max(jitter, default=0),
+            'duration_p99': percentile(self.durations, 0.99),
+        }
@@ -0,0 +1,12 @@
+""" BatchGame against the reference GameState, see batch.check """
+import pytest
+
+pytest.importorskip('numpy')
+
+import batch  # noqa: E402
+
+
+@pytest.mark.parametrize('dt', [batch.DT, 1/30, 1/20])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_same_as_gamestate(seed, dt):
+    assert batch.check(matches=4, ticks=1200, seed=seed, dt=dt) is None
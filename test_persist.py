@@ -0,0 +1,31 @@
+""" Snapshots keep what the match result is made of """
+import json
+
+import pytest
+
+import persist
+from bomb import GameState, load_level
+
+
+def test_round_trip_keeps_result_fields():
+    t = [1000.0]
+    gs = GameState(clock=lambda: t[0])
+    gs.set_level(*load_level('map1.txt'))
+    gs.running = True
+    for name in ('a', 'b', 'c'):
+        gs.spawn_player(name)
+    gs.drop_bomb('a')
+    gs.player_stats['b']['pickups'] += 2
+    gs.stats['pickup~'] += 2
+    gs.deaths['b'] = 1005.0
+
+    data = json.loads(json.dumps(persist.capture_game(gs, 1010.0)))
+    restored = persist.restore_game(data, 2000.0)
+
+    assert restored.started_at == pytest.approx(1990.0)
+    assert restored.deaths == {'b': pytest.approx(1995.0)}
+    assert restored.stats == gs.stats
+    assert restored.player_stats == gs.player_stats
+    # still counted the same way from there on
+    restored.player_stats['c']['bombs'] += 1
+    assert restored.player_stats['c']['bombs'] == 1
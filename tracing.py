@@ -0,0 +1,152 @@
+""" Spans around the phases of a tick, kept in a ring buffer.
+
+`Tracer.span` times a `with` block: the server's tick and its phases, the
+phases of `GameState.tick`, garbage collections. The last `EVENTS` spans are
+kept and can be written as Chrome trace events JSON, for a time window or
+only the slow ticks, to look at in Perfetto (ui.perfetto.dev) or
+chrome://tracing. `NULL_TRACER` does nothing, it is what games and servers
+have when tracing is off.
+
+`python tracing.py --seconds 10` asks a running server for its last ten
+seconds of spans.
+"""
+import json
+import os
+import time
+from bisect import bisect_right
+from collections import deque
+
+# about a minute of a server at 60 ticks per second
+EVENTS = 60000
+OUTPUT_DIR = 'traces'
+
+
+class Span:
+    __slots__ = ('events', 'name', 'args', 'start')
+
+    def __init__(self, events, name, args):
+        self.events = events
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.events.append((self.name, self.start,
+                            time.perf_counter() - self.start, self.args))
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class NullTracer:
+    enabled = False
+    _span = NullSpan()
+
+    def span(self, name, args=None):
+        return self._span
+
+    def add(self, name, start, duration, args=None):
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+class Tracer:
+    enabled = True
+
+    def __init__(self, name='server', size=EVENTS, output_dir=OUTPUT_DIR):
+        self.name = name
+        self.output_dir = output_dir
+        self.events = deque(maxlen=size)  # (name, start, duration, args)
+        # perf_counter to wall clock, so traces of processes line up
+        self.offset = time.time() - time.perf_counter()
+        self.written = 0
+
+    def span(self, name, args=None):
+        return Span(self.events, name, args)
+
+    def add(self, name, start, duration, args=None):
+        """ A span timed elsewhere, start from perf_counter """
+        self.events.append((name, start, duration, args))
+
+    def select(self, seconds=None, slow=None):
+        """ Spans of the last seconds, and only those within ticks which
+        took at least slow seconds """
+        events = list(self.events)
+        if seconds:
+            since = time.perf_counter() - seconds
+            events = [e for e in events if e[1] >= since]
+        if slow:
+            ticks = sorted((start, start + duration)
+                           for name, start, duration, _ in events
+                           if name == 'tick' and duration >= slow)
+            starts = [start for start, _ in ticks]
+
+            def in_slow_tick(e):
+                i = bisect_right(starts, e[1]) - 1
+                return i >= 0 and e[1] + e[2] <= ticks[i][1]
+            events = [e for e in events if in_slow_tick(e)]
+        return events
+
+    def chrome(self, events):
+        """ Chrome trace events: complete events, in microseconds """
+        pid = os.getpid()
+        trace = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+                  'args': {'name': self.name}}]
+        for name, start, duration, args in events:
+            event = {'name': name, 'ph': 'X', 'pid': pid, 'tid': 0,
+                     'ts': (start + self.offset) * 1e6,
+                     'dur': duration * 1e6}
+            if args:
+                event['args'] = args
+            trace.append(event)
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+
+    def write(self, events):
+        """ Write spans from select, returns the file name. Can run in
+        another thread, events is a copy """
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.written += 1
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        filename = os.path.join(self.output_dir,
+                                f'{stamp}-{self.written}.trace.json')
+        with open(filename, 'w') as f:
+            json.dump(self.chrome(events), f)
+        print(f"Trace written: {len(events)} spans -> {filename}")
+        return filename
+
+
+def dump_remote(host='127.0.0.1', port=1888, seconds=None, slow=None):
+    """ Ask a running server to write its trace """
+    import socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(5)
+    sock.sendto(json.dumps({'code': 'admin', 'cmd': 'trace',
+                            'seconds': seconds, 'slow': slow}).encode(),
+                (host, port))
+    try:
+        return json.loads(sock.recv(65535).decode())
+    finally:
+        sock.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Write the trace of a server started with --trace")
+    parser.add_argument('--port', type=int, default=1888)
+    parser.add_argument('--seconds', type=float,
+                        help="only the last seconds (default: all kept)")
+    parser.add_argument('--slow', type=float, metavar='SECONDS',
+                        help="only ticks which took at least that long")
+    args = parser.parse_args()
+    print(dump_remote(port=args.port, seconds=args.seconds, slow=args.slow))